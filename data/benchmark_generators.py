@@ -0,0 +1,293 @@
+"""
+Throughput and memory benchmarks for the dataset generators in generate_datasets.py.
+
+Each case (generator x engine x row count) runs in a fresh process, so the reported peak RSS
+belongs to that case alone. A case times generation, then writes the DataFrame in each output
+format and records the seconds and bytes written. The Claude note path is benchmarked end to end
+against mock_claude_server.py with configurable latency.
+
+Results are saved as JSON; pass an earlier results file to --compare to flag cases whose rows/sec
+dropped (or peak RSS grew) by more than --threshold. The exit status is 1 if anything regressed.
+
+Usage:
+    # Default sweep: 10k..10M rows for the numpy and counter engines, python engine up to 100k rows
+    python -m benchmark_generators --output bench_main.json
+
+    # Quick run of two generators, compared against a baseline
+    python -m benchmark_generators --cases labs notes_template --rows 10000 100000 --repeat 3 \
+        --compare bench_main.json --threshold 0.15
+
+    # Only the mock-LLM benchmark, 0.8s simulated latency
+    python -m benchmark_generators --cases llm --llm-notes 5000 --llm-latency 0.8
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import generate_datasets as gd
+
+DEFAULT_ROWS = [10_000, 100_000, 1_000_000, 10_000_000]
+GENERATOR_CASES = ["patients", "labs", "notes_template", "notes_expand", "notes_markov"]
+# Dataset each generator case writes, for the output writers
+CASE_DATASETS = {"patients": "patients", "labs": "labs", "notes_template": "notes", "notes_expand": "notes",
+                 "notes_markov": "notes"}
+# expand_notes_with_variations has no numpy or counter engine
+PYTHON_ONLY_CASES = {"notes_expand"}
+# The Markov synthesizer is vectorized and draws from a numpy Generator whatever the engine
+NUMPY_ONLY_CASES = {"notes_markov"}
+BENCHMARK_PATIENTS = 12_400
+BENCHMARK_BASE_NOTES = 2_000
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux but bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def generate_case(case, engine, rows):
+    """Build the DataFrame for one generator case; returns (df, generation seconds)."""
+    gd.random.seed(gd.SEED)
+    rng = np.random.default_rng(gd.SEED)
+    patient_ids = gd.PatientIdRange(0, BENCHMARK_PATIENTS)
+
+    base_notes_df = None
+    if case == "notes_expand":
+        # Base notes stand in for Claude output and are not part of the timing
+        base_notes_df = gd.generate_clinical_notes_template(BENCHMARK_BASE_NOTES, patient_ids)
+    elif case == "notes_markov":
+        # Training is a one-off cost per run, so it is not part of the timing either
+        model = gd.train_markov_model()
+
+    started = time.perf_counter()
+    if engine == "counter":
+        if case == "patients":
+            df = gd.generate_patient_demographics_range(0, rows)
+        elif case == "labs":
+            df = gd.generate_lab_results_range(0, rows, patient_ids)
+        else:
+            df = gd.generate_clinical_notes_range(0, rows, patient_ids)
+    elif case == "patients":
+        df = gd.generate_patient_demographics(rows, engine=engine, rng=rng)
+    elif case == "labs":
+        df = gd.generate_lab_results(rows, patient_ids, engine=engine, rng=rng)
+    elif case == "notes_markov":
+        df = gd.generate_clinical_notes_markov(rows, patient_ids, model, rng=rng)
+    elif case == "notes_template":
+        df = gd.generate_clinical_notes_template(rows, patient_ids, engine=engine, rng=rng)
+    else:
+        df = gd.expand_notes_with_variations(base_notes_df, rows, patient_ids)
+    return df, time.perf_counter() - started
+
+
+def run_generator_case(case, engine, rows, formats, compression):
+    """Run one case in the current (fresh) process and return its result record."""
+    baseline_rss = peak_rss_mb()
+    df, seconds = generate_case(case, engine, rows)
+    result = {
+        "case": case,
+        "engine": engine,
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(rows / seconds, 1),
+        "formats": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in formats:
+            path = os.path.join(tmp, gd.dataset_path(CASE_DATASETS[case], fmt))
+            started = time.perf_counter()
+            with gd.DatasetWriter(path, CASE_DATASETS[case], fmt, compression=compression) as writer:
+                writer.write(df)
+            write_seconds = time.perf_counter() - started
+            result["formats"][fmt] = {
+                "seconds": round(write_seconds, 4),
+                "rows_per_sec": round(rows / write_seconds, 1),
+                "bytes": os.path.getsize(path),
+            }
+            os.remove(path)
+
+    result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    result["baseline_rss_mb"] = round(baseline_rss, 1)
+    return result
+
+
+def run_llm_case(num_notes, latency, latency_jitter, max_concurrent, batch_size, rate_limit_prob):
+    """End-to-end notes/sec for generate_clinical_notes_with_claude against a local mock server."""
+    from mock_claude_server import start_mock_server
+
+    os.environ.setdefault("ANTHROPIC_API_KEY", "mock")
+    server = start_mock_server(latency=latency, latency_jitter=latency_jitter, rate_limit_prob=rate_limit_prob)
+    try:
+        gd.random.seed(gd.SEED)
+        patient_df = gd.generate_patient_demographics(BENCHMARK_PATIENTS, engine="numpy",
+                                                      rng=np.random.default_rng(gd.SEED))
+        baseline_rss = peak_rss_mb()
+        started = time.perf_counter()
+        notes_df = gd.generate_clinical_notes_with_claude(num_notes, patient_df, batch_size=batch_size,
+                                                          max_concurrent=max_concurrent, base_url=server.url)
+        seconds = time.perf_counter() - started
+    finally:
+        server.shutdown()
+
+    generated = 0 if notes_df is None else int((~notes_df["note_text"].isin(
+        ["Note generation failed.", "Note not available."])).sum())
+    return {
+        "case": "llm",
+        "engine": "mock",
+        "rows": num_notes,
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(generated / seconds, 1),
+        "notes_generated": generated,
+        "requests": server.requests,
+        "rejected": server.rejected,
+        "latency": latency,
+        "max_concurrent": max_concurrent,
+        "formats": {},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "baseline_rss_mb": round(baseline_rss, 1),
+    }
+
+
+def in_fresh_process(fn, *args):
+    """Call fn(*args) in a new spawned process, so its peak RSS is not inflated by earlier cases."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def best_of(repeat, fn, *args):
+    """Run a case repeat times in fresh processes and keep the fastest run, to damp timing noise."""
+    runs = [in_fresh_process(fn, *args) for _ in range(repeat)]
+    return max(runs, key=lambda r: r["rows_per_sec"])
+
+
+def case_key(result):
+    return f"{result['case']}/{result['engine']}/{result['rows']}"
+
+
+def compare_results(baseline, results, threshold):
+    """Return regression messages for cases slower (or hungrier) than the baseline by more than threshold."""
+    previous = {case_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        checks = [("generate rows/sec", old["rows_per_sec"], result["rows_per_sec"], True),
+                  ("peak RSS MB", old["peak_rss_mb"], result["peak_rss_mb"], False)]
+        for fmt, stats in result["formats"].items():
+            if fmt in old["formats"]:
+                checks.append((f"{fmt} write rows/sec", old["formats"][fmt]["rows_per_sec"], stats["rows_per_sec"], True))
+        for metric, before, after, higher_is_better in checks:
+            if not before:
+                continue
+            change = (after - before) / before
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(f"{case_key(result)}: {metric} {before:,.1f} -> {after:,.1f} ({change:+.1%})")
+    return regressions
+
+
+def print_result(result):
+    line = (f"   {case_key(result):<32} {result['rows_per_sec']:>14,.0f} rows/s "
+            f"{result['seconds']:>9.2f}s  peak RSS {result['peak_rss_mb']:>8,.0f} MB")
+    for fmt, stats in result["formats"].items():
+        line += f"  {fmt}: {stats['bytes'] / 1e6:,.1f} MB @ {stats['rows_per_sec']:,.0f} rows/s"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the clinical trial dataset generators")
+    parser.add_argument("--cases", nargs="+", default=GENERATOR_CASES + ["llm"],
+                        choices=GENERATOR_CASES + ["llm"], help="Benchmarks to run (default: all)")
+    parser.add_argument("--rows", nargs="+", type=int, default=DEFAULT_ROWS,
+                        help="Row counts to sweep (default: 10k 100k 1M 10M)")
+    parser.add_argument("--engines", nargs="+", default=["python", "numpy", "counter"],
+                        choices=["python", "numpy", "counter"])
+    parser.add_argument("--max-python-rows", type=int, default=100_000,
+                        help="Skip python-engine cases above this many rows (default: 100000)")
+    parser.add_argument("--formats", nargs="+", default=None, choices=gd.OUTPUT_FORMATS,
+                        help="Output formats to time (default: csv, plus parquet if pyarrow is installed)")
+    parser.add_argument("--compression", choices=["none", "zstd"], default=None)
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Run each case this many times and keep the fastest (default: 1)")
+    parser.add_argument("--llm-notes", type=int, default=2000, help="Notes for the mock-LLM benchmark (default: 2000)")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Mock API latency in seconds (default: 0.5)")
+    parser.add_argument("--llm-latency-jitter", type=float, default=0.1)
+    parser.add_argument("--llm-rate-limit-prob", type=float, default=0.0)
+    parser.add_argument("--llm-max-concurrent", type=int, default=32)
+    parser.add_argument("--llm-batch-size", type=int, default=20)
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to save the results JSON")
+    parser.add_argument("--compare", default=None, help="Earlier results JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Relative slowdown / memory growth counted as a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    formats = args.formats
+    if formats is None:
+        formats = ["csv"]
+        try:
+            import pyarrow  # noqa: F401
+            formats.append("parquet")
+        except ImportError:
+            pass
+
+    results = []
+    print("Benchmarking dataset generators...")
+    for case in [c for c in args.cases if c != "llm"]:
+        for engine in args.engines:
+            if engine != "python" and case in PYTHON_ONLY_CASES:
+                continue
+            if engine != "numpy" and case in NUMPY_ONLY_CASES:
+                continue
+            for rows in args.rows:
+                if engine == "python" and rows > args.max_python_rows:
+                    continue
+                result = best_of(args.repeat, run_generator_case, case, engine, rows, formats, args.compression)
+                print_result(result)
+                results.append(result)
+
+    if "llm" in args.cases:
+        print(f"\nBenchmarking Claude note generation against a mock API ({args.llm_latency}s latency)...")
+        result = best_of(args.repeat, run_llm_case, args.llm_notes, args.llm_latency, args.llm_latency_jitter,
+                         args.llm_max_concurrent, args.llm_batch_size, args.llm_rate_limit_prob)
+        print_result(result)
+        results.append(result)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": gd.pd.__version__,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved: {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, args.threshold)
+        if regressions:
+            print(f"\nREGRESSIONS vs {args.compare} (threshold {args.threshold:.0%}):")
+            for message in regressions:
+                print(f"   {message}")
+            sys.exit(1)
+        print(f"\nNo regressions vs {args.compare} (threshold {args.threshold:.0%})")
+
+
+if __name__ == "__main__":
+    main()
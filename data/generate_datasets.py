@@ -7,7 +7,7 @@ Datasets:
 3. clinical_notes_raw (~28,000 records) - can use Claude API for realistic generation
 
 Usage:
-    pip install faker pandas anthropic
+    pip install faker numpy pandas anthropic pyarrow
 
     # Basic generation (template-based notes):
     python generate_datasets.py
@@ -17,38 +17,652 @@ Usage:
 
     # RECOMMENDED: Generate 2k base notes with Claude, expand to 28k with variations:
     python generate_datasets.py --expand-notes --base-notes 2000
+
+    # Continue an interrupted Claude run (completed notes are checkpointed to --journal; --fresh discards them):
+    python generate_datasets.py --expand-notes --base-notes 2000 --resume
+
+    # Millions of offline notes from an n-gram model trained on example, template and earlier Claude notes:
+    python generate_datasets.py --engine numpy --notes-engine markov --markov-corpus claude_batches.jsonl \
+        --num-notes 5000000 --workers 8
+
+    # Large cohorts with the vectorized numpy engine:
+    python generate_datasets.py --engine numpy --num-patients 5000000
+
+    # Counter-based engine: each row depends only on --seed and its index, so any range can be
+    # regenerated on its own (see generate_lab_results_range) and sharding doesn't change the output:
+    python generate_datasets.py --engine counter --workers 8 --shard-size 250000
+
+    # Stream to disk in 1M-row chunks (memory stays flat regardless of row counts):
+    python generate_datasets.py --engine numpy --chunk-size 1000000 --num-lab-results 100000000
+
+    # Shard across 16 processes (output depends only on --seed and --shard-size):
+    python generate_datasets.py --engine numpy --workers 16 --num-lab-results 1000000000
+
+    # Typed, compressed columnar output (requires pyarrow):
+    python generate_datasets.py --engine numpy --format parquet --compression zstd
+
+    # Monthly partitions (lab_results_2025/test_month=2025-03/part-0000.parquet, with a _manifest.json):
+    python generate_datasets.py --engine numpy --format parquet --partition-by month
+
+    # One pass over the cohort, each patient's labs and notes conditioned on them and written alongside:
+    python generate_datasets.py --engine numpy --fused --num-patients 1000000 --num-lab-results 40000000
+
+    # Load straight into a local database (tables indexed on patient_id and date after the load) and time
+    # the pipeline's join:
+    python generate_datasets.py --engine numpy --workers 8 --num-lab-results 10000000 --sink duckdb --sink-benchmark
+
+    # Add 10k lab results to the existing outputs (same seed/engine/format as the original run):
+    python generate_datasets.py --append --num-lab-results 10000
+
+Output goes to the current directory. Runs with non-default settings (seed, engine, format, dates,
+activity, partitioning) and --append runs also write a <name>.meta.json per dataset recording its
+row count, files and those settings, which --append restores; default runs write only the data.
+With --stats, each dataset also gets a <name>.stats.json of summary statistics computed while it is
+written (value counts, quantiles, distinct patients, null and anomaly counts).
+
+Library use (e.g. from a notebook or a Python recipe), with compact dtypes: integer patient numbers,
+categoricals, datetime64 dates, float32 values and Arrow-backed note text:
+    from generate_datasets import PatientIdRange, generate_lab_results, format_patient_ids
+    labs = generate_lab_results(45_000_000, PatientIdRange(0, 12400), engine="numpy", compact=True)
 """
 
 import argparse
+import asyncio
+import base64
+import collections
+import contextlib
+import functools
+import hashlib
+import json
 import random
 import os
+import re
+import string
+import time
+import tracemalloc
+import zlib
 from datetime import datetime, timedelta
-from faker import Faker
+import numpy as np
 import pandas as pd
 
-fake = Faker()
-Faker.seed(42)
-random.seed(42)
+SEED = 42
+
+random.seed(SEED)
 
 # Configuration
 NUM_PATIENTS = 12400
 NUM_LAB_RESULTS = 45000
 NUM_CLINICAL_NOTES = 28000
 
+# ============================================
+# Instrumentation
+# ============================================
+STAGES = ["generate", "build_dataframe", "serialize", "write", "merge", "llm", "stats", "index"]
+PROGRESS_INTERVAL = 5.0  # seconds between progress lines
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64]  # request latency histogram upper bounds (s)
+# Prompt-cache pricing relative to uncached input tokens, for the savings estimate
+CACHE_WRITE_PRICE = 1.25
+CACHE_READ_PRICE = 0.1
+
+
+class Metrics:
+    """Per-stage timers, progress and LLM request stats, optionally written as JSON lines to path.
+
+    Stages nest, and each reports its own time excluding nested stages, so the per-stage totals
+    add up to where the run spent its time. With trace_memory, tracemalloc records the peak traced
+    memory inside each stage (at a sizeable slowdown for pure-Python loops). profile names one stage
+    to run under cProfile; the stats are dumped to profile_path on close().
+    """
+
+    def __init__(self, path=None, trace_memory=False, profile=None, profile_path=None, mode="w"):
+        self.path = path
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.profile_path = profile_path or (f"profile_{profile}.prof" if profile else None)
+        self.mode = mode
+        self.totals = {}  # (dataset, stage) -> {"seconds", "rows", "calls", "peak_bytes"}
+        self.requests = {"ok": 0, "errors": 0, "retries": 0, "input_tokens": 0, "output_tokens": 0,
+                         "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0, "cache_hits": 0}
+        self.latencies = []
+        self._file = None
+        self._stack = []
+        self._profiler = None
+        self._profile_depth = 0
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __getstate__(self):
+        # Shard workers get the settings only; they append to the same file and don't profile
+        return {"path": self.path, "trace_memory": self.trace_memory}
+
+    def __setstate__(self, state):
+        self.__init__(mode="a", **state)
+
+    def emit(self, event, **fields):
+        if self.path is None:
+            return
+        if self._file is None:
+            if self.mode == "w":
+                open(self.path, "w").close()
+            # Append mode even for the parent, so lines from shard workers never get overwritten
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps({"time": round(time.time(), 3), "event": event, "pid": os.getpid(), **fields},
+                                    default=str) + "\n")
+        self._file.flush()
+
+    @contextlib.contextmanager
+    def stage(self, name, dataset=None, rows=None):
+        """Time (and optionally memory-trace or profile) the enclosed block as one stage."""
+        frame = {"child": 0.0, "peak": 0}
+        if self.trace_memory:
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+        profiling = name == self.profile
+        if profiling:
+            self._start_profile()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiling:
+                self._stop_profile()
+            self._stack.pop()
+            seconds = elapsed - frame["child"]
+            if self._stack:
+                self._stack[-1]["child"] += elapsed
+            peak = None
+            if self.trace_memory:
+                peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                if self._stack:
+                    self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+                tracemalloc.reset_peak()
+            self._add(dataset, name, seconds, rows or 0, 1, peak or 0)
+            self.emit("stage", stage=name, dataset=dataset, rows=rows, seconds=round(seconds, 6),
+                      elapsed=round(elapsed, 6), rows_per_sec=round(rows / seconds, 1) if rows and seconds else None,
+                      peak_mb=round(peak / 2**20, 2) if peak is not None else None)
+
+    def _add(self, dataset, name, seconds, rows, calls, peak_bytes):
+        total = self.totals.setdefault((dataset, name), {"seconds": 0.0, "rows": 0, "calls": 0, "peak_bytes": 0})
+        total["seconds"] += seconds
+        total["rows"] += rows
+        total["calls"] += calls
+        total["peak_bytes"] = max(total["peak_bytes"], peak_bytes)
+
+    def merge(self, totals):
+        """Fold in stage totals reported by a shard worker (their seconds are CPU-parallel, not wall time)."""
+        for (dataset, name), total in totals.items():
+            self._add(dataset, name, total["seconds"], total["rows"], total["calls"], total["peak_bytes"])
+
+    def _start_profile(self):
+        import cProfile
+
+        if self._profiler is None:
+            self._profiler = cProfile.Profile()
+        if self._profile_depth == 0:
+            self._profiler.enable()
+        self._profile_depth += 1
+
+    def _stop_profile(self):
+        self._profile_depth -= 1
+        if self._profile_depth == 0:
+            self._profiler.disable()
+
+    def progress(self, label, total, unit="rows"):
+        return Progress(self, label, total, unit)
+
+    def record_request(self, latency, attempt, usage=None, error=None):
+        """Account one API attempt: its latency, whether it was a retry, and token usage if it succeeded."""
+        self.latencies.append(latency)
+        self.requests["retries"] += attempt > 0
+        if error is not None:
+            self.requests["errors"] += 1
+        else:
+            self.requests["ok"] += 1
+            for field in ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"):
+                self.requests[field] += getattr(usage, field, 0) or 0
+            self.requests["cache_hits"] += bool(getattr(usage, "cache_read_input_tokens", 0))
+        self.emit("llm_request", latency=round(latency, 4), attempt=attempt, error=error,
+                  input_tokens=getattr(usage, "input_tokens", None), output_tokens=getattr(usage, "output_tokens", None),
+                  cache_read_input_tokens=getattr(usage, "cache_read_input_tokens", None))
+
+    def llm_summary(self):
+        """Print and emit request counts, latency percentiles/histogram and token totals for the LLM path."""
+        if not self.latencies:
+            return
+        latencies = np.array(self.latencies)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        histogram = np.histogram(latencies, bins=[0] + LATENCY_BUCKETS + [np.inf])[0]
+        requests = self.requests
+        print(f"   Requests: {requests['ok']} ok, {requests['errors']} errors, {requests['retries']} retries; "
+              f"latency p50 {p50:.2f}s, p90 {p90:.2f}s, p99 {p99:.2f}s, max {latencies.max():.2f}s")
+        print(f"   Tokens: {requests['input_tokens']:,} input, {requests['output_tokens']:,} output")
+        cached, written = requests["cache_read_input_tokens"], requests["cache_creation_input_tokens"]
+        # Input tokens billed as if uncached, minus what was actually billed for them
+        saved = cached * (1 - CACHE_READ_PRICE) - written * (CACHE_WRITE_PRICE - 1)
+        if cached or written:
+            total_input = requests["input_tokens"] + cached + written
+            print(f"   Prompt cache: {requests['cache_hits']}/{requests['ok']} requests hit, "
+                  f"{cached:,} input tokens read from cache, {written:,} written; "
+                  f"~{saved:,.0f} input tokens saved ({saved / total_input:.0%} of input)")
+        self.emit("llm_summary", **requests, cache_saved_input_tokens=round(saved), latency_p50=round(p50, 4), latency_p90=round(p90, 4),
+                  latency_p99=round(p99, 4), latency_max=round(float(latencies.max()), 4),
+                  latency_histogram=dict(zip([f"<={b}s" for b in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"],
+                                                histogram.tolist())))
+
+    def close(self, report=True):
+        """Print and emit the per-stage summary, dump the profile and close the metrics file."""
+        if report and self.totals:
+            print("\nTime by stage (own time, excluding nested stages; sharded stages are summed over workers):")
+            for (dataset, name), total in sorted(self.totals.items(), key=lambda item: -item[1]["seconds"]):
+                line = f"   {dataset or '-':<9} {name:<16} {total['seconds']:>9.2f}s"
+                if total["rows"] and total["seconds"]:
+                    line += f"  {total['rows']:>13,} rows  {total['rows'] / total['seconds']:>13,.0f} rows/s"
+                if total["peak_bytes"]:
+                    line += f"  peak {total['peak_bytes'] / 2**20:,.1f} MB"
+                print(line)
+        if report:
+            self.emit("summary", stages=[{"dataset": dataset, "stage": name, **total}
+                                         for (dataset, name), total in self.totals.items()])
+        if self._profiler is not None:
+            import pstats
+
+            self._profiler.dump_stats(self.profile_path)
+            print(f"\nProfile of stage '{self.profile}' saved to {self.profile_path}; top functions by cumulative time:")
+            pstats.Stats(self._profiler).sort_stats("cumulative").print_stats(15)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Progress:
+    """Rows done, rows/sec and ETA for one long-running step, printed every PROGRESS_INTERVAL seconds."""
+
+    def __init__(self, metrics, label, total, unit="rows"):
+        self.metrics = metrics
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.started = time.monotonic()
+        self._printed = self.started
+
+    def update(self, done):
+        now = time.monotonic()
+        elapsed = now - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - done) / rate if rate else None
+        self.metrics.emit("progress", label=self.label, done=done, total=self.total, unit=self.unit,
+                          rate=round(rate, 1), eta=round(eta, 1) if eta is not None else None)
+        if now - self._printed >= PROGRESS_INTERVAL or done >= self.total:
+            self._printed = now
+            line = f"   Progress: {done:,}/{self.total:,} {self.unit} ({rate:,.0f} {self.unit}/s"
+            line += f", ETA {eta:.0f}s)" if done < self.total and eta is not None else ")"
+            print(line, flush=True)
+
+
+METRICS = Metrics()
+
+
+def configure_metrics(metrics):
+    """Replace the module-wide Metrics used by the generators and writers."""
+    global METRICS
+    METRICS = metrics
+
+
+def timed(stage, dataset, rows_arg=0):
+    """Decorator running a function as a METRICS stage, counting the rows in positional argument rows_arg.
+
+    rows_arg may also be a function of the call's arguments that returns the row count.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            rows = rows_arg(*args, **kwargs) if callable(rows_arg) else args[rows_arg]
+            with METRICS.stage(stage, dataset, rows):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 # ============================================
 # Dataset 1: patient_demographics
 # ============================================
-def generate_patient_demographics(num_patients):
-    """Generate patient demographics dataset with enrollment_success that correlates with key predictors."""
+REGIONS = ["Northeast", "Midwest", "Southwest", "Southeast", "West", "Pacific"]
+GENDERS = ["Female", "Male", "Non-binary"]
+GENDER_WEIGHTS = [0.48, 0.48, 0.04]
+CONTACT_STATUSES = ["Active", "Inactive", "Deceased"]
+CONTACT_WEIGHTS = [0.85, 0.12, 0.03]
+ENROLLMENT_HISTORY_WEIGHTS = [0.6, 0.25, 0.1, 0.04, 0.01]
+CONTRAINDICATION_WEIGHTS = [0.5, 0.3, 0.15, 0.05]
+
+DATE_START = np.datetime64("2025-01-01")
+DATE_END = np.datetime64("2025-12-31")
+
+
+class DateSampler:
+    """Draws dates in [start, end] as day offsets into a precomputed ISO string table.
+
+    seasonality is the relative amplitude of a yearly cycle peaking in mid-January (0 = uniform),
+    weekday_weights optionally weights Monday..Sunday (e.g. fewer weekend visits).
+
+    Uniform dates for the python engine still come from Faker's date_between, seeded with seed(),
+    so its rows match the original generator's for the same seed; the numpy and counter engines
+    draw from the table.
+    """
+
+    def __init__(self, start=DATE_START, end=DATE_END, seasonality=0.0, weekday_weights=None):
+        days = np.arange(start, end + 1, dtype="datetime64[D]")
+        self.start = days[0]
+        self.iso = days.astype(str).tolist()
+        self.num_days = len(days)
+        self._bounds = (days[0].item(), days[-1].item())
+        self._faker_seed = SEED
+        self._faker = None
+
+        weights = np.ones(self.num_days)
+        if seasonality:
+            day_of_year = (days - days.astype("datetime64[Y]")).astype(int)
+            weights *= 1 + seasonality * np.cos(2 * np.pi * (day_of_year - 14) / 365.25)
+        if weekday_weights is not None:
+            weekday = (days.astype(int) - 4) % 7  # 1970-01-01 was a Thursday
+            weights *= np.asarray(weekday_weights, dtype=float)[weekday]
+
+        if seasonality or weekday_weights is not None:
+            self.p = weights / weights.sum()
+            self._cum_weights = np.cumsum(weights).tolist()
+        else:
+            self.p = None
+            self._cum_weights = None
+
+    def __getstate__(self):
+        # Shard workers build their own Faker, seeded by seed_shard
+        return dict(self.__dict__, _faker=None)
+
+    def seed(self, seed):
+        """Seed the Faker generator behind sample(), alongside random.seed."""
+        self._faker_seed = seed
+        self._faker = None
+
+    def sample(self):
+        """One ISO date string (python engine): from Faker when uniform, else from the global random module."""
+        if self._cum_weights is None:
+            if self._faker is None:
+                from faker import Faker
+
+                self._faker = Faker()
+                self._faker.seed_instance(self._faker_seed)
+            start, end = self._bounds
+            return self._faker.date_between(start_date=start, end_date=end).isoformat()
+        return random.choices(self.iso, cum_weights=self._cum_weights)[0]
+
+    def sample_offsets(self, rng, n):
+        """n day offsets from start, drawn from a numpy Generator."""
+        if self.p is None:
+            return rng.integers(0, self.num_days, n)
+        return rng.choice(self.num_days, n, p=self.p)
+
+    def sample_array(self, rng, n):
+        """n ISO dates as a Categorical over the lookup table (no per-row formatting)."""
+        return pd.Categorical.from_codes(self.sample_offsets(rng, n), self.iso)
+
+    def as_datetime(self, values):
+        """datetime64[D] array for a Categorical drawn by sample_array or from_uniforms."""
+        return self.start + np.asarray(values.codes, dtype=np.int64)
+
+    def from_uniforms(self, u):
+        """One ISO date per uniform in u, as a Categorical (counter-based engine)."""
+        if self.p is None:
+            offsets = np.minimum((u * self.num_days).astype(np.int64), self.num_days - 1)
+        else:
+            offsets = np.minimum(np.searchsorted(np.cumsum(self.p), u, side="right"), self.num_days - 1)
+        return pd.Categorical.from_codes(offsets, self.iso)
+
+
+# Date sampler used by every generator; main() reconfigures it from the command line
+DATES = DateSampler()
+
+
+def configure_dates(sampler):
+    """Replace the module-level DateSampler (also used to ship it to shard worker processes)."""
+    global DATES
+    DATES = sampler
+
+
+def format_patient_ids(indices):
+    """Format integer patient indices as PT-2025-NNNNN strings."""
+    return "PT-2025-" + pd.Series(indices).astype(str).str.zfill(5)
+
+
+def gather_categorical(values, codes):
+    """Build a Categorical of values[codes] without materializing one string per row."""
+    categories, inverse = np.unique(np.asarray(values), return_inverse=True)
+    return pd.Categorical.from_codes(inverse[codes], categories)
+
+
+class PatientIdRange:
+    """Compact stand-in for the patient ID list PT-2025-{start} .. PT-2025-{stop - 1}.
+
+    Supports len() and indexing, so random.choice() works on it like on a list of strings,
+    without holding millions of strings in memory.
+    """
+
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("patient index out of range")
+        return f"PT-2025-{self.start + i:05d}"
+
+
+def take_patient_ids(patient_ids, codes):
+    """Return the patient IDs at integer positions codes, for a list, PatientIdRange or PatientActivity."""
+    if isinstance(patient_ids, PatientActivity):
+        patient_ids = patient_ids.patient_ids
+    if isinstance(patient_ids, PatientIdRange):
+        if len(patient_ids) < len(codes):
+            # Fewer patients than rows: format each ID once and gather
+            table = format_patient_ids(np.arange(patient_ids.start, patient_ids.stop)).to_numpy(dtype=object)
+            return pd.Series(table[codes])
+        return format_patient_ids(patient_ids.start + codes)
+    return gather_categorical(patient_ids, codes)
+
+
+def patient_index(patient_ids, codes):
+    """Integer patient numbers NNNNN of the IDs at positions codes (compact frames; see format_patient_ids)."""
+    if isinstance(patient_ids, PatientActivity):
+        patient_ids = patient_ids.patient_ids
+    if isinstance(patient_ids, PatientIdRange):
+        return (patient_ids.start + np.asarray(codes)).astype(np.int32)
+    numbers = np.array([int(patient_id.rsplit("-", 1)[1]) for patient_id in patient_ids], dtype=np.int32)
+    return numbers[codes]
+
+
+def compact_frame(dataset, columns):
+    """Build a memory-compact DataFrame straight from a generator's column arrays.
+
+    patient_id holds the integer patient number (format_patient_ids turns it back into
+    PT-2025-NNNNN), dates are datetime64 (pandas stores day dates as datetime64[s]), numbers are
+    narrowed to their DATASET_SCHEMAS types, low-cardinality strings are categoricals and free
+    text is an Arrow-backed string column. A 45M-row lab table takes about 1.3 GB this way.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("compact=True requires pyarrow. Run: pip install pyarrow") from None
+
+    data = {}
+    for name, kind in DATASET_SCHEMAS[dataset]:
+        values = columns[name]
+        if name == "patient_id":
+            data[name] = np.asarray(values, dtype=np.int32)
+        elif kind == "date32":
+            data[name] = DATES.as_datetime(values)
+        elif kind == "dict":
+            data[name] = values if isinstance(values, pd.Categorical) else pd.Categorical(values)
+        elif kind == "string":
+            data[name] = pd.array(values, dtype=pd.StringDtype("pyarrow"))
+        else:
+            data[name] = np.asarray(values, dtype=kind)
+    return pd.DataFrame(data)
+
+
+def build_frame(dataset, columns, compact=False):
+    """pd.DataFrame(columns), or the compact_frame of the same column arrays."""
+    return compact_frame(dataset, columns) if compact else pd.DataFrame(columns)
+
+
+# Patient activity: how many lab results and notes each patient gets
+ACTIVITY_MODELS = ["uniform", "lognormal", "zipf"]
+ACTIVITY_CONTRAINDICATION_EFFECT = 0.6  # +60% activity per contraindication
+ACTIVITY_AGE_EFFECT = 0.25  # log-activity change per 12 years of age above/below 58
+
+
+def alias_table(weights):
+    """Walker/Vose alias table for weights: (prob, alias) arrays for O(1) weighted draws.
+
+    Vose's pairing, built with prefix sums instead of a loop: small entries (below the mean, taken
+    from the end) are filled in turn by the current large entry, which turns small once it has given
+    away its excess and is then filled by the next large one. Small entry i goes to the first large
+    entry whose cumulative excess reaches the deficits filled before i.
+    """
+    scaled = np.asarray(weights, dtype=float)
+    n = len(scaled)
+    scaled = scaled * (n / scaled.sum())
+    prob = np.ones(n)
+    alias = np.arange(n, dtype=np.int32 if n < 2**31 else np.int64)
+    small = np.flatnonzero(scaled < 1.0)[::-1]
+    large = np.flatnonzero(scaled >= 1.0)[::-1]
+    if not len(small) or not len(large):
+        return prob, alias
+    deficit = np.cumsum(1.0 - scaled[small])
+    excess = np.cumsum(scaled[large] - 1.0)
+    before = np.concatenate([[0.0], deficit[:-1]])
+    donor = np.searchsorted(excess, before, side="left")
+    filled = donor < len(large)  # leftovers past the last large entry are 1 up to rounding
+    prob[small[filled]] = scaled[small[filled]]
+    alias[small[filled]] = large[donor[filled]]
+    # What each large entry keeps after the small entries it filled; below 1 it is filled by the next one
+    used = np.searchsorted(before, excess[:-1], side="right")
+    residual = 1.0 + excess[:-1] - np.concatenate([[0.0], deficit])[used]
+    switched = residual < 1.0
+    prob[large[:-1][switched]] = residual[switched]
+    alias[large[:-1][switched]] = large[1:][switched]
+    return prob, alias
+
+
+def activity_multiplier(ages, contraindications):
+    """How much more (or less) activity than average a patient's age and contraindications imply."""
+    ages = np.asarray(ages, dtype=float)
+    contraindications = np.asarray(contraindications, dtype=float)
+    return ((1.0 + ACTIVITY_CONTRAINDICATION_EFFECT * contraindications)
+            * np.exp(ACTIVITY_AGE_EFFECT * (ages - 58.0) / 12.0))
+
+
+def activity_weights(ages, contraindications, model="lognormal", skew=1.0, seed=SEED):
+    """Relative lab/note activity per patient.
+
+    A per-patient base weight (lognormal with sigma=skew, or Pareto with rank-size exponent skew,
+    i.e. Zipf's law) is scaled up for patients with more contraindications and for older patients,
+    so chronic cases get many rows. Drawn element-wise from its own seed stream, so the weights
+    of existing patients do not change when patients are appended.
+    """
+    rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(4)[3])  # after patients/labs/notes
+    n = len(ages)
+    if model == "zipf":
+        base = 1.0 + rng.pareto(1.0 / skew, n)
+    else:
+        base = rng.lognormal(0.0, skew, n)
+    return base * activity_multiplier(ages, contraindications)
+
+
+class PatientActivity:
+    """Patient IDs with per-patient activity weights, for skewed (and optionally clustered) draws.
+
+    Stands in for the plain patient ID list or PatientIdRange passed to the lab and note
+    generators. weights=None draws uniformly. With clustered=True each generated chunk is ordered
+    by patient, so a patient's rows sit together instead of being scattered over the file.
+    """
+
+    def __init__(self, patient_ids, weights=None, clustered=False):
+        self.patient_ids = patient_ids
+        self.clustered = clustered
+        self.prob, self.alias = (None, None) if weights is None else alias_table(weights)
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def choice(self):
+        """Index of one patient, drawn from the global random module (python engine)."""
+        i = random.randrange(len(self.patient_ids))
+        if self.prob is None or random.random() < self.prob[i]:
+            return i
+        return int(self.alias[i])
+
+    def sample(self, rng, n):
+        """n patient indices drawn from a numpy Generator, sorted if clustered."""
+        codes = rng.integers(0, len(self.patient_ids), n)
+        if self.prob is not None:
+            codes = np.where(rng.random(n) < self.prob[codes], codes, self.alias[codes])
+        if self.clustered:
+            codes.sort()
+        return codes
+
+
+def choose_patient(patient_ids):
+    """random.choice(patient_ids), weighted when patient_ids is a PatientActivity."""
+    if isinstance(patient_ids, PatientActivity):
+        return patient_ids.patient_ids[patient_ids.choice()]
+    return random.choice(patient_ids)
+
+
+def sample_patient_codes(patient_ids, rng, n):
+    """n uniform (or, for a PatientActivity, activity-weighted) patient indices."""
+    if isinstance(patient_ids, PatientActivity):
+        return patient_ids.sample(rng, n)
+    return rng.integers(0, len(patient_ids), n)
+
+
+def cluster_by_patient(records, patient_ids):
+    """Order python-engine records by patient when patient_ids asks for clustered output."""
+    if isinstance(patient_ids, PatientActivity) and patient_ids.clustered:
+        records.sort(key=lambda record: record["patient_id"])
+
+
+def patient_activity(patient_ids, ages, contraindications, args):
+    """Wrap patient_ids for the --patient-activity / --cluster-patients settings (unchanged if neither is set)."""
+    if args.patient_activity == "uniform" and not args.cluster_patients:
+        return patient_ids
+    weights = None
+    if args.patient_activity != "uniform":
+        weights = activity_weights(ages, contraindications, args.patient_activity, args.activity_skew, args.seed)
+    return PatientActivity(patient_ids, weights, clustered=args.cluster_patients)
 
-    regions = ["Northeast", "Midwest", "Southwest", "Southeast", "West", "Pacific"]
-    genders = ["Female", "Male", "Non-binary"]
-    gender_weights = [0.48, 0.48, 0.04]
-    contact_statuses = ["Active", "Inactive", "Deceased"]
-    contact_weights = [0.85, 0.12, 0.03]
+
+@timed("generate", "patients")
+def generate_patient_demographics(num_patients, engine="python", rng=None, start=0, compact=False):
+    """Generate patient demographics dataset with enrollment_success that correlates with key predictors.
+
+    engine="numpy" draws every column as a whole array (see generate_patient_demographics_numpy),
+    which is the only practical option for multi-million patient cohorts. start offsets the patient
+    IDs so the cohort can be generated in chunks. compact=True (numpy engine) returns a
+    compact_frame for in-process use.
+    """
+    if engine == "numpy":
+        return generate_patient_demographics_numpy(num_patients, rng, start, compact)
+    if compact:
+        raise ValueError("compact=True needs the numpy engine (the python engine builds rows)")
 
     records = []
-    for i in range(num_patients):
+    for i in range(start, start + num_patients):
         patient_id = f"PT-2025-{i:05d}"
 
         # Age distribution: median ~58, range 18-95, concentrated 45-72
@@ -57,10 +671,10 @@ def generate_patient_demographics(num_patients):
 
         # Generate predictors
         site_distance_km = round(random.expovariate(1/25) + 1, 1)  # Most close, some far
-        enrollment_history = random.choices([0, 1, 2, 3, 4], weights=[0.6, 0.25, 0.1, 0.04, 0.01])[0]
+        enrollment_history = random.choices([0, 1, 2, 3, 4], weights=ENROLLMENT_HISTORY_WEIGHTS)[0]
 
         # Contraindication count (will be used for model correlation)
-        contraindication_count = random.choices([0, 1, 2, 3], weights=[0.5, 0.3, 0.15, 0.05])[0]
+        contraindication_count = random.choices([0, 1, 2, 3], weights=CONTRAINDICATION_WEIGHTS)[0]
 
         # Generate enrollment_success with correlation to key predictors:
         # - Higher enrollment_history -> higher success
@@ -78,88 +692,153 @@ def generate_patient_demographics(num_patients):
         records.append({
             "patient_id": patient_id,
             "age": age,
-            "gender": random.choices(genders, weights=gender_weights)[0],
-            "region": random.choice(regions),
+            "gender": random.choices(GENDERS, weights=GENDER_WEIGHTS)[0],
+            "region": random.choice(REGIONS),
             "site_distance_km": site_distance_km,
-            "contact_status": random.choices(contact_statuses, weights=contact_weights)[0],
+            "contact_status": random.choices(CONTACT_STATUSES, weights=CONTACT_WEIGHTS)[0],
             "enrollment_history": enrollment_history,
             "contraindication_count": contraindication_count,
-            "last_visit_date": fake.date_between(start_date="2025-01-01", end_date="2025-12-31").isoformat(),
+            "last_visit_date": DATES.sample(),
             "enrollment_success": enrollment_success
         })
 
-    return pd.DataFrame(records)
+    with METRICS.stage("build_dataframe", "patients", len(records)):
+        return pd.DataFrame(records)
+
+
+def generate_patient_demographics_numpy(num_patients, rng=None, start=0, compact=False):
+    """Columnar version of generate_patient_demographics.
+
+    Draws each column as a NumPy array from a seeded Generator instead of building per-row dicts.
+    Marginal distributions and the enrollment_success correlations match the python engine, but the
+    individual rows differ since the random streams are different.
+    """
+    if rng is None:
+        rng = np.random.default_rng(SEED)
+    n = num_patients
+
+    # Age distribution: median ~58, range 18-95 (astype truncates toward zero like int())
+    age = np.clip(rng.normal(58, 12, n).astype(np.int64), 18, 95)
+
+    site_distance_km = np.round(rng.exponential(25, n) + 1, 1)
+    enrollment_history = rng.choice(5, n, p=ENROLLMENT_HISTORY_WEIGHTS)
+    contraindication_count = rng.choice(4, n, p=CONTRAINDICATION_WEIGHTS)
+
+    # Same enrollment_success model as the python engine, as array arithmetic
+    distance_effect = np.where(site_distance_km < 20, 1.0, np.where(site_distance_km < 40, -0.1, -0.2))
+    prob_adjustment = enrollment_history * 0.15 + distance_effect - 0.15 * contraindication_count
+    success_prob = np.clip(0.5 + prob_adjustment, 0.1, 0.95)
+    enrollment_success = (rng.random(n) < success_prob).astype(np.int64)
+
+    gender = rng.choice(len(GENDERS), n, p=GENDER_WEIGHTS)
+    region = rng.integers(0, len(REGIONS), n)
+    contact_status = rng.choice(len(CONTACT_STATUSES), n, p=CONTACT_WEIGHTS)
+    last_visit_date = DATES.sample_array(rng, n)
+
+    with METRICS.stage("build_dataframe", "patients", n):
+        numbers = np.arange(start, start + n)
+        return build_frame("patients", {
+            "patient_id": numbers if compact else format_patient_ids(numbers),
+            "age": age,
+            "gender": pd.Categorical.from_codes(gender, GENDERS),
+            "region": pd.Categorical.from_codes(region, REGIONS),
+            "site_distance_km": site_distance_km,
+            "contact_status": pd.Categorical.from_codes(contact_status, CONTACT_STATUSES),
+            "enrollment_history": enrollment_history,
+            "contraindication_count": contraindication_count,
+            "last_visit_date": last_visit_date,
+            "enrollment_success": enrollment_success,
+        }, compact)
 
 
 # ============================================
 # Dataset 2: lab_results_2025
 # ============================================
-def generate_lab_results(num_results, patient_ids):
+# Test definitions: (test_type, test_name, unit, ref_low, ref_high, typical_mean, typical_std)
+LAB_TESTS = [
+    # CBC Panel
+    ("CBC", "White Blood Cell Count", "K/uL", 4.5, 11.0, 7.5, 2.0),
+    ("CBC", "Red Blood Cell Count", "M/uL", 4.0, 5.5, 4.7, 0.5),
+    ("CBC", "Hemoglobin", "g/dL", 12.0, 17.0, 14.0, 1.5),
+    ("CBC", "Hematocrit", "%", 36.0, 50.0, 42.0, 4.0),
+    ("CBC", "Platelet Count", "K/uL", 150.0, 400.0, 250.0, 50.0),
+
+    # CMP Panel
+    ("CMP", "Glucose", "mg/dL", 70.0, 100.0, 95.0, 20.0),
+    ("CMP", "Creatinine", "mg/dL", 0.7, 1.3, 1.0, 0.3),
+    ("CMP", "BUN", "mg/dL", 7.0, 20.0, 14.0, 4.0),
+    ("CMP", "Sodium", "mEq/L", 136.0, 145.0, 140.0, 3.0),
+    ("CMP", "Potassium", "mEq/L", 3.5, 5.0, 4.2, 0.4),
+    ("CMP", "ALT", "U/L", 7.0, 56.0, 25.0, 15.0),
+    ("CMP", "AST", "U/L", 10.0, 40.0, 22.0, 10.0),
+
+    # Lipid Panel
+    ("Lipid Panel", "Total Cholesterol", "mg/dL", 0.0, 200.0, 195.0, 40.0),
+    ("Lipid Panel", "LDL Cholesterol", "mg/dL", 0.0, 100.0, 115.0, 35.0),
+    ("Lipid Panel", "HDL Cholesterol", "mg/dL", 40.0, 60.0, 50.0, 12.0),
+    ("Lipid Panel", "Triglycerides", "mg/dL", 0.0, 150.0, 140.0, 60.0),
+
+    # HbA1c
+    ("HbA1c", "Hemoglobin A1c", "%", 4.0, 5.6, 5.8, 1.2),
+
+    # Thyroid
+    ("Thyroid Panel", "TSH", "mIU/L", 0.4, 4.0, 2.0, 1.2),
+    ("Thyroid Panel", "Free T4", "ng/dL", 0.8, 1.8, 1.2, 0.3),
+]
+
+# Plant obvious data entry errors for Sarah to fix during demo
+# These are clearly wrong values that stand out
+OBVIOUS_ERRORS = [
+    # Creatinine of 150 when normal is 0.7-1.3 (likely meant 1.50)
+    {"test_type": "CMP", "test_name": "Creatinine", "result_value": 150.0, "result_unit": "mg/dL",
+     "reference_low": 0.7, "reference_high": 1.3, "flag": "Critical"},
+    # Hemoglobin of 140 when normal is 12-17 (likely meant 14.0)
+    {"test_type": "CBC", "test_name": "Hemoglobin", "result_value": 140.0, "result_unit": "g/dL",
+     "reference_low": 12.0, "reference_high": 17.0, "flag": "Critical"},
+    # Glucose of 9500 when normal is 70-100 (likely meant 95)
+    {"test_type": "CMP", "test_name": "Glucose", "result_value": 9500.0, "result_unit": "mg/dL",
+     "reference_low": 70.0, "reference_high": 100.0, "flag": "Critical"},
+]
+
+LAB_FLAGS = ["Normal", "Low", "High", "Critical"]
+
+
+def planted_errors(labs):
+    """The rows of a lab results frame that carry one of the OBVIOUS_ERRORS (its test name and value)."""
+    candidates = labs[labs["result_value"].isin([error["result_value"] for error in OBVIOUS_ERRORS])]
+    errors = {(error["test_name"], error["result_value"]) for error in OBVIOUS_ERRORS}
+    keys = zip(candidates["test_name"], candidates["result_value"])
+    return candidates[np.fromiter((key in errors for key in keys), dtype=bool, count=len(candidates))]
+
+
+@timed("generate", "labs")
+def generate_lab_results(num_results, patient_ids, engine="python", rng=None, errors=OBVIOUS_ERRORS, compact=False):
     """Generate lab results dataset with realistic medical test data.
 
     Includes 2-3 obvious data entry errors that Sarah can fix manually during the demo.
+    engine="numpy" uses the columnar generate_lab_results_numpy instead of the per-row loop.
+    errors selects which of the planted errors go into this call (chunked runs spread them out).
+    compact=True (numpy engine) returns a compact_frame for in-process use.
     """
-
-    # Test definitions: (test_type, test_name, unit, ref_low, ref_high, typical_mean, typical_std)
-    tests = [
-        # CBC Panel
-        ("CBC", "White Blood Cell Count", "K/uL", 4.5, 11.0, 7.5, 2.0),
-        ("CBC", "Red Blood Cell Count", "M/uL", 4.0, 5.5, 4.7, 0.5),
-        ("CBC", "Hemoglobin", "g/dL", 12.0, 17.0, 14.0, 1.5),
-        ("CBC", "Hematocrit", "%", 36.0, 50.0, 42.0, 4.0),
-        ("CBC", "Platelet Count", "K/uL", 150.0, 400.0, 250.0, 50.0),
-
-        # CMP Panel
-        ("CMP", "Glucose", "mg/dL", 70.0, 100.0, 95.0, 20.0),
-        ("CMP", "Creatinine", "mg/dL", 0.7, 1.3, 1.0, 0.3),
-        ("CMP", "BUN", "mg/dL", 7.0, 20.0, 14.0, 4.0),
-        ("CMP", "Sodium", "mEq/L", 136.0, 145.0, 140.0, 3.0),
-        ("CMP", "Potassium", "mEq/L", 3.5, 5.0, 4.2, 0.4),
-        ("CMP", "ALT", "U/L", 7.0, 56.0, 25.0, 15.0),
-        ("CMP", "AST", "U/L", 10.0, 40.0, 22.0, 10.0),
-
-        # Lipid Panel
-        ("Lipid Panel", "Total Cholesterol", "mg/dL", 0.0, 200.0, 195.0, 40.0),
-        ("Lipid Panel", "LDL Cholesterol", "mg/dL", 0.0, 100.0, 115.0, 35.0),
-        ("Lipid Panel", "HDL Cholesterol", "mg/dL", 40.0, 60.0, 50.0, 12.0),
-        ("Lipid Panel", "Triglycerides", "mg/dL", 0.0, 150.0, 140.0, 60.0),
-
-        # HbA1c
-        ("HbA1c", "Hemoglobin A1c", "%", 4.0, 5.6, 5.8, 1.2),
-
-        # Thyroid
-        ("Thyroid Panel", "TSH", "mIU/L", 0.4, 4.0, 2.0, 1.2),
-        ("Thyroid Panel", "Free T4", "ng/dL", 0.8, 1.8, 1.2, 0.3),
-    ]
+    if engine == "numpy":
+        return generate_lab_results_numpy(num_results, patient_ids, rng, errors, compact=compact)
+    if compact:
+        raise ValueError("compact=True needs the numpy engine (the python engine builds rows)")
 
     records = []
 
-    # Plant obvious data entry errors for Sarah to fix during demo
-    # These are clearly wrong values that stand out
-    obvious_errors = [
-        # Creatinine of 150 when normal is 0.7-1.3 (likely meant 1.50)
-        {"test_type": "CMP", "test_name": "Creatinine", "result_value": 150.0, "result_unit": "mg/dL",
-         "reference_low": 0.7, "reference_high": 1.3, "flag": "Critical"},
-        # Hemoglobin of 140 when normal is 12-17 (likely meant 14.0)
-        {"test_type": "CBC", "test_name": "Hemoglobin", "result_value": 140.0, "result_unit": "g/dL",
-         "reference_low": 12.0, "reference_high": 17.0, "flag": "Critical"},
-        # Glucose of 9500 when normal is 70-100 (likely meant 95)
-        {"test_type": "CMP", "test_name": "Glucose", "result_value": 9500.0, "result_unit": "mg/dL",
-         "reference_low": 70.0, "reference_high": 100.0, "flag": "Critical"},
-    ]
-
     # Add the obvious errors first
-    for error in obvious_errors:
+    for error in errors:
         records.append({
-            "patient_id": random.choice(patient_ids),
-            "test_date": fake.date_between(start_date="2025-01-01", end_date="2025-12-31").isoformat(),
+            "patient_id": choose_patient(patient_ids),
+            "test_date": DATES.sample(),
             **error
         })
 
     # Generate the rest of the records
-    for _ in range(num_results - len(obvious_errors)):
-        patient_id = random.choice(patient_ids)
-        test = random.choice(tests)
+    for _ in range(num_results - len(errors)):
+        patient_id = choose_patient(patient_ids)
+        test = random.choice(LAB_TESTS)
         test_type, test_name, unit, ref_low, ref_high, mean, std = test
 
         # Generate result value - mostly normal, some abnormal
@@ -183,7 +862,7 @@ def generate_lab_results(num_results, patient_ids):
 
         records.append({
             "patient_id": patient_id,
-            "test_date": fake.date_between(start_date="2025-01-01", end_date="2025-12-31").isoformat(),
+            "test_date": DATES.sample(),
             "test_type": test_type,
             "test_name": test_name,
             "result_value": result_value,
@@ -195,7 +874,72 @@ def generate_lab_results(num_results, patient_ids):
 
     # Shuffle so errors aren't at the top
     random.shuffle(records)
-    return pd.DataFrame(records)
+    cluster_by_patient(records, patient_ids)
+    with METRICS.stage("build_dataframe", "labs", len(records)):
+        return pd.DataFrame(records)
+
+
+def generate_lab_results_numpy(num_results, patient_ids, rng=None, errors=OBVIOUS_ERRORS, patient_codes=None,
+                               abnormal_prob=0.15, compact=False):
+    """Columnar version of generate_lab_results.
+
+    Test rows are picked as one index array into LAB_TESTS and their attributes gathered by fancy
+    indexing. The obvious errors overwrite random positions, so no shuffle is needed. patient_codes
+    fixes the patient of each row instead of drawing it, and abnormal_prob may be a per-row array.
+    """
+    if rng is None:
+        rng = np.random.default_rng(SEED)
+    n = num_results
+
+    test_types, test_names, units, ref_lows, ref_highs, means, stds = (np.array(col) for col in zip(*LAB_TESTS))
+    test_idx = rng.integers(0, len(LAB_TESTS), n)
+
+    # Plant the obvious errors at random positions
+    errors = errors[:n]
+    error_pos = rng.choice(n, len(errors), replace=False)
+    test_idx[error_pos] = [test_names.tolist().index(e["test_name"]) for e in errors]
+
+    ref_low, ref_high, mean, std = ref_lows[test_idx], ref_highs[test_idx], means[test_idx], stds[test_idx]
+
+    # Mostly normal, 15% abnormal split evenly between low and high
+    abnormal = rng.random(n) < abnormal_prob
+    low = abnormal & (rng.random(n) < 0.5)
+    high = abnormal & ~low
+    result_value = np.empty(n)
+    result_value[~abnormal] = rng.normal(mean[~abnormal], std[~abnormal] * 0.5)
+    result_value[low] = ref_low[low] - np.abs(rng.normal(0, std[low]))
+    result_value[high] = ref_high[high] + np.abs(rng.normal(0, std[high]))
+    result_value = np.round(np.maximum(result_value, 0), 1)
+    result_value[error_pos] = [e["result_value"] for e in errors]
+
+    flag = np.select(
+        [
+            result_value < ref_low * 0.7,
+            result_value < ref_low,
+            result_value > ref_high * 1.3,
+            result_value > ref_high,
+        ],
+        [LAB_FLAGS.index("Critical"), LAB_FLAGS.index("Low"), LAB_FLAGS.index("Critical"), LAB_FLAGS.index("High")],
+        default=LAB_FLAGS.index("Normal"),
+    )
+
+    test_date = DATES.sample_array(rng, n)
+    if patient_codes is None:
+        patient_codes = sample_patient_codes(patient_ids, rng, n)
+
+    with METRICS.stage("build_dataframe", "labs", n):
+        return build_frame("labs", {
+            "patient_id": patient_index(patient_ids, patient_codes) if compact else take_patient_ids(patient_ids,
+                                                                                                     patient_codes),
+            "test_date": test_date,
+            "test_type": gather_categorical(test_types, test_idx),
+            "test_name": gather_categorical(test_names, test_idx),
+            "result_value": result_value,
+            "result_unit": gather_categorical(units, test_idx),
+            "reference_low": ref_low,
+            "reference_high": ref_high,
+            "flag": pd.Categorical.from_codes(flag, LAB_FLAGS),
+        }, compact)
 
 
 # ============================================
@@ -223,446 +967,3261 @@ EXAMPLE_NOTES = [
 ]
 
 
-def expand_notes_with_variations(base_notes_df, target_count, patient_ids):
-    """Expand a smaller set of Claude-generated notes to a larger dataset using variations.
+# Substitution mappings used by expand_notes_with_variations
+MED_SUBSTITUTIONS = {
+    "lisinopril": ["losartan", "enalapril", "ramipril", "benazepril"],
+    "amlodipine": ["nifedipine", "diltiazem", "verapamil", "felodipine"],
+    "metoprolol": ["atenolol", "carvedilol", "bisoprolol", "propranolol"],
+    "metformin": ["glipizide", "glyburide", "sitagliptin", "pioglitazone"],
+    "atorvastatin": ["rosuvastatin", "simvastatin", "pravastatin", "lovastatin"],
+    "furosemide": ["bumetanide", "torsemide", "hydrochlorothiazide", "spironolactone"],
+    "sertraline": ["fluoxetine", "paroxetine", "escitalopram", "citalopram"],
+    "omeprazole": ["pantoprazole", "esomeprazole", "lansoprazole", "rabeprazole"],
+    "gabapentin": ["pregabalin", "duloxetine", "amitriptyline", "nortriptyline"],
+    "warfarin": ["apixaban", "rivaroxaban", "dabigatran", "edoxaban"],
+}
 
-    Variations include:
-    - Different patient_id, note_date, provider_id
-    - Medication/dosage substitutions
-    - Age/number substitutions
-    - Typo variations
-    """
-    import re
-
-    # Substitution mappings
-    med_substitutions = {
-        "lisinopril": ["losartan", "enalapril", "ramipril", "benazepril"],
-        "amlodipine": ["nifedipine", "diltiazem", "verapamil", "felodipine"],
-        "metoprolol": ["atenolol", "carvedilol", "bisoprolol", "propranolol"],
-        "metformin": ["glipizide", "glyburide", "sitagliptin", "pioglitazone"],
-        "atorvastatin": ["rosuvastatin", "simvastatin", "pravastatin", "lovastatin"],
-        "furosemide": ["bumetanide", "torsemide", "hydrochlorothiazide", "spironolactone"],
-        "sertraline": ["fluoxetine", "paroxetine", "escitalopram", "citalopram"],
-        "omeprazole": ["pantoprazole", "esomeprazole", "lansoprazole", "rabeprazole"],
-        "gabapentin": ["pregabalin", "duloxetine", "amitriptyline", "nortriptyline"],
-        "warfarin": ["apixaban", "rivaroxaban", "dabigatran", "edoxaban"],
-    }
+DOSAGE_SUBSTITUTIONS = {
+    "5mg": ["2.5mg", "10mg", "7.5mg"],
+    "10mg": ["5mg", "20mg", "15mg"],
+    "20mg": ["10mg", "40mg", "25mg"],
+    "25mg": ["12.5mg", "50mg", "37.5mg"],
+    "50mg": ["25mg", "100mg", "75mg"],
+    "100mg": ["50mg", "200mg", "150mg"],
+    "500mg": ["250mg", "750mg", "1000mg"],
+    "1000mg": ["500mg", "850mg", "1500mg"],
+}
 
-    dosage_substitutions = {
-        "5mg": ["2.5mg", "10mg", "7.5mg"],
-        "10mg": ["5mg", "20mg", "15mg"],
-        "20mg": ["10mg", "40mg", "25mg"],
-        "25mg": ["12.5mg", "50mg", "37.5mg"],
-        "50mg": ["25mg", "100mg", "75mg"],
-        "100mg": ["50mg", "200mg", "150mg"],
-        "500mg": ["250mg", "750mg", "1000mg"],
-        "1000mg": ["500mg", "850mg", "1500mg"],
-    }
+# Typo additions/variations
+TYPO_PAIRS = [
+    ("patient", "patietn"), ("previous", "previus"), ("symptoms", "symtpoms"),
+    ("eligible", "eligibile"), ("recommend", "reccomend"), ("follow up", "followup"),
+    ("allergies", "allergeis"), ("treatment", "treatement"), ("received", "recieved"),
+    ("occurred", "occured"), ("assessment", "assesment"), ("necessary", "neccessary"),
+]
 
-    # Typo additions/variations
-    typo_pairs = [
-        ("patient", "patietn"), ("previous", "previus"), ("symptoms", "symtpoms"),
-        ("eligible", "eligibile"), ("recommend", "reccomend"), ("follow up", "followup"),
-        ("allergies", "allergeis"), ("treatment", "treatement"), ("received", "recieved"),
-        ("occurred", "occured"), ("assessment", "assesment"), ("necessary", "neccessary"),
-    ]
+PROVIDER_IDS = [f"DR-{i:04d}" for i in range(50)]
 
-    provider_ids = [f"DR-{i:04d}" for i in range(50)]
+NOTE_TYPES = ["Progress Note", "Consultation", "Discharge Summary", "Follow-up", "Initial Assessment"]
 
-    records = []
-    base_notes = base_notes_df.to_dict('records')
-    notes_per_base = (target_count // len(base_notes)) + 1
 
-    for base_note in base_notes:
-        # Create variations of this note
-        for var_num in range(notes_per_base):
-            if len(records) >= target_count:
-                break
+# Every substitution site, compiled once: medication names, dosages, ages ("65 yo") and percentages
+SUBSTITUTION_PATTERN = re.compile(
+    "|".join([
+        "(?P<med>" + "|".join(re.escape(med) for med in MED_SUBSTITUTIONS) + ")",
+        r"(?<![\d.])(?P<dose>" + "|".join(sorted(map(re.escape, DOSAGE_SUBSTITUTIONS), key=len, reverse=True)) + r")\b",
+        r"\b(?P<age>\d{2})\s*(?P<age_unit>yo|year old|y\.o\.|y/o)",
+        r"\b(?P<percent>\d{2})%",
+    ]),
+    re.IGNORECASE,
+)
+TYPO_PATTERNS = [
+    (re.compile(re.escape(correct), re.IGNORECASE), re.compile(re.escape(typo), re.IGNORECASE))
+    for correct, typo in TYPO_PAIRS
+]
 
-            note_text = base_note["note_text"]
-
-            # Apply medication substitutions (30% chance per med)
-            for orig_med, alternatives in med_substitutions.items():
-                if orig_med.lower() in note_text.lower() and random.random() < 0.3:
-                    pattern = re.compile(re.escape(orig_med), re.IGNORECASE)
-                    note_text = pattern.sub(random.choice(alternatives), note_text)
-
-            # Apply dosage substitutions (40% chance)
-            for orig_dose, alternatives in dosage_substitutions.items():
-                if orig_dose in note_text and random.random() < 0.4:
-                    note_text = note_text.replace(orig_dose, random.choice(alternatives))
-
-            # Substitute ages (find patterns like "65 yo" or "65 year old")
-            age_pattern = r'\b(\d{2})\s*(yo|year old|y\.o\.|y/o)'
-            def replace_age(match):
-                new_age = int(match.group(1)) + random.randint(-10, 10)
-                new_age = max(25, min(90, new_age))
-                return f"{new_age} {match.group(2)}"
-            if random.random() < 0.5:
-                note_text = re.sub(age_pattern, replace_age, note_text, flags=re.IGNORECASE)
-
-            # Substitute percentages (EF values, etc.)
-            def replace_percent(match):
-                val = int(match.group(1))
-                new_val = val + random.randint(-5, 5)
-                new_val = max(15, min(70, new_val))
-                return f"{new_val}%"
-            if random.random() < 0.4:
-                note_text = re.sub(r'\b(\d{2})%', replace_percent, note_text)
-
-            # Add or fix typos (20% chance)
-            if random.random() < 0.2:
-                correct, typo = random.choice(typo_pairs)
-                if random.random() < 0.5 and correct in note_text.lower():
-                    # Add typo
-                    pattern = re.compile(re.escape(correct), re.IGNORECASE)
-                    note_text = pattern.sub(typo, note_text, count=1)
-                elif typo in note_text.lower():
-                    # Fix typo (make some notes cleaner)
-                    pattern = re.compile(re.escape(typo), re.IGNORECASE)
-                    note_text = pattern.sub(correct, note_text, count=1)
 
-            records.append({
-                "patient_id": random.choice(patient_ids),
-                "note_date": fake.date_between(start_date="2025-01-01", end_date="2025-12-31").isoformat(),
-                "provider_id": random.choice(provider_ids),
-                "note_type": base_note["note_type"],
-                "note_text": note_text
-            })
+class NoteVariator:
+    """Produces random variations of a fixed set of base notes.
 
-    # Shuffle to mix up the variations
-    random.shuffle(records)
-    return pd.DataFrame(records[:target_count])
+    Each base note is scanned once into literal segments and the substitution sites between them
+    (plus the first occurrence of each typo pair), so building a variant is a single join over the
+    sites that note actually contains - no regex work per variant.
+    """
 
+    def __init__(self, base_texts):
+        self._notes = [self._index(text) for text in base_texts]
 
-def generate_clinical_notes_with_claude(num_notes, patient_df, batch_size=20, max_concurrent=10):
-    """Generate clinical notes using Claude API for realistic, contextual notes.
+    @staticmethod
+    def _index(text):
+        sites = []
+        for match in SUBSTITUTION_PATTERN.finditer(text):
+            kind = match.lastgroup if match.lastgroup != "age_unit" else "age"
+            if kind == "med":
+                sites.append((match.start(), match.end(), "med", match.group("med").lower()))
+            elif kind == "dose":
+                sites.append((match.start(), match.end(), "dose", match.group("dose").lower()))
+            elif kind == "age":
+                sites.append((match.start(), match.end(), "age", (int(match.group("age")), match.group("age_unit"))))
+            else:
+                sites.append((match.start(), match.end(), "percent", int(match.group("percent"))))
 
-    Uses concurrent API calls for much faster generation.
+        for pair, (correct_pattern, typo_pattern) in enumerate(TYPO_PATTERNS):
+            for kind, pattern in (("add_typo", correct_pattern), ("fix_typo", typo_pattern)):
+                match = pattern.search(text)
+                if match and not any(start < match.end() and match.start() < end for start, end, _, _ in sites):
+                    sites.append((match.start(), match.end(), kind, pair))
+        sites.sort()
 
-    Args:
-        num_notes: Number of notes to generate
-        patient_df: DataFrame with patient demographics for context
-        batch_size: Number of notes to generate per API call (default: 20)
-        max_concurrent: Maximum concurrent API calls (default: 10)
-    """
-    import asyncio
-    try:
-        import anthropic
-    except ImportError:
-        print("ERROR: anthropic package not installed. Run: pip install anthropic")
-        return None
+        segments, pos = [], 0
+        for start, end, _, _ in sites:
+            segments.append(text[pos:start])
+            segments.append(text[start:end])
+            pos = end
+        segments.append(text[pos:])
 
-    api_key = os.environ.get("ANTHROPIC_API_KEY")
-    if not api_key:
-        print("ERROR: ANTHROPIC_API_KEY environment variable not set")
-        return None
+        present = {kind: {key for _, _, k, key in sites if k == kind} for kind in ("med", "dose", "add_typo", "fix_typo")}
+        return {
+            "segments": segments,
+            "sites": [(kind, key) for _, _, kind, key in sites],
+            "meds": sorted(present["med"]),
+            "doses": sorted(present["dose"]),
+            "has_age": any(kind == "age" for _, _, kind, _ in sites),
+            "has_percent": any(kind == "percent" for _, _, kind, _ in sites),
+            "typo_sites": present["add_typo"],
+            "fixable_typos": present["fix_typo"],
+        }
 
-    note_types = ["Progress Note", "Consultation", "Discharge Summary", "Follow-up", "Initial Assessment"]
-    provider_ids = [f"DR-{i:04d}" for i in range(50)]
+    def vary(self, index):
+        """Return a random variation of base note number index."""
+        note = self._notes[index]
 
-    # Build few-shot examples
-    examples_text = "\n\n".join([
-        f"Note Type: {ex['note_type']}\nNote: {ex['note_text']}"
-        for ex in EXAMPLE_NOTES
-    ])
+        # Medication substitutions (30% chance per med) and dosage substitutions (40% chance per dose)
+        meds = {med: random.choice(MED_SUBSTITUTIONS[med]) for med in note["meds"] if random.random() < 0.3}
+        doses = {dose: random.choice(DOSAGE_SUBSTITUTIONS[dose]) for dose in note["doses"] if random.random() < 0.4}
+        vary_age = note["has_age"] and random.random() < 0.5
+        vary_percent = note["has_percent"] and random.random() < 0.4
 
-    system_prompt = f"""You are generating realistic clinical notes for a healthcare demo.
-The notes should:
-1. Be messy and realistic - include typos, abbreviations (w/, hx, d/t, BID, s/p, etc.), inconsistent formatting
-2. Reference clinical trials, contraindications, prior treatments when relevant
-3. Match the note_type (Progress Note, Consultation, Discharge Summary, Follow-up, Initial Assessment)
-4. Be appropriate for the patient's age and any context provided
-5. Vary in length and style - some brief, some detailed
+        # Add or fix one typo (20% chance)
+        add_typo = fix_typo = None
+        if random.random() < 0.2:
+            pair = random.randrange(len(TYPO_PAIRS))
+            if random.random() < 0.5 and pair in note["typo_sites"]:
+                add_typo = pair
+            elif pair in note["fixable_typos"]:
+                fix_typo = pair
 
-Example notes showing the desired style:
+        if not (meds or doses or vary_age or vary_percent or add_typo is not None or fix_typo is not None):
+            return "".join(note["segments"])
 
-{examples_text}
+        out = list(note["segments"])
+        for i, (kind, key) in enumerate(note["sites"]):
+            slot = 2 * i + 1
+            if kind == "med" and key in meds:
+                out[slot] = meds[key]
+            elif kind == "dose" and key in doses:
+                out[slot] = doses[key]
+            elif kind == "age" and vary_age:
+                age, unit = key
+                out[slot] = f"{max(25, min(90, age + random.randint(-10, 10)))} {unit}"
+            elif kind == "percent" and vary_percent:
+                out[slot] = f"{max(15, min(70, key + random.randint(-5, 5)))}%"
+            elif kind == "add_typo" and key == add_typo:
+                out[slot] = TYPO_PAIRS[key][1]
+            elif kind == "fix_typo" and key == fix_typo:
+                out[slot] = TYPO_PAIRS[key][0]
+        return "".join(out)
 
-Generate notes that look like they were quickly typed by busy physicians."""
 
-    # Prepare all batches upfront
-    all_batches = []
-    total_notes = 0
-    while total_notes < num_notes:
-        batch_records = []
-        contexts = []
-        current_batch_size = min(batch_size, num_notes - total_notes)
-
-        for _ in range(current_batch_size):
-            patient = patient_df.sample(1).iloc[0]
-            note_type = random.choice(note_types)
-            note_date = fake.date_between(start_date="2025-01-01", end_date="2025-12-31").isoformat()
-            provider_id = random.choice(provider_ids)
-
-            context = {
-                "patient_id": patient["patient_id"],
-                "age": patient["age"],
-                "gender": patient["gender"],
-                "region": patient["region"],
-                "enrollment_history": patient["enrollment_history"],
-                "contraindication_count": patient["contraindication_count"],
-                "note_type": note_type,
-                "note_date": note_date,
-                "provider_id": provider_id
-            }
-            contexts.append(context)
-            batch_records.append({
-                "patient_id": patient["patient_id"],
-                "note_date": note_date,
-                "provider_id": provider_id,
-                "note_type": note_type,
-            })
+# ============================================
+# Near-duplicate detection (MinHash + LSH)
+# ============================================
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 8  # 8 bands of 8 values: pairs above ~0.77 Jaccard almost always share a bucket
+SHINGLE_WORDS = 3
+DEDUP_RETRIES = 3  # re-rolls before a near-duplicate variant is kept anyway
 
-        # Build prompt for batch
-        prompt = "Generate clinical notes for the following patients. Return ONLY the note text for each, separated by '---'.\n\n"
-        for i, ctx in enumerate(contexts, 1):
-            prompt += f"{i}. {ctx['age']} year old {ctx['gender']}, Note Type: {ctx['note_type']}"
-            if ctx['enrollment_history'] > 0:
-                prompt += f", Prior trial enrollments: {ctx['enrollment_history']}"
-            if ctx['contraindication_count'] > 0:
-                prompt += f", Has {ctx['contraindication_count']} contraindication(s)"
-            prompt += "\n"
 
-        all_batches.append((batch_records, prompt))
-        total_notes += current_batch_size
+def note_shingles(text, size=SHINGLE_WORDS):
+    """crc32 hashes of the distinct word size-grams of text (the whole text if it is shorter)."""
+    words = text.split()
+    grams = {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+    return np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
 
-    num_batches = len(all_batches)
-    print(f"   Generating {num_notes} notes in {num_batches} batches ({max_concurrent} concurrent)...")
 
-    # Async function to process a single batch
-    async def process_batch(client, batch_idx, batch_records, prompt):
-        try:
-            response = await asyncio.to_thread(
-                client.messages.create,
-                model="claude-sonnet-4-20250514",
-                max_tokens=8000,
-                system=system_prompt,
-                messages=[{"role": "user", "content": prompt}]
-            )
-
-            notes = response.content[0].text.split("---")
-            notes = [n.strip() for n in notes if n.strip()]
-
-            for i, record in enumerate(batch_records):
-                if i < len(notes):
-                    record["note_text"] = notes[i]
-                else:
-                    record["note_text"] = "Note not available."
+class NoteDeduplicator:
+    """Incremental MinHash + LSH index that keeps expanded notes from repeating each other.
 
-            return batch_records
-        except Exception as e:
-            print(f"   Warning: API error in batch {batch_idx + 1}: {e}")
-            for record in batch_records:
-                record["note_text"] = "Note generation failed."
-            return batch_records
+    Each note's signature is the minimum of MINHASH_PERMUTATIONS multiply-shift hashes over its
+    word 3-grams. Signatures are cut into LSH_BANDS bands, and notes sharing a band's bucket are
+    candidates, accepted as near-duplicates when the fraction of equal signature values (an
+    estimate of their Jaccard similarity) reaches threshold. A lookup only reads the note's own
+    buckets, so the cost per note stays roughly flat as the index grows.
 
-    # Process batches with concurrency limit
-    async def process_all_batches():
-        client = anthropic.Anthropic(api_key=api_key)
-        semaphore = asyncio.Semaphore(max_concurrent)
-        completed = [0]
-
-        async def bounded_process(batch_idx, batch_records, prompt):
-            async with semaphore:
-                result = await process_batch(client, batch_idx, batch_records, prompt)
-                completed[0] += 1
-                if completed[0] % 10 == 0 or completed[0] == num_batches:
-                    notes_done = min(completed[0] * batch_size, num_notes)
-                    print(f"   Progress: {notes_done}/{num_notes} notes generated")
-                return result
-
-        tasks = [
-            bounded_process(i, batch_records, prompt)
-            for i, (batch_records, prompt) in enumerate(all_batches)
-        ]
-        results = await asyncio.gather(*tasks)
-        return results
+    Only distinct notes are indexed; a near-duplicate that survives the re-rolls joins the cluster
+    of the note it matched. Each process (shard) keeps its own index.
+    """
 
-    # Run async processing
-    all_results = asyncio.run(process_all_batches())
+    def __init__(self, threshold, retries=DEDUP_RETRIES, seed=SEED):
+        rng = np.random.default_rng(seed)
+        self.multipliers = rng.integers(1, 2**63, MINHASH_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+        self.offsets = rng.integers(0, 2**63, MINHASH_PERMUTATIONS, dtype=np.uint64)
+        self.threshold = threshold
+        self.retries = retries
+        self.band_rows = MINHASH_PERMUTATIONS // LSH_BANDS
+        self.buckets = [{} for _ in range(LSH_BANDS)]
+        self.signatures = np.empty((1024, MINHASH_PERMUTATIONS), dtype=np.uint32)
+        self.cluster_sizes = []  # per indexed note: itself plus the near-duplicates kept against it
+        self.base_notes = collections.Counter()  # notes generated per base note
+        self.base_distinct = collections.Counter()  # of which indexed as distinct
+        self.notes = 0
+        self.rerolls = 0
+        self.duplicates = 0
 
-    # Flatten results
-    records = []
-    for batch_result in all_results:
-        records.extend(batch_result)
-
-    return pd.DataFrame(records)
-
-
-def generate_clinical_notes_template(num_notes, patient_ids):
-    """Generate clinical notes using templates (fast, no API required)."""
-
-    note_types = ["Progress Note", "Consultation", "Discharge Summary", "Follow-up", "Initial Assessment"]
-
-    # Templates with intentional typos and abbreviations
-    note_templates = [
-        # Hypertension notes
-        "Pt presents w/ hx of hypertension, prev tx w/ {med1} discontinued d/t {side_effect}. Currently on {med2}. No known {typo_allergies}. {trial_history}",
-        "{age} yo {gender} w/ HTN, well controlled on current regimen. BP {bp} today. Continue {med1}. {typo_follow} in 3 months.",
-        "Hypertensive urgency - BP {bp_high}. Pt reports medication non-adherance. Restarted {med1}, added {med2}. {typo_eligible} for HYPER-2025 study.",
-
-        # Diabetes notes
-        "{age} yo {gender} w/ Type 2 DM, on {dm_med} {dm_dose} BID. Contraindications: {contraindication}. Prior treatments incl {prior_med} (d/c for {dc_reason}).",
-        "DM follow up. HbA1c {hba1c}%. {typo_patient} tolerating current regimen. Discussed diet modifications. {trial_mention}",
-        "Uncontrolled T2DM despite max dose metformin. Adding {dm_med2}. {typo_eligible} for GLUCOSE-001 trial pending insurance auth.",
-
-        # Oncology notes
-        "Follow up visit. Patient tolerated {typo_previous} chemo well. No new {typo_symptoms}. Labs reviewed - ANC recovered. {typo_eligible2} for continued treatment. Note: pt has {contraindication2} - {typo_contraindication} for {excluded_procedure}.",
-        "Cycle {cycle_num} of {chemo_regimen}. Grade 2 {side_effect2}. Dose reduction discussed. {typo_patient} prefers to continue full dose. Next scan in {weeks} weeks.",
-        "Oncology consult for {cancer_type}. Stage {stage}. Discussed treatment options. {typo_recommend} enrollment in {trial_name} trial. Pt {decision}.",
-
-        # Cardiology notes
-        "Hx: CAD s/p CABG {year}, CHF (EF {ef}%), CKD stage {ckd_stage}. Current meds: {cardiac_meds}. CONTRAINDICATED for nephrotoxic agents. {trial_history2}",
-        "Cardiac clearance for {procedure}. EKG shows {ekg_finding}. Echo {ef2}% EF. {typo_cleared} for procedure. Note: {pacer_note}",
-        "CHF exacerbation - {typo_patient} with {weight_gain} lb weight gain, increased {typo_edema}. Diuretics adjusted. {typo_follow} in 1 week.",
-
-        # General/Other
-        "New patient eval. PMHx: {conditions}. Medications reviewed - no interactions. {typo_patient} interested in clinical trials for {interest_condition}.",
-        "Annual wellness visit. {age} yo {gender} in good health. Vaccines updated. {typo_screening} scheduled. No acute concerns.",
-        "Referral from PCP for {specialty} evaluation. {typo_reviewed} outside records. Assessment: {assessment}. Plan: {plan}",
-    ]
-
-    # Replacement values
-    meds = ["lisinopril 10mg", "amlodipine 5mg", "metoprolol 25mg", "losartan 50mg", "hydrochlorothiazide 12.5mg"]
-    dm_meds = ["metformin 1000mg", "metformin 500mg", "glipizide 5mg", "januvia 100mg"]
-    dm_meds2 = ["trulicity", "ozempic", "jardiance", "farxiga"]
-    side_effects = ["persistent cough", "dizziness", "fatigue", "GI upset", "ankle swelling"]
-    contraindications = ["sulfa allergy", "hx of angioedema", "renal impairment", "liver disease", "pregnancy"]
-    contraindications2 = ["pacemaker", "metal implant", "claustrophobia", "contrast allergy", "bleeding disorder"]
-    chemo_regimens = ["FOLFOX", "FOLFIRI", "carboplatin/paclitaxel", "R-CHOP", "pembrolizumab"]
-    cancer_types = ["NSCLC", "breast cancer", "colorectal cancer", "lymphoma", "melanoma"]
-    cardiac_meds = ["carvedilol, furosemide, atorvastatin", "metoprolol, lisinopril, aspirin", "diltiazem, warfarin, digoxin"]
-    conditions = ["HTN, DM, hyperlipidemia", "COPD, CAD, CKD", "RA, osteoporosis, anxiety", "depression, obesity, sleep apnea"]
+    def signature(self, text):
+        hashes = self.multipliers[:, None] * note_shingles(text)[None, :] + self.offsets[:, None]
+        return (hashes >> np.uint64(32)).min(axis=1).astype(np.uint32)
 
-    # Typo variations
-    typos = {
-        "typo_allergies": ["allergeis", "allergies", "alergies", "allergys"],
-        "typo_follow": ["Follow up", "Followup", "F/u", "Follow-up"],
-        "typo_eligible": ["Eligible", "Eligibile", "Elligible", "eligible"],
-        "typo_eligible2": ["Eligible", "Eligibile", "Elligible", "eligible"],
-        "typo_patient": ["Patient", "Pt", "Patietn", "patient"],
-        "typo_previous": ["previous", "previus", "prior", "prev"],
-        "typo_symptoms": ["symptoms", "symtpoms", "sxs", "symptms"],
-        "typo_contraindication": ["contraindication", "contrindication", "contra-indication", "CI"],
-        "typo_recommend": ["Recommend", "Reccomend", "Recomend", "recommend"],
-        "typo_cleared": ["Cleared", "Cleard", "cleared", "OK'd"],
-        "typo_edema": ["edema", "oedema", "swelling", "edma"],
-        "typo_screening": ["Screening", "Screenings", "screening", "Screeening"],
-        "typo_reviewed": ["Reviewed", "Reviwed", "reviewed", "Rev"],
-    }
+    def _band_keys(self, signature):
+        # A fixed hash rather than hash(), which is salted per process, so buckets match across runs and shards
+        rows = self.band_rows
+        return [int.from_bytes(hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(),
+                                               digest_size=8).digest(), "little")
+                for band in range(LSH_BANDS)]
 
-    trial_histories = [
-        "Prev enrolled in CARD-2022 trial, completed full protocol.",
-        "Previous trial: withdrew from HEART-001 due to transportation issues.",
-        "No prior trial participation.",
-        "Enrolled in 2 previous studies - good compliance.",
-        "Screen failed for ONCO-2023 (abnormal LFTs).",
-        "",
-        ""
-    ]
+    def match(self, signature, keys):
+        """Index of the most similar indexed note if it is at least threshold similar, else None."""
+        candidates = set()
+        for bucket, key in zip(self.buckets, keys):
+            candidates.update(bucket.get(key, ()))
+        if not candidates:
+            return None
+        ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similarity = (self.signatures[ids] == signature).mean(axis=1)
+        best = similarity.argmax()
+        return int(ids[best]) if similarity[best] >= self.threshold else None
 
-    records = []
-    num_providers = 50
-    provider_ids = [f"DR-{i:04d}" for i in range(num_providers)]
+    def add(self, signature, keys):
+        index = len(self.cluster_sizes)
+        if index == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.empty_like(self.signatures)])
+        self.signatures[index] = signature
+        for bucket, key in zip(self.buckets, keys):
+            bucket.setdefault(key, []).append(index)
+        self.cluster_sizes.append(1)
 
-    for _ in range(num_notes):
-        patient_id = random.choice(patient_ids)
-        template = random.choice(note_templates)
-
-        # Fill in template
-        note_text = template.format(
-            med1=random.choice(meds),
-            med2=random.choice(meds),
-            dm_med=random.choice(dm_meds),
-            dm_med2=random.choice(dm_meds2),
-            dm_dose="1000mg" if random.random() > 0.5 else "500mg",
-            side_effect=random.choice(side_effects),
-            side_effect2=random.choice(["nausea", "fatigue", "neuropathy", "mucositis"]),
-            contraindication=random.choice(contraindications),
-            contraindication2=random.choice(contraindications2),
-            excluded_procedure=random.choice(["MRI-based studies", "contrast CT", "certain chemo agents"]),
-            prior_med=random.choice(dm_meds2),
-            dc_reason=random.choice(["hypoglycemia", "insurance denial", "GI intolerance", "cost"]),
-            age=random.randint(35, 85),
-            gender=random.choice(["M", "F"]),
-            bp=f"{random.randint(115, 135)}/{random.randint(70, 85)}",
-            bp_high=f"{random.randint(170, 200)}/{random.randint(100, 120)}",
-            hba1c=round(random.uniform(5.5, 9.5), 1),
-            cycle_num=random.randint(1, 8),
-            chemo_regimen=random.choice(chemo_regimens),
-            cancer_type=random.choice(cancer_types),
-            stage=random.choice(["IIA", "IIB", "IIIA", "IIIB", "IV"]),
-            trial_name=random.choice(["KEYNOTE-999", "ONCOLOGY-2025", "BEACON-3", "IMMUNOBOOST"]),
-            decision=random.choice(["agrees to enrollment", "declines - wants more time", "will discuss with family"]),
-            year=random.randint(2015, 2022),
-            ef=random.randint(25, 55),
-            ef2=random.randint(30, 65),
-            ckd_stage=random.randint(2, 4),
-            cardiac_meds=random.choice(cardiac_meds),
-            procedure=random.choice(["surgery", "colonoscopy", "cardiac cath", "biopsy"]),
-            ekg_finding=random.choice(["NSR", "afib", "LBBB", "normal sinus rhythm"]),
-            pacer_note=random.choice(["no pacemaker", "ICD in place", "pacemaker - MRI conditional"]),
-            weight_gain=random.randint(3, 12),
-            weeks=random.randint(4, 12),
-            conditions=random.choice(conditions),
-            interest_condition=random.choice(["diabetes", "hypertension", "cancer prevention", "arthritis"]),
-            specialty=random.choice(["cardiology", "oncology", "endocrinology", "rheumatology"]),
-            assessment=random.choice(["stable", "improved", "requires intervention", "monitoring"]),
-            plan=random.choice(["continue current management", "start new medication", "order additional testing", "refer to specialist"]),
-            trial_history=random.choice(trial_histories),
-            trial_history2=random.choice(trial_histories),
-            trial_mention=random.choice(["", "Discussed DIABETES-2025 trial.", "May be candidate for research study."]),
-            **{k: random.choice(v) for k, v in typos.items()}
-        )
+    def diversify(self, vary, base_index):
+        """Call vary() until its note has no near-duplicate in the index, at most retries more times.
 
-        records.append({
-            "patient_id": patient_id,
-            "note_date": fake.date_between(start_date="2025-01-01", end_date="2025-12-31").isoformat(),
-            "provider_id": random.choice(provider_ids),
-            "note_type": random.choice(note_types),
-            "note_text": note_text
-        })
+        Returns the first distinct note (which is indexed), or the last attempt if none was.
+        """
+        self.notes += 1
+        self.base_notes[base_index] += 1
+        for attempt in range(self.retries + 1):
+            text = vary()
+            signature = self.signature(text)
+            keys = self._band_keys(signature)
+            match = self.match(signature, keys)
+            if match is None:
+                self.add(signature, keys)
+                self.base_distinct[base_index] += 1
+                return text
+            self.rerolls += attempt < self.retries
+        self.duplicates += 1
+        self.cluster_sizes[match] += 1
+        return text
 
-    return pd.DataFrame(records)
+    def counts(self):
+        """The report as mergeable value counts, alongside write_chunks' counts (see print_note_diversity)."""
+        sizes = pd.Series(self.cluster_sizes, dtype="int64").value_counts()
+        return {
+            "note_diversity": pd.Series({"notes": self.notes, "distinct": len(self.cluster_sizes),
+                                         "near_duplicates": self.duplicates, "rerolls": self.rerolls}, dtype="int64"),
+            "note_clusters": sizes,
+            "base_notes": pd.Series(self.base_notes, dtype="int64"),
+            "base_distinct": pd.Series(self.base_distinct, dtype="int64"),
+        }
 
 
-# ============================================
-# Main
-# ============================================
-def main():
-    parser = argparse.ArgumentParser(description="Generate clinical trial demo datasets")
-    parser.add_argument("--use-claude", action="store_true",
-                        help="Use Claude API for clinical note generation (requires ANTHROPIC_API_KEY)")
-    parser.add_argument("--expand-notes", action="store_true",
-                        help="Generate base notes with Claude then expand using variations (recommended)")
-    parser.add_argument("--base-notes", type=int, default=2000,
-                        help="Number of base notes to generate with Claude when using --expand-notes (default: 2000)")
-    parser.add_argument("--num-notes", type=int, default=NUM_CLINICAL_NOTES,
-                        help=f"Number of clinical notes to generate (default: {NUM_CLINICAL_NOTES})")
-    parser.add_argument("--num-patients", type=int, default=NUM_PATIENTS,
-                        help=f"Number of patients to generate (default: {NUM_PATIENTS})")
-    parser.add_argument("--num-lab-results", type=int, default=NUM_LAB_RESULTS,
-                        help=f"Number of lab results to generate (default: {NUM_LAB_RESULTS})")
-    args = parser.parse_args()
+def note_deduplicator(args):
+    """The --dedup-threshold NoteDeduplicator for expanded notes, or None if it is off."""
+    if not args.dedup_threshold:
+        return None
+    return NoteDeduplicator(args.dedup_threshold, args.dedup_retries, args.seed)
+
+
+def print_note_diversity(counts, threshold):
+    """Print and emit the diversity report that NoteDeduplicator.counts() added to counts (removing it)."""
+    if "note_diversity" not in counts:
+        return
+    stats = counts.pop("note_diversity")
+    clusters = counts.pop("note_clusters").sort_index()
+    base_notes = counts.pop("base_notes")
+    distinct = counts.pop("base_distinct").reindex(base_notes.index, fill_value=0)
+    print(f"   Diversity: {stats['near_duplicates']:,} of {stats['notes']:,} notes "
+          f"({stats['near_duplicates'] / max(stats['notes'], 1):.2%}) kept as near-duplicates "
+          f"(Jaccard >= {threshold}) after {stats['rerolls']:,} re-rolls")
+    edges = [0, 1] + [2 ** k for k in range(1, max(1, int(clusters.index.max() - 1).bit_length()) + 1)]
+    labels = ["1"] + [str(hi) if hi == lo + 1 else f"{lo + 1}-{hi}" for lo, hi in zip(edges[1:], edges[2:])]
+    binned = clusters.groupby(pd.cut(clusters.index, edges, labels=labels), observed=True).sum()
+    print(f"   Near-duplicate cluster sizes (notes: clusters): {binned.to_dict()}, largest {clusters.index.max()}")
+    print(f"   Distinct variants per base note: min {distinct.min()}, median {distinct.median():g}, "
+          f"max {distinct.max()} (of {base_notes.median():g} notes per base note)")
+    METRICS.emit("note_diversity", threshold=threshold, **{k: int(v) for k, v in stats.items()},
+                 cluster_sizes={int(k): int(v) for k, v in clusters.items()},
+                 distinct_per_base_note={"min": int(distinct.min()), "median": float(distinct.median()),
+                                         "max": int(distinct.max())})
+
+
+@timed("generate", "notes", rows_arg=1)
+def expand_notes_with_variations(base_notes_df, target_count, patient_ids, dedup=None):
+    """Expand a smaller set of Claude-generated notes to a larger dataset using variations.
+
+    Variations include:
+    - Different patient_id, note_date, provider_id
+    - Medication/dosage substitutions
+    - Age/number substitutions
+    - Typo variations
+
+    With a NoteDeduplicator, variants too similar to an earlier note are re-rolled.
+    """
+    records = []
+    base_notes = base_notes_df.to_dict('records')
+    notes_per_base = (target_count // len(base_notes)) + 1
+    variator = NoteVariator([note["note_text"] for note in base_notes])
+
+    for base_idx, base_note in enumerate(base_notes):
+        # Create variations of this note
+        for var_num in range(notes_per_base):
+            if len(records) >= target_count:
+                break
+
+            if dedup is not None:
+                note_text = dedup.diversify(functools.partial(variator.vary, base_idx), base_idx)
+            else:
+                note_text = variator.vary(base_idx)
+
+            records.append({
+                "patient_id": choose_patient(patient_ids),
+                "note_date": DATES.sample(),
+                "provider_id": random.choice(PROVIDER_IDS),
+                "note_type": base_note["note_type"],
+                "note_text": note_text
+            })
+
+    # Shuffle to mix up the variations
+    random.shuffle(records)
+    records = records[:target_count]
+    cluster_by_patient(records, patient_ids)
+    with METRICS.stage("build_dataframe", "notes", target_count):
+        return pd.DataFrame(records)
+
+
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+CLAUDE_MAX_TOKENS = 8000
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of Claude-generated notes.
+
+    Each note is a JSON file named by the SHA-256 of (model, system prompt, prompt, max_tokens), where
+    the prompt is the note's own patient line and metadata (the key the journal uses), so a rerun finds
+    every note again however the adaptive batches were cut and never requests it. Reads refresh the
+    file's mtime, and evict() drops entries older than max_age_days, then the least recently used ones
+    until the cache fits in max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, max_age_days=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model, system_prompt, prompt, max_tokens):
+        payload = json.dumps([model, system_prompt, prompt, max_tokens])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """Return the cached response text for key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if self.max_age_days is not None and time.time() - entry["created"] > self.max_age_days * 86400:
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return entry["text"]
+
+    def put(self, key, text, model):
+        """Store a response; written to a temp file and renamed so readers never see partial JSON."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"model": model, "created": time.time(), "text": text}, f)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Apply the age and size limits. Returns the number of entries removed."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        removed = 0
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            expired = self.max_age_days is not None and now - mtime > self.max_age_days * 86400
+            oversized = self.max_bytes is not None and total > self.max_bytes
+            if not (expired or oversized):
+                continue
+            os.remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+
+RETRYABLE_STATUS_CODES = {429, 503, 529}  # rate limited, unavailable, overloaded
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+
+class AIMDLimiter:
+    """Adaptive concurrency limit for API calls (additive increase, multiplicative decrease).
+
+    The limit grows by about one slot per limit's worth of fast successful requests and is halved on
+    a rate-limit/overload response - at most once per cooldown, so one burst of 429s from requests
+    that were already in flight only counts once.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, latency_target=60.0, decrease=0.5, cooldown=5.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.peak = self.limit
+        self.rate_limited = 0
+        self._last_decrease = float("-inf")
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency=None, rate_limited=False):
+        """Give back a slot; latency is set for successful requests only."""
+        async with self._cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self.rate_limited += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            elif latency is not None and latency <= self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.peak = max(self.peak, self.limit)
+            self._cond.notify_all()
+
+
+class TokenBudget:
+    """Token bucket enforcing a tokens-per-minute budget across concurrent requests.
+
+    Requests reserve an estimate up front (prompt characters / 4 plus the average output seen so
+    far) and settle with the real usage afterwards, so the bucket can run into debt when the
+    estimate was low; later requests then wait it off.
+    """
+
+    def __init__(self, tokens_per_minute, expected_output_tokens=CLAUDE_MAX_TOKENS // 2):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = float(tokens_per_minute)
+        self.expected_output_tokens = expected_output_tokens
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def estimate(self, prompt_chars):
+        return prompt_chars // 4 + self.expected_output_tokens
+
+    async def reserve(self, tokens):
+        # Waiters queue on the lock, so requests are admitted in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                needed = min(tokens, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    def settle(self, reserved, input_tokens=0, output_tokens=0):
+        """Correct a reservation with actual usage (0/0 refunds a request that was rejected)."""
+        self.tokens += reserved - input_tokens - output_tokens
+        if output_tokens:
+            self.expected_output_tokens = 0.8 * self.expected_output_tokens + 0.2 * output_tokens
+
+
+NOTE_FOLLOWUPS = 2  # follow-up requests per batch for notes missing from the reply
+
+
+class NoteStreamParser:
+    """Incrementally matches JSON-lines notes in a (streamed) reply to their 1-based batch index.
+
+    Each complete line of the form {"index": n, "note": "..."} is recorded as soon as it arrives;
+    prose, code fences, duplicates, out-of-range indices and a line cut off by max_tokens are ignored.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.notes = {}
+        self._buffer = ""
+
+    def feed(self, text):
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self._parse_line(line)
+
+    def close(self):
+        self._parse_line(self._buffer)
+        self._buffer = ""
+
+    def reset(self):
+        """Drop a partial line, e.g. when a retried request starts streaming from scratch."""
+        self._buffer = ""
+
+    def _parse_line(self, line):
+        line = line.strip()
+        if not line.startswith("{"):
+            return
+        try:
+            item = json.loads(line)
+        except ValueError:
+            return
+        index, note = item.get("index"), item.get("note")
+        if (isinstance(index, int) and 1 <= index <= self.count and index not in self.notes
+                and isinstance(note, str) and note.strip()):
+            self.notes[index] = note.strip()
+
+    @property
+    def missing(self):
+        return [i for i in range(1, self.count + 1) if i not in self.notes]
+
+
+class BatchSizer:
+    """Picks how many notes to request per call from the output tokens observed so far.
+
+    Aims for replies that fill ``headroom`` of max_tokens; a reply cut off at max_tokens drops the
+    size to what actually fit, so later batches stop overflowing.
+    """
+
+    def __init__(self, initial=20, max_tokens=CLAUDE_MAX_TOKENS, headroom=0.75, maximum=50):
+        self.size = initial
+        self.max_tokens = max_tokens
+        self.headroom = headroom
+        self.maximum = max(maximum, initial)
+        self.tokens_per_note = None
+
+    def observe(self, notes, output_tokens, truncated=False):
+        if notes:
+            per_note = output_tokens / notes
+            self.tokens_per_note = (per_note if self.tokens_per_note is None
+                                    else 0.8 * self.tokens_per_note + 0.2 * per_note)
+        if truncated:
+            self.size = max(1, min(self.size, int(notes * self.headroom)))
+        elif self.tokens_per_note:
+            self.size = max(1, min(self.maximum, int(self.headroom * self.max_tokens / self.tokens_per_note)))
+
+
+async def admit(limiter, budget, prompt_chars):
+    """Reserve budget tokens for a prompt of prompt_chars, then take a concurrency slot; returns the reservation."""
+    reserved = budget.estimate(prompt_chars) if budget is not None else 0
+    if budget is not None:
+        await budget.reserve(reserved)
+    await limiter.acquire()
+    return reserved
+
+
+async def call_claude(client, limiter, budget, system_prompt, prompt, max_retries, jitter=None, parser=None,
+                      cache_prompt=True, reserved=None):
+    """One Messages API call through the AIMD limiter and optional token budget.
+
+    Rate-limit/overload responses shrink the limiter and are retried with full-jitter exponential
+    backoff; the concurrency slot is released while backing off so other requests keep going.
+    With a parser, the reply is streamed and fed to it as text arrives. With cache_prompt, the
+    system prompt is sent as a cache_control block, so every request after the first reads the
+    shared prefix from the API's prompt cache. A caller that already went through admit() passes
+    its reservation, and the first attempt uses the slot it holds.
+    """
+    # Unseeded by default, so retry timing never perturbs the seeded generation stream
+    jitter = jitter or random.Random()
+    request = {
+        "model": CLAUDE_MODEL,
+        "max_tokens": CLAUDE_MAX_TOKENS,
+        "system": system_blocks(system_prompt) if cache_prompt else system_prompt,
+        "messages": [{"role": "user", "content": prompt}],
+    }
+    for attempt in range(max_retries + 1):
+        if attempt or reserved is None:
+            reserved = await admit(limiter, budget, len(system_prompt) + len(prompt))
+        started = time.monotonic()
+        try:
+            if parser is None:
+                response = await client.messages.create(**request)
+            else:
+                parser.reset()
+                async with client.messages.stream(**request) as stream:
+                    async for text in stream.text_stream:
+                        parser.feed(text)
+                    response = await stream.get_final_message()
+                parser.close()
+        except Exception as e:
+            status = getattr(e, "status_code", None)
+            METRICS.record_request(time.monotonic() - started, attempt, error=status or type(e).__name__)
+            retryable = status in RETRYABLE_STATUS_CODES
+            await limiter.release(rate_limited=retryable)
+            if budget is not None:
+                budget.settle(reserved)
+            if attempt == max_retries or not retryable:
+                raise
+            await asyncio.sleep(jitter.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+            continue
+
+        latency = time.monotonic() - started
+        METRICS.record_request(latency, attempt, usage=getattr(response, "usage", None))
+        await limiter.release(latency=latency)
+        if budget is not None:
+            usage = getattr(response, "usage", None)
+            budget.settle(reserved, getattr(usage, "input_tokens", 0), getattr(usage, "output_tokens", 0))
+        return response
+
+
+def read_note_journal(path):
+    """Load notes completed by a previous run from a journal written by generate_clinical_notes_with_claude.
+
+    Returns {note key: note text}. A truncated last line from a crashed run is ignored.
+    """
+    journaled = {}
+    if not os.path.exists(path):
+        return journaled
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            journaled[entry["key"]] = entry["note_text"]
+    return journaled
+
+
+NOTE_BATCH_HEADER = ("Generate clinical notes for the following patients. Return one JSON object per line, "
+                     '{"index": <patient number>, "note": "<note text>"}, and nothing else. '
+                     "Write line breaks inside a note as \\n.\n\n")
+# The API only caches prefixes of at least this many tokens (2048 for Haiku models)
+MIN_CACHEABLE_TOKENS = 1024
+# Optional guidance sent ahead of the few-shot examples (--note-style-guide). It changes what Claude is
+# told to write, and so every note and cache key, but takes the system prompt past MIN_CACHEABLE_TOKENS
+NOTE_STYLE_GUIDE = """Structure by note type (loosely - real notes skip sections and run them together):
+- Progress Note: interval hx since last visit, current meds w/ doses, pertinent exam or vitals (BP, HR, wt),
+  recent labs if relevant, then a short assessment/plan. Often 2-5 sentences.
+- Consultation: reason for referral, PMH, meds, allergies and contraindications spelled out, prior
+  treatments and why they stopped, then recs for the referring provider. Usually the longest note.
+- Discharge Summary: admitting dx, brief hospital course, procedures, discharge meds (new/changed/stopped),
+  follow-up appointments and pending results. Problem-list style with colons and semicolons is common.
+- Follow-up: one or two lines to a short paragraph. Tolerating tx or not, new symptoms, labs reviewed,
+  whether to continue, and when to return.
+- Initial Assessment: chief complaint, HPI, PMH/PSH, social hx (smoking, EtOH, transportation, caregiver),
+  meds, allergies, and a first impression of trial eligibility.
+
+Abbreviations physicians use freely (never expand them all; mix abbreviated and spelled-out forms):
+pt, yo, M/F, hx, PMH, PSH, HPI, CC, dx, ddx, tx, rx, sx/sxs, f/u, w/, w/o, s/p, d/t, d/c, c/o, r/o, h/o,
+BID, TID, QD, QHS, PRN, PO, IV, SQ, NKDA, SOB, CP, N/V, HA, BP, HR, RR, wt, BMI, WNL, NAD, A&O x3,
+HTN, HLD, DM2, CAD, CHF, CKD, COPD, AFib, MI, CVA, TIA, GERD, OA, RA, PE, DVT, Cr, eGFR, A1c, LDL,
+CBC, BMP, CMP, ANC, LFTs, TSH, INR, EF, CABG, PCI, MRI, CT, ECG/EKG, ROS, PE (exam), RTC, PCP.
+
+What makes them look real:
+- Typos that a fast typist makes (transposed or doubled letters, dropped letters), at most a few per note,
+  and never in drug names so badly that the drug can't be identified.
+- Drug names with doses and frequencies (metformin 1000mg BID, atorvastatin 40 QHS), brand and generic
+  names mixed, occasional reasons for stopping (d/t cough, GI upset, cost, insurance denial).
+- Numbers in the formats clinicians type: BP 142/88, HR 72, A1c 7.9, Cr 1.4, EF 35%, wt 82kg.
+- Trial references as sponsor-style codes (CARD-2022, ONC-117, HEART-001) with a status: screened,
+  enrolled, completed, withdrew (and why), screen failed (and why).
+- Contraindications and eligibility stated the way they appear in charts: "CONTRAINDICATED for ...",
+  "contraindication for MRI-based studies", "not a candidate d/t ...", "Eligible"/"Not eligible".
+- Inconsistent capitalization and punctuation, sentence fragments, run-on lists, dashes instead of periods.
+
+Using the patient context in each request line:
+- Age and gender set the comorbidities that are plausible (a 28 yo rarely has CABG hx; an 80 yo often has
+  several chronic conditions and a long med list) and are mentioned the way charts do ("67 yo M").
+- "Prior trial enrollments: N" means the patient has been in N earlier studies - name one or more trial
+  codes and what happened (completed, withdrew, screen failed). Without it, don't invent trial history,
+  though a note may say the patient is interested in or being screened for a study.
+- "Has N contraindication(s)" means the note should state that many specific contraindications (allergies,
+  implanted devices, organ impairment, interacting meds, pregnancy). Without it, contraindications are
+  absent or explicitly denied ("no known contraindications").
+
+Keep every note fictional: no real names, addresses, phone numbers, record numbers or dates of birth.
+Do not use markdown, headings with #, bullet characters or quotation marks around the note."""
+
+
+@functools.lru_cache(maxsize=None)
+def note_system_prompt(style_guide=False):
+    """The static system prompt with the few-shot EXAMPLE_NOTES (and NOTE_STYLE_GUIDE), built once per process."""
+    examples_text = "\n\n".join([
+        f"Note Type: {ex['note_type']}\nNote: {ex['note_text']}"
+        for ex in EXAMPLE_NOTES
+    ])
+    guide = f"{NOTE_STYLE_GUIDE}\n\n" if style_guide else ""
+
+    return f"""You are generating realistic clinical notes for a healthcare demo.
+The notes should:
+1. Be messy and realistic - include typos, abbreviations (w/, hx, d/t, BID, s/p, etc.), inconsistent formatting
+2. Reference clinical trials, contraindications, prior treatments when relevant
+3. Match the note_type (Progress Note, Consultation, Discharge Summary, Follow-up, Initial Assessment)
+4. Be appropriate for the patient's age and any context provided
+5. Vary in length and style - some brief, some detailed
+
+{guide}Example notes showing the desired style:
+
+{examples_text}
+
+Generate notes that look like they were quickly typed by busy physicians."""
+
+
+def system_blocks(system_prompt):
+    """The system prompt as one text block marked as a prompt-cache breakpoint."""
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+
+def patient_contexts(patient_df):
+    """Prompt fragments for every patient, built once rather than per note.
+
+    Returns (heads, tails): "<age> year old <gender>" and the optional prior-enrollment and
+    contraindication clauses, which go either side of the note type in each prompt line.
+    """
+    enrollments = patient_df["enrollment_history"].to_numpy()
+    contraindications = patient_df["contraindication_count"].to_numpy()
+    heads = patient_df["age"].astype(str) + " year old " + patient_df["gender"].astype(str)
+    tails = [(f", Prior trial enrollments: {enrolled}" if enrolled > 0 else "")
+             + (f", Has {contras} contraindication(s)" if contras > 0 else "")
+             for enrolled, contras in zip(enrollments.tolist(), contraindications.tolist())]
+    return heads.tolist(), tails
+
+
+def note_batch_prompt(lines):
+    """User prompt asking for one JSON line per (number, patient description) pair."""
+    return NOTE_BATCH_HEADER + "".join([f"{i}. {line}\n" for i, line in lines])
+
+
+def claude_options(args):
+    """Cache, journal and retry keyword arguments for generate_clinical_notes_with_claude from the command line."""
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024,
+                              max_age_days=args.cache_max_age_days)
+    return {
+        "cache": cache,
+        "journal_path": args.journal,
+        "resume": args.resume,
+        "fresh": args.fresh,
+        "max_retries": args.max_retries,
+        "max_concurrent": args.max_concurrent,
+        "tokens_per_minute": args.tokens_per_minute,
+        "base_url": args.api_base_url,
+        "cache_prompt": not args.no_prompt_cache,
+        "style_guide": args.note_style_guide,
+    }
+
+
+def generate_clinical_notes_with_claude(num_notes, patient_df, batch_size=20, max_concurrent=32, cache=None,
+                                        journal_path=None, resume=False, fresh=False, max_retries=5,
+                                        tokens_per_minute=None,
+                                        base_url=None, cache_prompt=True, style_guide=False):
+    """Generate clinical notes using Claude API for realistic, contextual notes.
+
+    Uses concurrent API calls for much faster generation. Replies are streamed as JSON lines and
+    matched to patients by index; notes the model skips are re-requested in a small follow-up call.
+
+    Args:
+        num_notes: Number of notes to generate
+        patient_df: DataFrame with patient demographics for context
+        batch_size: Initial number of notes per API call, adapted to the observed output tokens (default: 20)
+        max_concurrent: Ceiling for the adaptive number of concurrent API calls (default: 32)
+        cache: Optional ResponseCache of notes; cached notes are never requested from the API
+        journal_path: Optional JSON-lines file each completed note is appended to as its batch finishes
+        resume: Reuse notes already in journal_path instead of starting it over
+        fresh: Start a non-empty journal_path over; without resume or fresh it raises FileExistsError
+        max_retries: Retries per batch on rate-limit/overload errors, with jittered exponential backoff
+        tokens_per_minute: Optional input+output token budget shared by all in-flight requests
+        base_url: Optional API base URL, e.g. a local mock server
+        cache_prompt: Mark the shared system prompt (instructions and few-shot examples) for the API's
+            prompt cache, so only the per-batch patient lines are billed at the full input price
+        style_guide: Add NOTE_STYLE_GUIDE to the system prompt (changes the notes written and their cache keys)
+    """
+    try:
+        import anthropic
+    except ImportError:
+        print("ERROR: anthropic package not installed. Run: pip install anthropic")
+        return None
+
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        print("ERROR: ANTHROPIC_API_KEY environment variable not set")
+        return None
+
+    # Never truncate a crashed run's progress by accident
+    if journal_path and not (resume or fresh) and os.path.exists(journal_path) and os.path.getsize(journal_path):
+        raise FileExistsError(f"{journal_path} holds notes from an earlier run; pass resume=True to continue it "
+                              f"or fresh=True to start it over")
+
+    provider_ids = [f"DR-{i:04d}" for i in range(50)]
+    system_prompt = note_system_prompt(style_guide)
+
+    # Draw every note's patient and metadata upfront from the seeded random module, so reruns
+    # describe identical notes; batches are cut from this list as the batch size adapts
+    heads, tails = patient_contexts(patient_df)
+    patient_ids = patient_df["patient_id"].tolist()
+    records = []
+    lines = []
+    for _ in range(num_notes):
+        patient = random.randrange(len(patient_df))
+        note_type = random.choice(NOTE_TYPES)
+        note_date = DATES.sample()
+        provider_id = random.choice(provider_ids)
+
+        lines.append(f"{heads[patient]}, Note Type: {note_type}{tails[patient]}")
+        records.append({
+            "patient_id": patient_ids[patient],
+            "note_date": note_date,
+            "provider_id": provider_id,
+            "note_type": note_type,
+        })
+
+    note_keys = [ResponseCache.key(CLAUDE_MODEL, system_prompt, f"{line}\n{json.dumps(record, sort_keys=True)}",
+                                   CLAUDE_MAX_TOKENS)
+                 for line, record in zip(lines, records)]
+
+    # Notes completed by a previous run, keyed by note hash
+    journaled = {}
+    if journal_path and resume:
+        journaled = read_note_journal(journal_path)
+        for key, record in zip(note_keys, records):
+            if key in journaled:
+                record["note_text"] = journaled[key]
+        print(f"   Resuming: {sum(key in journaled for key in note_keys)}/{num_notes} notes already in {journal_path}")
+    journal = open(journal_path, "a" if resume else "w", encoding="utf-8") if journal_path else None
+
+    # Notes cached by any earlier run, whatever batch they were requested in
+    if cache is not None:
+        for key, record in zip(note_keys, records):
+            if key in journaled:
+                continue
+            text = cache.get(key)
+            if text is not None:
+                record["note_text"] = text
+                if journal is not None:
+                    journal.write(json.dumps({"key": key, "note_text": text}) + "\n")
+
+    pending = collections.deque(i for i, record in enumerate(records) if "note_text" not in record)
+    sizer = BatchSizer(initial=batch_size)
+    stats = {"batches": 0, "requests": 0, "followups": 0, "unmatched": 0, "done": num_notes - len(pending)}
+    failed = {}
+    print(f"   Generating {len(pending)} notes in batches of ~{batch_size} "
+          f"(adaptive size and concurrency, up to {max_concurrent} requests)...")
+
+    async def request_notes(client, limiter, budget, prompt, parser, reserved=None):
+        """Fill parser from a streamed API call and feed the reply's output tokens to the batch sizer."""
+        before = len(parser.notes)
+        response = await call_claude(client, limiter, budget, system_prompt, prompt, max_retries, parser=parser,
+                                     cache_prompt=cache_prompt, reserved=reserved)
+        stats["requests"] += 1
+        sizer.observe(len(parser.notes) - before, response.usage.output_tokens,
+                      truncated=response.stop_reason == "max_tokens")
+        return response
+
+    # Async function to process a single batch
+    async def process_batch(client, limiter, budget, batch_no, indices, reserved):
+        batch_lines = [(n, lines[i]) for n, i in enumerate(indices, 1)]
+        parser = NoteStreamParser(len(indices))
+        try:
+            await request_notes(client, limiter, budget, note_batch_prompt(batch_lines), parser, reserved)
+            # Re-request only the notes the reply skipped or lost to truncation, keeping their numbers
+            for _ in range(NOTE_FOLLOWUPS):
+                if not parser.missing:
+                    break
+                stats["followups"] += 1
+                missing = [batch_lines[n - 1] for n in parser.missing]
+                await request_notes(client, limiter, budget, note_batch_prompt(missing), parser)
+        except Exception as e:
+            print(f"   Warning: API error in batch {batch_no}: {e}")
+            failed[batch_no] = e
+
+        for n, i in enumerate(indices, 1):
+            if n in parser.notes:
+                records[i]["note_text"] = parser.notes[n]
+                if cache is not None:
+                    cache.put(note_keys[i], parser.notes[n], CLAUDE_MODEL)
+                if journal is not None:
+                    journal.write(json.dumps({"key": note_keys[i], "note_text": parser.notes[n]}) + "\n")
+            elif batch_no in failed:
+                records[i]["note_text"] = "Note generation failed."
+            else:
+                records[i]["note_text"] = "Note not available."
+                stats["unmatched"] += 1
+        if journal is not None:
+            journal.flush()
+
+    # Process batches under the adaptive concurrency limit (one async client, one connection pool)
+    async def process_all_batches():
+        client = anthropic.AsyncAnthropic(api_key=api_key, max_retries=0, base_url=base_url)
+        limiter = AIMDLimiter(initial=min(4, max_concurrent), maximum=max_concurrent)
+        budget = TokenBudget(tokens_per_minute) if tokens_per_minute else None
+        progress = METRICS.progress("claude_notes", num_notes, unit="notes")
+
+        async def worker():
+            while pending:
+                # Cut the batch only once it may be sent, so its size reflects every reply and 429 so far
+                reserved = await admit(limiter, budget, len(system_prompt) + len(NOTE_BATCH_HEADER))
+                if not pending:
+                    await limiter.release()
+                    if budget is not None:
+                        budget.settle(reserved)
+                    break
+                indices = [pending.popleft() for _ in range(min(sizer.size, len(pending)))]
+                stats["batches"] += 1
+                await process_batch(client, limiter, budget, stats["batches"], indices, reserved)
+                stats["done"] += len(indices)
+                progress.update(stats["done"])
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(max_concurrent)))
+        finally:
+            await client.close()
+        print(f"   Concurrency: settled at {limiter.limit:.1f} (peak {limiter.peak:.1f}), "
+              f"{limiter.rate_limited} rate-limited responses")
+
+    # Run async processing
+    try:
+        with METRICS.stage("llm", "notes", len(pending)):
+            asyncio.run(process_all_batches())
+    finally:
+        if journal is not None:
+            journal.close()
+    METRICS.llm_summary()
+    # The API ignores the breakpoint on prefixes shorter than its minimum, and then reports no cache usage
+    if cache_prompt and METRICS.requests["ok"] and not (METRICS.requests["cache_read_input_tokens"]
+                                                        or METRICS.requests["cache_creation_input_tokens"]):
+        print(f"   Prompt cache: did not apply - the system prompt is below the model's minimum cacheable "
+              f"length ({MIN_CACHEABLE_TOKENS} tokens for most models; --note-style-guide lengthens it)")
+    tokens_per_note = f", ~{sizer.tokens_per_note:.0f} output tokens/note" if sizer.tokens_per_note else ""
+    print(f"   Batching: {stats['batches']} batches, {stats['requests']} API requests "
+          f"({stats['followups']} follow-ups for missing notes), batch size settled at {sizer.size}{tokens_per_note}")
+    if cache is not None:
+        print(f"   Response cache: {cache.hits} notes cached, {cache.misses} requested")
+        cache.evict()
+    if stats["unmatched"]:
+        print(f"   WARNING: {stats['unmatched']} notes still missing after {NOTE_FOLLOWUPS} follow-up requests")
+    if failed:
+        print(f"   WARNING: {len(failed)} batches could not be generated after retries:")
+        for batch_no, error in sorted(failed.items()):
+            print(f"     batch {batch_no}: {type(error).__name__}: {error}")
+    if (failed or stats["unmatched"]) and journal_path:
+        print("   Rerun with --resume to retry only the missing notes.")
+
+    with METRICS.stage("build_dataframe", "notes", len(records)):
+        return pd.DataFrame(records)
+
+
+# Templates with intentional typos and abbreviations
+NOTE_TEMPLATES = [
+    # Hypertension notes
+    "Pt presents w/ hx of hypertension, prev tx w/ {med1} discontinued d/t {side_effect}. Currently on {med2}. No known {typo_allergies}. {trial_history}",
+    "{age} yo {gender} w/ HTN, well controlled on current regimen. BP {bp} today. Continue {med1}. {typo_follow} in 3 months.",
+    "Hypertensive urgency - BP {bp_high}. Pt reports medication non-adherance. Restarted {med1}, added {med2}. {typo_eligible} for HYPER-2025 study.",
+
+    # Diabetes notes
+    "{age} yo {gender} w/ Type 2 DM, on {dm_med} {dm_dose} BID. Contraindications: {contraindication}. Prior treatments incl {prior_med} (d/c for {dc_reason}).",
+    "DM follow up. HbA1c {hba1c}%. {typo_patient} tolerating current regimen. Discussed diet modifications. {trial_mention}",
+    "Uncontrolled T2DM despite max dose metformin. Adding {dm_med2}. {typo_eligible} for GLUCOSE-001 trial pending insurance auth.",
+
+    # Oncology notes
+    "Follow up visit. Patient tolerated {typo_previous} chemo well. No new {typo_symptoms}. Labs reviewed - ANC recovered. {typo_eligible2} for continued treatment. Note: pt has {contraindication2} - {typo_contraindication} for {excluded_procedure}.",
+    "Cycle {cycle_num} of {chemo_regimen}. Grade 2 {side_effect2}. Dose reduction discussed. {typo_patient} prefers to continue full dose. Next scan in {weeks} weeks.",
+    "Oncology consult for {cancer_type}. Stage {stage}. Discussed treatment options. {typo_recommend} enrollment in {trial_name} trial. Pt {decision}.",
+
+    # Cardiology notes
+    "Hx: CAD s/p CABG {year}, CHF (EF {ef}%), CKD stage {ckd_stage}. Current meds: {cardiac_meds}. CONTRAINDICATED for nephrotoxic agents. {trial_history2}",
+    "Cardiac clearance for {procedure}. EKG shows {ekg_finding}. Echo {ef2}% EF. {typo_cleared} for procedure. Note: {pacer_note}",
+    "CHF exacerbation - {typo_patient} with {weight_gain} lb weight gain, increased {typo_edema}. Diuretics adjusted. {typo_follow} in 1 week.",
+
+    # General/Other
+    "New patient eval. PMHx: {conditions}. Medications reviewed - no interactions. {typo_patient} interested in clinical trials for {interest_condition}.",
+    "Annual wellness visit. {age} yo {gender} in good health. Vaccines updated. {typo_screening} scheduled. No acute concerns.",
+    "Referral from PCP for {specialty} evaluation. {typo_reviewed} outside records. Assessment: {assessment}. Plan: {plan}",
+]
+
+
+def int_strings(low, high):
+    """The integers low..high (inclusive) as strings, for uniform integer placeholders."""
+    return [str(v) for v in range(low, high + 1)]
+
+
+MEDS = ["lisinopril 10mg", "amlodipine 5mg", "metoprolol 25mg", "losartan 50mg", "hydrochlorothiazide 12.5mg"]
+DM_MEDS2 = ["trulicity", "ozempic", "jardiance", "farxiga"]
+TRIAL_HISTORIES = [
+    "Prev enrolled in CARD-2022 trial, completed full protocol.",
+    "Previous trial: withdrew from HEART-001 due to transportation issues.",
+    "No prior trial participation.",
+    "Enrolled in 2 previous studies - good compliance.",
+    "Screen failed for ONCO-2023 (abnormal LFTs).",
+    "",
+    ""
+]
+ELIGIBLE_TYPOS = ["Eligible", "Eligibile", "Elligible", "eligible"]
+
+# Every value a placeholder can take, as the exact string it renders to (drawn uniformly unless
+# weighted in NOTE_FIELD_WEIGHTS)
+NOTE_FIELDS = {
+    "med1": MEDS,
+    "med2": MEDS,
+    "dm_med": ["metformin 1000mg", "metformin 500mg", "glipizide 5mg", "januvia 100mg"],
+    "dm_med2": DM_MEDS2,
+    "dm_dose": ["1000mg", "500mg"],
+    "side_effect": ["persistent cough", "dizziness", "fatigue", "GI upset", "ankle swelling"],
+    "side_effect2": ["nausea", "fatigue", "neuropathy", "mucositis"],
+    "contraindication": ["sulfa allergy", "hx of angioedema", "renal impairment", "liver disease", "pregnancy"],
+    "contraindication2": ["pacemaker", "metal implant", "claustrophobia", "contrast allergy", "bleeding disorder"],
+    "excluded_procedure": ["MRI-based studies", "contrast CT", "certain chemo agents"],
+    "prior_med": DM_MEDS2,
+    "dc_reason": ["hypoglycemia", "insurance denial", "GI intolerance", "cost"],
+    "age": int_strings(35, 85),
+    "gender": ["M", "F"],
+    "bp": [f"{s}/{d}" for s in range(115, 136) for d in range(70, 86)],
+    "bp_high": [f"{s}/{d}" for s in range(170, 201) for d in range(100, 121)],
+    "hba1c": [f"{v / 10:.1f}" for v in range(55, 96)],
+    "cycle_num": int_strings(1, 8),
+    "chemo_regimen": ["FOLFOX", "FOLFIRI", "carboplatin/paclitaxel", "R-CHOP", "pembrolizumab"],
+    "cancer_type": ["NSCLC", "breast cancer", "colorectal cancer", "lymphoma", "melanoma"],
+    "stage": ["IIA", "IIB", "IIIA", "IIIB", "IV"],
+    "trial_name": ["KEYNOTE-999", "ONCOLOGY-2025", "BEACON-3", "IMMUNOBOOST"],
+    "decision": ["agrees to enrollment", "declines - wants more time", "will discuss with family"],
+    "year": int_strings(2015, 2022),
+    "ef": int_strings(25, 55),
+    "ef2": int_strings(30, 65),
+    "ckd_stage": int_strings(2, 4),
+    "cardiac_meds": ["carvedilol, furosemide, atorvastatin", "metoprolol, lisinopril, aspirin", "diltiazem, warfarin, digoxin"],
+    "procedure": ["surgery", "colonoscopy", "cardiac cath", "biopsy"],
+    "ekg_finding": ["NSR", "afib", "LBBB", "normal sinus rhythm"],
+    "pacer_note": ["no pacemaker", "ICD in place", "pacemaker - MRI conditional"],
+    "weight_gain": int_strings(3, 12),
+    "weeks": int_strings(4, 12),
+    "conditions": ["HTN, DM, hyperlipidemia", "COPD, CAD, CKD", "RA, osteoporosis, anxiety", "depression, obesity, sleep apnea"],
+    "interest_condition": ["diabetes", "hypertension", "cancer prevention", "arthritis"],
+    "specialty": ["cardiology", "oncology", "endocrinology", "rheumatology"],
+    "assessment": ["stable", "improved", "requires intervention", "monitoring"],
+    "plan": ["continue current management", "start new medication", "order additional testing", "refer to specialist"],
+    "trial_history": TRIAL_HISTORIES,
+    "trial_history2": TRIAL_HISTORIES,
+    "trial_mention": ["", "Discussed DIABETES-2025 trial.", "May be candidate for research study."],
+
+    # Typo variations
+    "typo_allergies": ["allergeis", "allergies", "alergies", "allergys"],
+    "typo_follow": ["Follow up", "Followup", "F/u", "Follow-up"],
+    "typo_eligible": ELIGIBLE_TYPOS,
+    "typo_eligible2": ELIGIBLE_TYPOS,
+    "typo_patient": ["Patient", "Pt", "Patietn", "patient"],
+    "typo_previous": ["previous", "previus", "prior", "prev"],
+    "typo_symptoms": ["symptoms", "symtpoms", "sxs", "symptms"],
+    "typo_contraindication": ["contraindication", "contrindication", "contra-indication", "CI"],
+    "typo_recommend": ["Recommend", "Reccomend", "Recomend", "recommend"],
+    "typo_cleared": ["Cleared", "Cleard", "cleared", "OK'd"],
+    "typo_edema": ["edema", "oedema", "swelling", "edma"],
+    "typo_screening": ["Screening", "Screenings", "screening", "Screeening"],
+    "typo_reviewed": ["Reviewed", "Reviwed", "reviewed", "Rev"],
+}
+
+# HbA1c was round(uniform(5.5, 9.5), 1): the two endpoints only get half a rounding interval
+NOTE_FIELD_WEIGHTS = {
+    "hba1c": np.array([0.5] + [1.0] * 39 + [0.5]) / 40,
+}
+
+
+class NoteTemplate:
+    """A note template parsed once into literal segments and the placeholders between them.
+
+    Only the placeholders the template actually uses are drawn, and rendering is a single
+    positional str.format call per note (or a map over whole value columns in bulk).
+    """
+
+    def __init__(self, template):
+        self.fields = []
+        self.segments = []
+        pattern = []
+        for literal, field, _, _ in string.Formatter().parse(template):
+            self.segments.append(literal)
+            pattern.append(literal.replace("{", "{{").replace("}", "}}"))
+            if field is not None:
+                if field not in self.fields:
+                    self.fields.append(field)
+                pattern.append(f"{{{self.fields.index(field)}}}")
+        self._format = "".join(pattern).format
+
+    def render(self, values):
+        """Render one note from values in self.fields order."""
+        return self._format(*values)
+
+    def render_many(self, columns):
+        """Render one note per row of columns (one sequence of strings per field, in self.fields order)."""
+        return list(map(self._format, *columns))
+
+
+COMPILED_NOTE_TEMPLATES = [NoteTemplate(template) for template in NOTE_TEMPLATES]
+NOTE_FIELD_TABLES = {field: np.array(values, dtype=object) for field, values in NOTE_FIELDS.items()}
+
+
+def draw_note_field(field):
+    """Draw one value for a template placeholder from the global random module."""
+    if field in NOTE_FIELD_WEIGHTS:
+        return random.choices(NOTE_FIELDS[field], weights=NOTE_FIELD_WEIGHTS[field])[0]
+    return random.choice(NOTE_FIELDS[field])
+
+
+def sample_note_field(rng, field, n):
+    """Draw n values for a template placeholder as an object array."""
+    table = NOTE_FIELD_TABLES[field]
+    if field in NOTE_FIELD_WEIGHTS:
+        return table[rng.choice(len(table), size=n, p=NOTE_FIELD_WEIGHTS[field])]
+    return table[rng.integers(len(table), size=n)]
+
+
+@timed("generate", "notes")
+def generate_clinical_notes_template(num_notes, patient_ids, engine="python", rng=None, compact=False):
+    """Generate clinical notes using templates (fast, no API required).
+
+    Each note picks one of COMPILED_NOTE_TEMPLATES and draws only the placeholders it uses.
+    engine="numpy" groups the rows by template and draws and renders each group in bulk (see
+    generate_clinical_notes_template_numpy). compact=True (numpy engine) returns a compact_frame.
+    """
+    if engine == "numpy":
+        return generate_clinical_notes_template_numpy(num_notes, patient_ids, rng, compact)
+    if compact:
+        raise ValueError("compact=True needs the numpy engine (the python engine builds rows)")
+
+    records = []
+    for _ in range(num_notes):
+        patient_id = choose_patient(patient_ids)
+        template = random.choice(COMPILED_NOTE_TEMPLATES)
+        note_text = template.render([draw_note_field(field) for field in template.fields])
+
+        records.append({
+            "patient_id": patient_id,
+            "note_date": DATES.sample(),
+            "provider_id": random.choice(PROVIDER_IDS),
+            "note_type": random.choice(NOTE_TYPES),
+            "note_text": note_text
+        })
+
+    cluster_by_patient(records, patient_ids)
+    with METRICS.stage("build_dataframe", "notes", len(records)):
+        return pd.DataFrame(records)
+
+
+def generate_clinical_notes_template_numpy(num_notes, patient_ids, rng=None, compact=False):
+    """Vectorized template notes: one pass per template over the rows that picked it.
+
+    Same templates and value distributions as the python engine (but a different random stream);
+    provider_id and note_type come back as categoricals.
+    """
+    if rng is None:
+        rng = np.random.default_rng(SEED)
+
+    template_idx = rng.integers(len(COMPILED_NOTE_TEMPLATES), size=num_notes)
+    note_text = np.empty(num_notes, dtype=object)
+    for t, template in enumerate(COMPILED_NOTE_TEMPLATES):
+        rows = np.flatnonzero(template_idx == t)
+        columns = [sample_note_field(rng, field, len(rows)) for field in template.fields]
+        note_text[rows] = template.render_many(columns)
+
+    patient_codes = sample_patient_codes(patient_ids, rng, num_notes)
+    with METRICS.stage("build_dataframe", "notes", num_notes):
+        return build_frame("notes", {
+            "patient_id": patient_index(patient_ids, patient_codes) if compact else take_patient_ids(patient_ids,
+                                                                                                     patient_codes),
+            "note_date": DATES.sample_array(rng, num_notes),
+            "provider_id": pd.Categorical.from_codes(rng.integers(len(PROVIDER_IDS), size=num_notes), PROVIDER_IDS),
+            "note_type": pd.Categorical.from_codes(rng.integers(len(NOTE_TYPES), size=num_notes), NOTE_TYPES),
+            "note_text": note_text,
+        }, compact)
+
+
+# ============================================
+# Markov note synthesizer (offline)
+# ============================================
+MARKOV_ORDER = 2  # tokens of context per transition
+MARKOV_TEMPLATE_NOTES = 20_000  # template notes added to the training corpus
+MARKOV_MAX_TOKENS = 120  # notes that haven't ended by then are cut off
+MARKOV_BATCH_SIZE = 50_000  # notes advanced together, one token per step
+MARKOV_BOS, MARKOV_EOS = 0, 1
+
+
+class MarkovNoteModel:
+    """Token-level n-gram model of clinical notes with one transition table per note_type.
+
+    Tokens are whitespace-separated words (punctuation stays attached), so sampled tokens are
+    joined back with single spaces. Tables are array-backed: each context (the previous `order`
+    token ids) is packed into one int64 key, keys are sorted, and each context's successors are a
+    slice of flat next-token and cumulative-probability arrays. Sampling advances a whole batch
+    of notes one token per step with two searchsorted calls, so the only per-note Python work is
+    the final join. Note types without training notes use the table trained on all notes.
+    """
+
+    def __init__(self, note_types, note_texts, order=MARKOV_ORDER):
+        self.order = order
+        vocab = {"<s>": MARKOV_BOS, "</s>": MARKOV_EOS}
+        sequences = collections.defaultdict(list)
+        for note_type, text in zip(note_types, note_texts):
+            ids = [vocab.setdefault(token, len(vocab)) for token in str(text).split()]
+            sequences[note_type].append(ids)
+            if note_type is not None:
+                sequences[None].append(ids)
+        self.vocab = np.array(list(vocab), dtype=object)
+        if len(self.vocab) ** order >= 2**63:
+            raise ValueError(f"vocabulary of {len(self.vocab):,} tokens is too large for order {order}")
+        self.tables = {note_type: self._table(notes) for note_type, notes in sequences.items()}
+
+    def _table(self, notes):
+        """(sorted context keys, cumulative probabilities offset by row, next token ids) for one note type."""
+        size = len(self.vocab)
+        keys, successors = [], []
+        for ids in notes:
+            tokens = np.array([MARKOV_BOS] * self.order + ids + [MARKOV_EOS], dtype=np.int64)
+            context = np.zeros(len(tokens) - self.order, dtype=np.int64)
+            for k in range(self.order):
+                context = context * size + tokens[k:len(tokens) - self.order + k]
+            keys.append(context)
+            successors.append(tokens[self.order:])
+        pairs, counts = np.unique(np.stack([np.concatenate(keys), np.concatenate(successors)], axis=1),
+                                  axis=0, return_counts=True)
+        context_keys, starts = np.unique(pairs[:, 0], return_index=True)
+        row = np.repeat(np.arange(len(context_keys)), np.diff(np.append(starts, len(pairs))))
+        cumulative = np.cumsum(counts)
+        row_start = (cumulative[starts] - counts[starts])[row]
+        row_total = np.add.reduceat(counts, starts)[row]
+        # Row r's successors cover (r, r + 1], so one searchsorted over all rows finds the draw
+        return context_keys, row + (cumulative - row_start) / row_total, pairs[:, 1].astype(np.int32)
+
+    def sample_tokens(self, rng, n, note_type=None, max_tokens=MARKOV_MAX_TOKENS):
+        """Token id matrix (n, max_tokens) and note lengths for n notes of one type."""
+        context_keys, cumulative, successors = self.tables.get(note_type, self.tables[None])
+        size = len(self.vocab)
+        tokens = np.full((n, max_tokens), MARKOV_EOS, dtype=np.int32)
+        lengths = np.full(n, max_tokens)
+        active = np.arange(n)
+        key = np.zeros(n, dtype=np.int64)  # all-BOS context
+        for step in range(max_tokens):
+            rows = np.searchsorted(context_keys, key)
+            token = successors[np.searchsorted(cumulative, rows + rng.random(len(active)), side="right")]
+            tokens[active, step] = token
+            done = token == MARKOV_EOS
+            lengths[active[done]] = step
+            active, key, token = active[~done], key[~done], token[~done]
+            if not len(active):
+                break
+            key = key % size ** (self.order - 1) * size + token
+        return tokens, lengths
+
+    def sample(self, rng, note_type_codes, note_types=NOTE_TYPES):
+        """One note text per entry of note_type_codes (indices into note_types), as an object array."""
+        texts = np.empty(len(note_type_codes), dtype=object)
+        vocab = self.vocab.tolist()
+        for code in np.unique(note_type_codes):
+            rows = np.flatnonzero(note_type_codes == code)
+            for begin in range(0, len(rows), MARKOV_BATCH_SIZE):
+                batch = rows[begin:begin + MARKOV_BATCH_SIZE]
+                tokens, lengths = self.sample_tokens(rng, len(batch), note_types[code])
+                texts[batch] = [" ".join([vocab[token] for token in ids[:length].tolist()])
+                                for ids, length in zip(tokens, lengths)]
+        return texts
+
+
+def read_note_corpus(path):
+    """note_type and note_text of a base-note file: a notes csv/parquet/arrow output, or a --journal
+    JSONL file of Claude notes (which has no note_type, so it only trains the pooled table)."""
+    if path.endswith(".jsonl"):
+        notes = pd.read_json(path, lines=True)
+    elif path.endswith(".csv"):
+        notes = pd.read_csv(path, usecols=lambda column: column in ("note_type", "note_text"))
+    elif path.endswith(".parquet"):
+        notes = pd.read_parquet(path, columns=["note_type", "note_text"])
+    else:
+        notes = pd.read_feather(path, columns=["note_type", "note_text"])
+    note_types = notes["note_type"].astype(object) if "note_type" in notes else [None] * len(notes)
+    return list(note_types), notes["note_text"].astype(str).tolist()
+
+
+def train_markov_model(corpus=None, template_notes=MARKOV_TEMPLATE_NOTES, order=MARKOV_ORDER, seed=SEED):
+    """Train a MarkovNoteModel on EXAMPLE_NOTES, template_notes template notes and an optional base-note file."""
+    note_types = [note["note_type"] for note in EXAMPLE_NOTES]
+    note_texts = [note["note_text"] for note in EXAMPLE_NOTES]
+    if template_notes:
+        templates = generate_clinical_notes_template_numpy(template_notes, PatientIdRange(0, 1),
+                                                           np.random.default_rng(seed))
+        note_types += templates["note_type"].astype(str).tolist()
+        note_texts += templates["note_text"].tolist()
+    if corpus:
+        corpus_types, corpus_texts = read_note_corpus(corpus)
+        note_types += corpus_types
+        note_texts += corpus_texts
+    return MarkovNoteModel(note_types, note_texts, order)
+
+
+@timed("generate", "notes")
+def generate_clinical_notes_markov(num_notes, patient_ids, model, rng=None):
+    """Notes sampled from a MarkovNoteModel: no network, and cheap enough for millions of notes per core.
+
+    Note types are uniform like the template engine's; each text is sampled from its type's table.
+    Without rng, the draws are seeded from the global random module.
+    """
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    note_type = rng.integers(len(NOTE_TYPES), size=num_notes)
+    note_text = model.sample(rng, note_type)
+    patient_codes = sample_patient_codes(patient_ids, rng, num_notes)
+
+    with METRICS.stage("build_dataframe", "notes", num_notes):
+        return pd.DataFrame({
+            "patient_id": take_patient_ids(patient_ids, patient_codes),
+            "note_date": DATES.sample_array(rng, num_notes),
+            "provider_id": pd.Categorical.from_codes(rng.integers(len(PROVIDER_IDS), size=num_notes), PROVIDER_IDS),
+            "note_type": pd.Categorical.from_codes(note_type, NOTE_TYPES),
+            "note_text": note_text,
+        })
+
+
+def markov_model(args):
+    """Train the --notes-engine markov model from the command line settings, reporting the corpus size."""
+    model = train_markov_model(args.markov_corpus, order=args.markov_order, seed=args.seed)
+    pooled = model.tables[None]
+    print(f"   Trained order-{model.order} Markov note model: {len(model.vocab):,} tokens, "
+          f"{len(pooled[0]):,} contexts, {len(pooled[2]):,} transitions", flush=True)
+    return model
+
+
+# ============================================
+# Counter-based (order-independent) generation
+# ============================================
+# Every random value is a pure function of (seed, dataset, field, row index): a Philox stream keyed
+# by (seed, dataset, field) is positioned at the row's counter, so any row range can be generated
+# on its own, in any order or process, and adding a field never shifts the other fields' values.
+def counter_key(seed, dataset, field):
+    """128-bit Philox key for one field of one dataset."""
+    digest = hashlib.blake2b(f"{seed}/{dataset}/{field}".encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(digest, "little")
+
+
+def row_uniforms(seed, dataset, field, start, stop, per_row=1):
+    """Uniform [0, 1) doubles for rows start..stop of one field, per_row of them per row.
+
+    Each double consumes exactly one 64-bit Philox output, so row r's values sit at a fixed
+    counter position (Philox emits 4 outputs per counter step) and can be jumped to directly.
+    """
+    first = start * per_row
+    generator = np.random.Generator(np.random.Philox(key=counter_key(seed, dataset, field), counter=first // 4))
+    values = generator.random(first % 4 + (stop - start) * per_row)[first % 4:]
+    return values.reshape(-1, per_row) if per_row > 1 else values
+
+
+def uniform_index(u, n):
+    """Map uniforms to integers in [0, n)."""
+    return np.minimum((u * n).astype(np.int64), n - 1)
+
+
+def weighted_index(u, weights):
+    """Map uniforms to indices drawn with the given weights (inverse CDF)."""
+    cum_weights = np.cumsum(weights, dtype=float)
+    return np.minimum(np.searchsorted(cum_weights / cum_weights[-1], u, side="right"), len(cum_weights) - 1)
+
+
+def standard_normal(u):
+    """Standard normal values from pairs of uniforms (Box-Muller), one per row of u."""
+    return np.sqrt(-2.0 * np.log1p(-u[:, 0])) * np.cos(2.0 * np.pi * u[:, 1])
+
+
+def counter_patient_codes(patient_ids, u):
+    """Patient indices from pairs of uniforms: uniform, or through a PatientActivity's alias table."""
+    codes = uniform_index(u[:, 0], len(patient_ids))
+    if isinstance(patient_ids, PatientActivity) and patient_ids.prob is not None:
+        codes = np.where(u[:, 1] < patient_ids.prob[codes], codes, patient_ids.alias[codes])
+    return codes
+
+
+def lab_error_rows(seed, count, num_results):
+    """Rows (out of num_results) that hold the planted lab errors in counter-based output."""
+    generator = np.random.Generator(np.random.Philox(key=counter_key(seed, "labs", "error_rows")))
+    return generator.choice(num_results, min(count, num_results), replace=False)
+
+
+def range_rows(start, stop, *_, **__):
+    return stop - start
+
+
+@timed("generate", "patients", rows_arg=range_rows)
+def generate_patient_demographics_range(start, stop, seed=SEED, compact=False):
+    """Patients start..stop-1 from the counter-based engine; same distributions as the numpy engine.
+
+    compact=True returns a compact_frame.
+    """
+    def u(field, per_row=1):
+        return row_uniforms(seed, "patients", field, start, stop, per_row)
+
+    n = stop - start
+    age = np.clip((58 + 12 * standard_normal(u("age", 2))).astype(np.int64), 18, 95)
+    site_distance_km = np.round(-25 * np.log1p(-u("site_distance_km")) + 1, 1)
+    enrollment_history = weighted_index(u("enrollment_history"), ENROLLMENT_HISTORY_WEIGHTS)
+    contraindication_count = weighted_index(u("contraindication_count"), CONTRAINDICATION_WEIGHTS)
+
+    distance_effect = np.where(site_distance_km < 20, 1.0, np.where(site_distance_km < 40, -0.1, -0.2))
+    prob_adjustment = enrollment_history * 0.15 + distance_effect - 0.15 * contraindication_count
+    success_prob = np.clip(0.5 + prob_adjustment, 0.1, 0.95)
+    enrollment_success = (u("enrollment_success") < success_prob).astype(np.int64)
+
+    with METRICS.stage("build_dataframe", "patients", n):
+        return build_frame("patients", {
+            "patient_id": np.arange(start, stop) if compact else format_patient_ids(np.arange(start, stop)),
+            "age": age,
+            "gender": pd.Categorical.from_codes(weighted_index(u("gender"), GENDER_WEIGHTS), GENDERS),
+            "region": pd.Categorical.from_codes(uniform_index(u("region"), len(REGIONS)), REGIONS),
+            "site_distance_km": site_distance_km,
+            "contact_status": pd.Categorical.from_codes(weighted_index(u("contact_status"), CONTACT_WEIGHTS),
+                                                        CONTACT_STATUSES),
+            "enrollment_history": enrollment_history,
+            "contraindication_count": contraindication_count,
+            "last_visit_date": DATES.from_uniforms(u("last_visit_date")),
+            "enrollment_success": enrollment_success,
+        }, compact)
+
+
+@timed("generate", "labs", rows_arg=range_rows)
+def generate_lab_results_range(start, stop, patient_ids, seed=SEED, errors=OBVIOUS_ERRORS, num_results=None,
+                               compact=False):
+    """Lab results start..stop-1 from the counter-based engine; same distributions as the numpy engine.
+
+    The planted errors sit at lab_error_rows(seed, len(errors), num_results), where num_results
+    is the size of the whole dataset (default: stop), and are only written if they fall in range.
+    compact=True returns a compact_frame.
+    """
+    def u(field, per_row=1):
+        return row_uniforms(seed, "labs", field, start, stop, per_row)
+
+    n = stop - start
+    test_types, test_names, units, ref_lows, ref_highs, means, stds = (np.array(col) for col in zip(*LAB_TESTS))
+    test_idx = uniform_index(u("test"), len(LAB_TESTS))
+
+    error_rows = lab_error_rows(seed, len(errors), stop if num_results is None else num_results)
+    planted = [(row - start, error) for row, error in zip(error_rows, errors) if start <= row < stop]
+    error_pos = np.array([pos for pos, _ in planted], dtype=np.int64)
+    test_idx[error_pos] = [test_names.tolist().index(error["test_name"]) for _, error in planted]
+
+    ref_low, ref_high, mean, std = ref_lows[test_idx], ref_highs[test_idx], means[test_idx], stds[test_idx]
+
+    abnormal = u("abnormal") < 0.15
+    low = abnormal & (u("abnormal_low") < 0.5)
+    high = abnormal & ~low
+    z = standard_normal(u("result_value", 2))
+    result_value = mean + z * std * 0.5
+    result_value[low] = ref_low[low] - np.abs(z[low] * std[low])
+    result_value[high] = ref_high[high] + np.abs(z[high] * std[high])
+    result_value = np.round(np.maximum(result_value, 0), 1)
+    result_value[error_pos] = [error["result_value"] for _, error in planted]
+
+    flag = np.select(
+        [
+            result_value < ref_low * 0.7,
+            result_value < ref_low,
+            result_value > ref_high * 1.3,
+            result_value > ref_high,
+        ],
+        [LAB_FLAGS.index("Critical"), LAB_FLAGS.index("Low"), LAB_FLAGS.index("Critical"), LAB_FLAGS.index("High")],
+        default=LAB_FLAGS.index("Normal"),
+    )
+
+    patient_codes = counter_patient_codes(patient_ids, u("patient_id", 2))
+    with METRICS.stage("build_dataframe", "labs", n):
+        return build_frame("labs", {
+            "patient_id": patient_index(patient_ids, patient_codes) if compact else take_patient_ids(patient_ids,
+                                                                                                     patient_codes),
+            "test_date": DATES.from_uniforms(u("test_date")),
+            "test_type": gather_categorical(test_types, test_idx),
+            "test_name": gather_categorical(test_names, test_idx),
+            "result_value": result_value,
+            "result_unit": gather_categorical(units, test_idx),
+            "reference_low": ref_low,
+            "reference_high": ref_high,
+            "flag": pd.Categorical.from_codes(flag, LAB_FLAGS),
+        }, compact)
+
+
+NOTE_TEMPLATE_SLOTS = max(len(template.fields) for template in COMPILED_NOTE_TEMPLATES)
+
+
+@timed("generate", "notes", rows_arg=range_rows)
+def generate_clinical_notes_range(start, stop, patient_ids, seed=SEED, compact=False):
+    """Template notes start..stop-1 from the counter-based engine; same templates as the numpy engine.
+
+    Each row draws NOTE_TEMPLATE_SLOTS uniforms for its placeholders; the template picked for the
+    row decides which field each one fills. compact=True returns a compact_frame.
+    """
+    def u(field, per_row=1):
+        return row_uniforms(seed, "notes", field, start, stop, per_row)
+
+    n = stop - start
+    template_idx = uniform_index(u("template"), len(COMPILED_NOTE_TEMPLATES))
+    slots = u("note_text", NOTE_TEMPLATE_SLOTS).reshape(n, NOTE_TEMPLATE_SLOTS)
+    note_text = np.empty(n, dtype=object)
+    for t, template in enumerate(COMPILED_NOTE_TEMPLATES):
+        rows = np.flatnonzero(template_idx == t)
+        columns = []
+        for slot, field in enumerate(template.fields):
+            table = NOTE_FIELD_TABLES[field]
+            if field in NOTE_FIELD_WEIGHTS:
+                columns.append(table[weighted_index(slots[rows, slot], NOTE_FIELD_WEIGHTS[field])])
+            else:
+                columns.append(table[uniform_index(slots[rows, slot], len(table))])
+        note_text[rows] = template.render_many(columns)
+
+    patient_codes = counter_patient_codes(patient_ids, u("patient_id", 2))
+    with METRICS.stage("build_dataframe", "notes", n):
+        return build_frame("notes", {
+            "patient_id": patient_index(patient_ids, patient_codes) if compact else take_patient_ids(patient_ids,
+                                                                                                     patient_codes),
+            "note_date": DATES.from_uniforms(u("note_date")),
+            "provider_id": pd.Categorical.from_codes(uniform_index(u("provider_id"), len(PROVIDER_IDS)), PROVIDER_IDS),
+            "note_type": pd.Categorical.from_codes(uniform_index(u("note_type"), len(NOTE_TYPES)), NOTE_TYPES),
+            "note_text": note_text,
+        }, compact)
+
+
+# ============================================
+# Streaming statistics (mergeable sketches)
+# ============================================
+KLL_K = 200  # quantile sketch capacity; rank error is roughly 1.7 / KLL_K
+KLL_DECAY = 2 / 3  # capacity ratio between a level and the one above it
+HLL_PRECISION = 14  # 2**14 registers, ~0.8% relative error on distinct counts
+STATS_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+# Exact value counts per column (dates count per day)
+STATS_CATEGORICAL = {
+    "patients": ["gender", "region", "contact_status", "enrollment_history", "contraindication_count",
+                 "last_visit_date", "enrollment_success"],
+    "labs": ["test_date", "test_type", "test_name", "result_unit", "flag"],
+    "notes": ["note_date", "provider_id", "note_type"],
+}
+# Quantile-sketched numeric columns; note_length is derived from note_text
+STATS_NUMERIC = {"patients": ["age", "site_distance_km"], "labs": ["result_value"], "notes": ["note_length"]}
+LAB_IMPLAUSIBLE_FACTOR = 5  # results this many times the reference high look like data entry errors
+FAILED_NOTE_TEXTS = ["Note generation failed.", "Note not available."]
+# Rows counted as anomalies per dataset
+STATS_ANOMALIES = {
+    "patients": {},
+    "labs": {"implausible_result": lambda chunk: chunk["result_value"] > LAB_IMPLAUSIBLE_FACTOR * chunk["reference_high"]},
+    "notes": {"failed_note": lambda chunk: chunk["note_text"].isin(FAILED_NOTE_TEXTS)},
+}
+
+
+class QuantileSketch:
+    """KLL quantile sketch: a stack of levels of sampled values, level i items weighing 2**i.
+
+    A level over capacity is sorted and every other item (from a random offset) moves up a level,
+    so memory stays around 3 * KLL_K values however many are added. Sketches of the same column
+    merge by concatenating levels and compacting again. count, sum, min and max are exact.
+    """
+
+    def __init__(self, k=KLL_K, seed=0):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        return max(2, int(np.ceil(self.k * KLL_DECAY ** (len(self.levels) - level - 1))))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compact()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compact()
+
+    def _compact(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(self.levels[level])
+                paired = len(items) - len(items) % 2
+                self.levels[level] = items[paired:]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1],
+                                                         items[self._rng.integers(2):paired:2]])
+            level += 1
+
+    def quantiles(self, qs):
+        """Approximate values at the given quantiles (exact at 0 and 1), or None for an empty sketch."""
+        if not self.count:
+            return [None] * len(qs)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        ranks = np.searchsorted(cumulative, np.asarray(qs) * cumulative[-1])
+        values = items[order][np.minimum(ranks, len(items) - 1)]
+        return [self.min if q <= 0 else self.max if q >= 1 else float(v) for q, v in zip(qs, values)]
+
+    def to_json(self):
+        return {"k": self.k, "count": self.count, "sum": self.sum, "min": self.min if self.count else None,
+                "max": self.max if self.count else None, "levels": [items.tolist() for items in self.levels]}
+
+    @classmethod
+    def from_json(cls, data):
+        sketch = cls(data["k"])
+        sketch.levels = [np.array(items, dtype=np.float64) for items in data["levels"]]
+        sketch.count, sketch.sum = data["count"], data["sum"]
+        if sketch.count:
+            sketch.min, sketch.max = data["min"], data["max"]
+        return sketch
+
+
+class HyperLogLog:
+    """HyperLogLog distinct counter over 2**precision one-byte registers; merges by register-wise max."""
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, values):
+        # Duplicates can't change the registers, so only each chunk's distinct values are hashed
+        hashes = pd.util.hash_pandas_object(pd.Series(pd.unique(values)), index=False).to_numpy()
+        tail_bits = 64 - self.precision
+        buckets = (hashes >> np.uint64(tail_bits)).astype(np.int64)
+        tails = (hashes & np.uint64((1 << tail_bits) - 1)).astype(np.float64)  # exact: below 2**53
+        ranks = tail_bits - np.frexp(tails)[1] + 1  # leading zeros in the tail, plus one
+        np.maximum.at(self.registers, buckets, ranks.astype(np.uint8))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int((self.registers == 0).sum())
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)  # linear counting for small cardinalities
+        return int(round(estimate))
+
+    def to_json(self):
+        return {"precision": self.precision, "registers": base64.b64encode(self.registers.tobytes()).decode("ascii")}
+
+    @classmethod
+    def from_json(cls, data):
+        sketch = cls(data["precision"])
+        sketch.registers = np.frombuffer(base64.b64decode(data["registers"]), dtype=np.uint8).copy()
+        return sketch
+
+
+class DatasetStats:
+    """Summary statistics of a dataset, updated a chunk at a time as it is written.
+
+    Exact value counts for categorical and date columns, quantile sketches for numeric columns,
+    a HyperLogLog of distinct patient_ids, and per-column null and per-rule anomaly counts. Every
+    part merges, so shards and appended deltas are summarized on their own and combined, and the
+    dataset never has to be read back.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.rows = 0
+        self.counts = {column: pd.Series(dtype="int64") for column in STATS_CATEGORICAL[dataset]}
+        self.numeric = {column: QuantileSketch() for column in STATS_NUMERIC[dataset]}
+        self.patients = HyperLogLog()
+        self.nulls = pd.Series(dtype="int64")
+        self.anomalies = dict.fromkeys(STATS_ANOMALIES[dataset], 0)
+
+    def update(self, chunk):
+        self.rows += len(chunk)
+        for column, counts in self.counts.items():
+            chunk_counts = chunk[column].value_counts()
+            chunk_counts.index = chunk_counts.index.astype(str)
+            self.counts[column] = counts.add(chunk_counts, fill_value=0).astype("int64")
+        for column, sketch in self.numeric.items():
+            sketch.update(chunk["note_text"].str.len() if column == "note_length" else chunk[column])
+        self.patients.update(chunk["patient_id"])
+        self.nulls = self.nulls.add(chunk.isna().sum(), fill_value=0).astype("int64")
+        for name, rule in STATS_ANOMALIES[self.dataset].items():
+            self.anomalies[name] += int(rule(chunk).sum())
+
+    def merge(self, other):
+        self.rows += other.rows
+        for column, counts in other.counts.items():
+            self.counts[column] = self.counts[column].add(counts, fill_value=0).astype("int64")
+        for column, sketch in other.numeric.items():
+            self.numeric[column].merge(sketch)
+        self.patients.merge(other.patients)
+        self.nulls = self.nulls.add(other.nulls, fill_value=0).astype("int64")
+        for name, count in other.anomalies.items():
+            self.anomalies[name] += count
+
+    def summary(self, column):
+        """count, mean, min, max and STATS_QUANTILES of a numeric column."""
+        sketch = self.numeric[column]
+        quantiles = sketch.quantiles(STATS_QUANTILES)
+        return {"count": sketch.count, "mean": sketch.sum / sketch.count if sketch.count else None,
+                "min": sketch.min if sketch.count else None,
+                "max": sketch.max if sketch.count else None,
+                **{f"p{round(q * 100)}": value for q, value in zip(STATS_QUANTILES, quantiles)}}
+
+    def to_json(self):
+        return {
+            "dataset": self.dataset,
+            "rows": self.rows,
+            "distinct_patient_ids": self.patients.estimate(),
+            "categorical": {column: {str(k): int(v) for k, v in counts.sort_index().items()}
+                            for column, counts in self.counts.items()},
+            "numeric": {column: self.summary(column) for column in self.numeric},
+            "nulls": {str(k): int(v) for k, v in self.nulls.items()},
+            "anomalies": self.anomalies,
+            "sketches": {"patient_id": self.patients.to_json(),
+                         **{column: sketch.to_json() for column, sketch in self.numeric.items()}},
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls(data["dataset"])
+        stats.rows = data["rows"]
+        for column, counts in data["categorical"].items():
+            stats.counts[column] = pd.Series(counts, dtype="int64")
+        stats.numeric = {column: QuantileSketch.from_json(data["sketches"][column]) for column in stats.numeric}
+        stats.patients = HyperLogLog.from_json(data["sketches"]["patient_id"])
+        stats.nulls = pd.Series(data["nulls"], dtype="int64")
+        stats.anomalies.update(data["anomalies"])
+        return stats
+
+
+def counts_median(counts):
+    """Exact median of the values behind a value_counts() Series, as Series.median() gives for the values."""
+    counts = counts.sort_index()
+    cumulative = counts.cumsum().to_numpy()
+    middle = np.searchsorted(cumulative, [(cumulative[-1] - 1) // 2, cumulative[-1] // 2], side="right")
+    return counts.index[middle].to_numpy().mean()
+
+
+def new_dataset_stats(dataset, args):
+    """An empty DatasetStats for dataset with --stats. Otherwise None, and the sidecar of an earlier
+    run is removed, since it would no longer describe the regenerated data."""
+    if args.stats:
+        return DatasetStats(dataset)
+    if os.path.exists(dataset_stats_path(dataset)):
+        os.remove(dataset_stats_path(dataset))
+    return None
+
+
+def dataset_stats_path(dataset):
+    return f"{DATASET_FILES[dataset]}.stats.json"
+
+
+def save_dataset_stats(stats):
+    """Write the <name>.stats.json sidecar (atomically); a no-op for None (no --stats)."""
+    if stats is None:
+        return
+    path = dataset_stats_path(stats.dataset)
+    data = dict(stats.to_json(), updated=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def read_dataset_stats(dataset):
+    """The DatasetStats saved for dataset, or None if it has no sidecar."""
+    if not os.path.exists(dataset_stats_path(dataset)):
+        return None
+    with open(dataset_stats_path(dataset)) as f:
+        return DatasetStats.from_json(json.load(f))
+
+
+# ============================================
+# Output writers
+# ============================================
+DATASET_FILES = {
+    "patients": "patient_demographics",
+    "labs": "lab_results_2025",
+    "notes": "clinical_notes_raw",
+}
+
+OUTPUT_FORMATS = ["csv", "parquet", "arrow", "feather"]
+CSV_SLICE_ROWS = 100_000  # rows rendered to CSV text at a time
+
+# Date column each dataset is split on by --partition-by, and the ISO date prefix that keys a partition
+PARTITION_COLUMNS = {"labs": "test_date", "notes": "note_date"}
+PARTITION_KEY_LENGTHS = {"month": 7, "day": 10}
+PARTITION_MANIFEST = "_manifest.json"
+
+# Arrow column types per dataset; "dict" columns are dictionary-encoded strings
+DATASET_SCHEMAS = {
+    "patients": [
+        ("patient_id", "string"), ("age", "int16"), ("gender", "dict"), ("region", "dict"),
+        ("site_distance_km", "float32"), ("contact_status", "dict"), ("enrollment_history", "int8"),
+        ("contraindication_count", "int8"), ("last_visit_date", "date32"), ("enrollment_success", "int8"),
+    ],
+    "labs": [
+        ("patient_id", "string"), ("test_date", "date32"), ("test_type", "dict"), ("test_name", "dict"),
+        ("result_value", "float32"), ("result_unit", "dict"), ("reference_low", "float32"),
+        ("reference_high", "float32"), ("flag", "dict"),
+    ],
+    "notes": [
+        ("patient_id", "string"), ("note_date", "date32"), ("provider_id", "dict"), ("note_type", "dict"),
+        ("note_text", "string"),
+    ],
+}
+
+
+# Fixed dictionaries, so every chunk and shard of a file shares one encoding (required by Arrow IPC files)
+DICTIONARY_VALUES = {
+    "gender": GENDERS,
+    "region": REGIONS,
+    "contact_status": CONTACT_STATUSES,
+    "test_type": sorted({test[0] for test in LAB_TESTS}),
+    "test_name": [test[1] for test in LAB_TESTS],
+    "result_unit": sorted({test[2] for test in LAB_TESTS}),
+    "flag": LAB_FLAGS,
+    "provider_id": PROVIDER_IDS,
+    "note_type": NOTE_TYPES,
+}
+
+
+def dataset_path(dataset, fmt="csv"):
+    """Output file name for a dataset in the given format."""
+    return f"{DATASET_FILES[dataset]}.{fmt}"
+
+
+def arrow_schema(dataset):
+    """Build the explicit pyarrow schema for a dataset."""
+    import pyarrow as pa
+
+    types = {
+        "string": pa.string(),
+        "dict": pa.dictionary(pa.int32(), pa.string()),
+        "date32": pa.date32(),
+        "float32": pa.float32(),
+        "int8": pa.int8(),
+        "int16": pa.int16(),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in DATASET_SCHEMAS[dataset]])
+
+
+def to_arrow_table(df, schema):
+    """Convert a generated DataFrame to a pyarrow Table, casting each column to its schema type."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    columns = []
+    for field in schema:
+        values = pa.array(df[field.name])
+        if pa.types.is_dictionary(field.type):
+            values = values.cast(pa.string())
+            dictionary = pa.array(DICTIONARY_VALUES[field.name], pa.string())
+            indices = pc.index_in(values, value_set=dictionary).cast(pa.int32())
+            if indices.null_count != values.null_count:
+                raise ValueError(f"{field.name} has values outside its fixed dictionary")
+            columns.append(pa.DictionaryArray.from_arrays(indices, dictionary))
+        else:
+            columns.append(values.cast(field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class DatasetWriter:
+    """Writes DataFrame chunks of one dataset to a csv, parquet or arrow/feather file.
+
+    Parquet output buffers chunks until row_group_size rows are available, so row groups don't
+    shrink to the generation chunk size. arrow and feather both write the Arrow IPC file format.
+    append=True adds rows to the end of an existing CSV file (columnar files can't be extended in
+    place; write a new partition file instead).
+    """
+
+    def __init__(self, path, dataset, fmt="csv", compression=None, row_group_size=1_000_000, append=False):
+        if append and fmt != "csv":
+            raise ValueError(f"{fmt} files can't be appended to in place; write a new partition file")
+        self.path = path
+        self.dataset = dataset
+        self.fmt = fmt
+        self.compression = None if compression == "none" else compression
+        self.row_group_size = row_group_size
+        self.schema = arrow_schema(dataset) if fmt != "csv" else None
+        self._writer = None
+        self._started = append
+        self._pending = []
+        self._pending_rows = 0
+
+    def write(self, df):
+        if self.fmt == "csv":
+            # Render CSV text and write it in slices, so serialization and I/O are timed separately
+            for begin in range(0, max(len(df), 1), CSV_SLICE_ROWS):
+                part = df.iloc[begin:begin + CSV_SLICE_ROWS]
+                with METRICS.stage("serialize", self.dataset, len(part)):
+                    text = part.to_csv(header=not self._started, index=False)
+                with METRICS.stage("write", self.dataset, len(part)):
+                    with open(self.path, "a" if self._started else "w", encoding="utf-8", newline="") as f:
+                        f.write(text)
+                self._started = True
+        else:
+            with METRICS.stage("serialize", self.dataset, len(df)):
+                table = to_arrow_table(df, self.schema)
+            with METRICS.stage("write", self.dataset, len(df)):
+                self.write_table(table)
+
+    def write_table(self, table):
+        if self.fmt == "parquet":
+            self._pending.append(table)
+            self._pending_rows += table.num_rows
+            if self._pending_rows >= self.row_group_size:
+                self._flush()
+        else:
+            self._open().write_table(table)
+
+    def append_part(self, part_path):
+        """Append the rows of a part file written by a DatasetWriter with the same format."""
+        if self.fmt == "csv":
+            import shutil
+
+            with open(part_path, "rb") as part, open(self.path, "ab" if self._started else "wb") as out:
+                if self._started:
+                    part.readline()  # keep only the first header
+                shutil.copyfileobj(part, out)
+            self._started = True
+            return
+
+        import pyarrow as pa
+
+        if self.fmt == "parquet":
+            import pyarrow.parquet as pq
+
+            for batch in pq.ParquetFile(part_path).iter_batches(batch_size=self.row_group_size):
+                self.write_table(pa.Table.from_batches([batch]).cast(self.schema))
+        else:
+            import pyarrow.ipc as ipc
+
+            with ipc.open_file(part_path) as reader:
+                for i in range(reader.num_record_batches):
+                    self.write_table(pa.Table.from_batches([reader.get_batch(i)]))
+
+    def close(self):
+        if self.fmt == "csv":
+            if not self._started:
+                self.write(pd.DataFrame(columns=[name for name, _ in DATASET_SCHEMAS[self.dataset]]))
+            return
+        self._flush()
+        self._open().close()
+
+    def _flush(self):
+        if self._pending:
+            import pyarrow as pa
+
+            self._open().write_table(pa.concat_tables(self._pending), row_group_size=self.row_group_size)
+            self._pending = []
+            self._pending_rows = 0
+
+    def _open(self):
+        if self._writer is None:
+            if self.fmt == "parquet":
+                import pyarrow.parquet as pq
+
+                self._writer = pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+            else:
+                import pyarrow.ipc as ipc
+
+                options = ipc.IpcWriteOptions(compression=self.compression)
+                self._writer = ipc.new_file(self.path, self.schema, options=options)
+        return self._writer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PartitionedWriter:
+    """Routes rows of a dated dataset to one DatasetWriter per month or day partition.
+
+    Rows land in <directory>/<key name>=<key>/<part>.<fmt> (e.g. test_month=2025-03, see
+    partition_key_name) as each chunk is split by its date, so nothing is sorted or re-read
+    afterwards. Split rows are buffered per partition until row_group_size rows are pending across
+    all of them, then each partition gets them in one write (one row group for parquet). That keeps
+    memory bounded with hundreds of daily partitions without hundreds of tiny writes per chunk.
+    """
+
+    def __init__(self, directory, dataset, partition_by, part="part-0000", fmt="csv", compression=None,
+                 row_group_size=1_000_000):
+        self.directory = directory
+        self.dataset = dataset
+        self.partition_by = partition_by
+        self.column = PARTITION_COLUMNS[dataset]
+        self.part = part
+        self.fmt = fmt
+        self.row_group_size = row_group_size
+        self.options = {"fmt": fmt, "compression": compression, "row_group_size": row_group_size}
+        self.writers = {}
+        self.rows = {}
+        self._pending = {}
+        self._pending_rows = 0
+
+    def write(self, df):
+        # Partition keys are computed once per distinct date, not per row
+        dates = df[self.column].astype("category")
+        keys, key_names = pd.factorize(dates.cat.categories.str.slice(0, PARTITION_KEY_LENGTHS[self.partition_by]))
+        row_keys = keys[dates.cat.codes.to_numpy()]
+        for code, part in df.groupby(row_keys, sort=False):
+            key = key_names[code]
+            self._pending.setdefault(key, []).append(part)
+            self.rows[key] = self.rows.get(key, 0) + len(part)
+        self._pending_rows += len(df)
+        if self._pending_rows >= self.row_group_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        for writer in self.writers.values():
+            writer.close()
+
+    def _flush(self):
+        for key, parts in self._pending.items():
+            writer = self._writer(key)
+            writer.write(pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0])
+            writer._flush()
+        self._pending = {}
+        self._pending_rows = 0
+
+    def _writer(self, key):
+        if key not in self.writers:
+            partition_dir = os.path.join(self.directory, f"{partition_key_name(self.dataset, self.partition_by)}={key}")
+            os.makedirs(partition_dir, exist_ok=True)
+            path = os.path.join(partition_dir, f"{self.part}.{self.fmt}")
+            self.writers[key] = DatasetWriter(path, self.dataset, **self.options)
+        return self.writers[key]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# SQL column types per --sink; SQLite keeps dates as ISO text, which sorts and compares correctly
+SQL_TYPES = {
+    "sqlite": {"string": "TEXT", "dict": "TEXT", "date32": "TEXT", "float32": "REAL", "int8": "INTEGER",
+               "int16": "INTEGER"},
+    "duckdb": {"string": "VARCHAR", "dict": "VARCHAR", "date32": "DATE", "float32": "REAL", "int8": "TINYINT",
+               "int16": "SMALLINT"},
+}
+# Indexed once each table is loaded: the join key and the date column
+SQL_INDEXES = {"patients": ["patient_id", "last_visit_date"], "labs": ["patient_id", "test_date"],
+               "notes": ["patient_id", "note_date"]}
+SQL_BATCH_ROWS = 100_000  # rows per executemany / transaction
+DEFAULT_SINK_PATHS = {"sqlite": "clinical_trials.sqlite", "duckdb": "clinical_trials.duckdb"}
+# The pipeline's first step: patients left-joined to per-patient lab result and note aggregates, then
+# summarized by region and contraindication count (unmatched = patients missing labs or notes)
+JOIN_BENCHMARK_QUERY = """
+WITH labs AS (
+    SELECT patient_id, COUNT(*) AS results, SUM(CASE WHEN flag = 'Critical' THEN 1 ELSE 0 END) AS critical
+    FROM lab_results_2025 WHERE test_date >= '2025-07-01' GROUP BY patient_id
+), notes AS (
+    SELECT patient_id, COUNT(*) AS notes FROM clinical_notes_raw GROUP BY patient_id
+)
+SELECT p.region, p.contraindication_count,
+       COUNT(*) AS patients,
+       SUM(CASE WHEN l.patient_id IS NULL OR n.patient_id IS NULL THEN 1 ELSE 0 END) AS unmatched,
+       SUM(COALESCE(l.results, 0)) AS lab_results_h2,
+       SUM(COALESCE(l.critical, 0)) AS critical_results_h2,
+       AVG(COALESCE(n.notes, 0)) AS notes_per_patient
+FROM patient_demographics p
+LEFT JOIN labs l ON l.patient_id = p.patient_id
+LEFT JOIN notes n ON n.patient_id = p.patient_id
+GROUP BY p.region, p.contraindication_count
+ORDER BY p.region, p.contraindication_count
+"""
+
+
+def connect_sink(path, sink):
+    """Open a --sink database; SQLite is set up for a one-off bulk load (no rollback journal or fsync)."""
+    if sink == "duckdb":
+        import duckdb
+
+        return duckdb.connect(path)
+    import sqlite3
+
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=OFF")
+    con.execute("PRAGMA synchronous=OFF")
+    con.execute("PRAGMA cache_size=-262144")  # 256 MB of page cache for the index builds
+    return con
+
+
+def sink_query(con, sink, query):
+    """Run a query on a --sink connection and return the result as a DataFrame."""
+    if sink == "duckdb":
+        return con.execute(query).df()
+    return pd.read_sql_query(query, con)
+
+
+class SqlWriter:
+    """Bulk-loads DataFrame chunks of one dataset into a table of a local SQLite or DuckDB database.
+
+    The table, named like the dataset's file, is recreated without indexes and loaded a chunk at a
+    time: SQLite through executemany over column batches, one transaction per batch; DuckDB by
+    ingesting each chunk as an Arrow table. The patient_id and date indexes are only built by
+    close(), after the last row, which is far cheaper than maintaining them during the load.
+    Sharded runs load the shards' Arrow IPC part files with append_part(), with no text round-trip.
+    """
+
+    def __init__(self, path, dataset, sink="sqlite"):
+        self.path = path
+        self.dataset = dataset
+        self.sink = sink
+        self.table = DATASET_FILES[dataset]
+        self.columns = [name for name, _ in DATASET_SCHEMAS[dataset]]
+        self.schema = arrow_schema(dataset) if sink == "duckdb" else None
+        self.insert = f"INSERT INTO {self.table} VALUES ({', '.join('?' * len(self.columns))})"
+        self.con = connect_sink(path, sink)
+        self.con.execute(f"DROP TABLE IF EXISTS {self.table}")
+        self.con.execute(f"CREATE TABLE {self.table} ("
+                         + ", ".join(f"{name} {SQL_TYPES[sink][kind]}" for name, kind in DATASET_SCHEMAS[dataset])
+                         + ")")
+
+    def write(self, df):
+        if self.sink == "duckdb":
+            with METRICS.stage("serialize", self.dataset, len(df)):
+                table = to_arrow_table(df, self.schema)
+            with METRICS.stage("write", self.dataset, len(df)):
+                self._insert_table(table)
+            return
+        for begin in range(0, len(df), SQL_BATCH_ROWS):
+            part = df.iloc[begin:begin + SQL_BATCH_ROWS]
+            with METRICS.stage("serialize", self.dataset, len(part)):
+                columns = [part[name].tolist() for name in self.columns]
+            with METRICS.stage("write", self.dataset, len(part)):
+                self._insert_rows(columns)
+
+    def append_part(self, part_path):
+        """Load the rows of a shard's Arrow IPC part file.
+
+        Not timed as serialize/write stages: the shard already counted these rows as written, and the
+        caller times the load as its merge stage.
+        """
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+
+        with ipc.open_file(pa.memory_map(part_path)) as reader:
+            for i in range(reader.num_record_batches):
+                table = pa.Table.from_batches([reader.get_batch(i)])
+                if self.sink == "duckdb":
+                    self._insert_table(table)
+                    continue
+                for begin in range(0, table.num_rows, SQL_BATCH_ROWS):
+                    self._insert_rows(sqlite_columns(table.slice(begin, SQL_BATCH_ROWS)))
+
+    def _insert_rows(self, columns):
+        with self.con:
+            self.con.executemany(self.insert, zip(*columns))
+
+    def _insert_table(self, table):
+        self.con.register("chunk", table)
+        self.con.execute(f"INSERT INTO {self.table} SELECT * FROM chunk")
+        self.con.unregister("chunk")
+
+    def close(self):
+        with METRICS.stage("index", self.dataset):
+            for column in SQL_INDEXES[self.dataset]:
+                self.con.execute(f"CREATE INDEX idx_{self.table}_{column} ON {self.table} ({column})")
+            if self.sink == "sqlite":
+                self.con.execute(f"ANALYZE {self.table}")  # row estimates for the join planner
+                self.con.commit()
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def sqlite_columns(table):
+    """Python value lists of an Arrow table's columns, as SQLite gets them from a DataFrame.
+
+    Dates become ISO text and dictionary columns plain strings (both far faster to convert), and
+    float32 values go through their shortest text form, so 7.2 is stored as 7.2 rather than
+    7.199999809265137.
+    """
+    import pyarrow as pa
 
+    columns = []
+    for column in table.columns:
+        if pa.types.is_date(column.type) or pa.types.is_dictionary(column.type):
+            column = column.cast(pa.string())
+        elif pa.types.is_float32(column.type):
+            column = column.cast(pa.string()).cast(pa.float64())
+        columns.append(column.to_pylist())
+    return columns
+
+
+def read_sink_table(path, sink, dataset, columns=None, limit=None):
+    """Read (the given columns of) a dataset's table back from a --sink database."""
+    query = f"SELECT {', '.join(columns) if columns else '*'} FROM {DATASET_FILES[dataset]}"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    con = connect_sink(path, sink)
+    try:
+        return sink_query(con, sink, query)
+    finally:
+        con.close()
+
+
+def run_join_benchmark(path, sink, repeat=3):
+    """Time JOIN_BENCHMARK_QUERY on a --sink database; prints the best of repeat runs and returns the result."""
+    con = connect_sink(path, sink)
+    try:
+        rows = {dataset: sink_query(con, sink, f"SELECT COUNT(*) AS n FROM {table}")["n"].iloc[0]
+                for dataset, table in DATASET_FILES.items()}
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = sink_query(con, sink, JOIN_BENCHMARK_QUERY)
+            timings.append(time.perf_counter() - started)
+    finally:
+        con.close()
+    print(f"\nJoin benchmark ({sink}, {path}): {rows['patients']:,} patients, {rows['labs']:,} lab results, "
+          f"{rows['notes']:,} notes")
+    print(f"   Best of {repeat}: {min(timings):.3f}s ({', '.join(f'{t:.3f}s' for t in timings)}), "
+          f"{len(result)} result rows")
+    print(result.head(10).to_string(index=False))
+    METRICS.emit("join_benchmark", sink=sink, seconds=[round(t, 4) for t in timings],
+                 **{f"{dataset}_rows": int(n) for dataset, n in rows.items()})
+    return result
+
+
+def open_writer(path, dataset, output):
+    """DatasetWriter, or a PartitionedWriter when output has partition_by, or a SqlWriter when it
+    has sink, for the given options."""
+    if output.get("sink"):
+        return SqlWriter(path, dataset, **output)
+    if output.get("partition_by"):
+        return PartitionedWriter(path, dataset, **output)
+    return DatasetWriter(path, dataset, **output)
+
+
+def partition_key_name(dataset, partition_by):
+    """Name of the partition key in directory names, e.g. test_month or note_day.
+
+    It differs from the date column the files keep, so readers that turn hive-style directory keys
+    into columns (pyarrow datasets, pd.read_parquet on the directory) don't clash with it.
+    """
+    return PARTITION_COLUMNS[dataset].replace("_date", f"_{partition_by}")
+
+
+def partitioning(dataset, args):
+    """The --partition-by granularity for dataset, or None for unpartitioned datasets (patients)."""
+    return args.partition_by if dataset in PARTITION_COLUMNS else None
+
+
+def output_path(dataset, args):
+    """Where a dataset is written: its file, its partition directory with --partition-by, or the
+    --sink database."""
+    if args.sink:
+        return args.sink_path
+    if partitioning(dataset, args):
+        return DATASET_FILES[dataset]
+    return dataset_path(dataset, args.format)
+
+
+def reset_partitions(directory):
+    """Remove the partition directories and manifest of an earlier run before regenerating."""
+    import shutil
+
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+
+
+def write_partition_manifest(directory, dataset, partition_by, fmt, rows, merge=False):
+    """Write <directory>/_manifest.json with the row count and files of every partition.
+
+    rows maps partition keys to rows just written; with merge=True they are added to the counts
+    of an existing manifest (appends), otherwise the manifest describes only these rows.
+    """
+    path = os.path.join(directory, PARTITION_MANIFEST)
+    column = PARTITION_COLUMNS[dataset]
+    key_name = partition_key_name(dataset, partition_by)
+    counts = {}
+    if merge and os.path.exists(path):
+        with open(path) as f:
+            counts = {p["key"]: p["rows"] for p in json.load(f)["partitions"]}
+    for key, n in rows.items():
+        counts[key] = counts.get(key, 0) + int(n)
+
+    partitions = []
+    for key in sorted(counts):
+        partition_dir = f"{key_name}={key}"
+        files = sorted(name for name in os.listdir(os.path.join(directory, partition_dir)) if name.endswith(f".{fmt}"))
+        partitions.append({"key": key, "path": partition_dir, "rows": counts[key], "files": files})
+    manifest = {
+        "dataset": dataset,
+        "column": column,
+        "key": key_name,
+        "partition_by": partition_by,
+        "format": fmt,
+        "rows": sum(counts.values()),
+        "partitions": partitions,
+        "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return manifest
+
+
+def output_options(args):
+    """DatasetWriter keyword arguments from the command line."""
+    return {"fmt": args.format, "compression": args.compression, "row_group_size": args.row_group_size}
+
+
+def read_dataset_head(path, fmt, nrows, dataset="patients"):
+    """Read the first nrows of a dataset file written by DatasetWriter (or a --sink table, with fmt set to
+    the sink) back into a DataFrame."""
+    if fmt in SQL_TYPES:
+        return read_sink_table(path, fmt, dataset, limit=nrows)
+    if fmt == "csv":
+        return pd.read_csv(path, nrows=nrows)
+    import pyarrow as pa
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        batches = pq.ParquetFile(path).iter_batches(batch_size=nrows)
+        return pa.Table.from_batches([next(batches)]).to_pandas()
+    import pyarrow.ipc as ipc
+
+    with ipc.open_file(path) as reader:
+        return reader.read_all().slice(0, nrows).to_pandas()
+
+
+def read_dataset_columns(paths, fmt, columns, dataset="patients"):
+    """Read only the given columns of one or more files of a dataset, concatenated in file order."""
+    if fmt in SQL_TYPES:
+        return read_sink_table(paths[0], fmt, dataset, columns)
+    if fmt == "csv":
+        frames = [pd.read_csv(path, usecols=columns) for path in paths]
+    else:
+        import pyarrow as pa
+
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+
+            frames = [pq.read_table(path, columns=columns).to_pandas() for path in paths]
+        else:
+            import pyarrow.ipc as ipc
+
+            frames = []
+            for path in paths:
+                with ipc.open_file(pa.memory_map(path)) as reader:
+                    frames.append(reader.read_all().select(columns).to_pandas())
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_patient_activity(patient_ids, paths, args):
+    """patient_activity() for patients already written to paths; only age and contraindication_count are read."""
+    if args.patient_activity == "uniform":
+        return patient_activity(patient_ids, None, None, args)
+    patients = read_dataset_columns(paths, args.sink or args.format, ["age", "contraindication_count"])
+    return patient_activity(patient_ids, patients["age"], patients["contraindication_count"], args)
+
+
+def write_dataframe(df, dataset, args, stats=None):
+    """Write a fully generated dataset in the selected output format and return its path."""
+    path = output_path(dataset, args)
+    write_output([df], dataset, path, args, stats=stats)
+    return path
+
+
+# ============================================
+# Streaming (chunked) generation
+# ============================================
+def iter_patient_demographics(num_patients, chunk_size, engine="python", rng=None, start=0):
+    """Yield patient demographics as DataFrames of at most chunk_size rows."""
+    if engine == "numpy" and rng is None:
+        rng = np.random.default_rng(SEED)
+    for chunk_start in range(start, start + num_patients, chunk_size):
+        size = min(chunk_size, start + num_patients - chunk_start)
+        yield generate_patient_demographics(size, engine, rng, start=chunk_start)
+
+
+def iter_lab_results(num_results, patient_ids, chunk_size, engine="python", rng=None, errors=OBVIOUS_ERRORS):
+    """Yield lab results in chunks, with the planted errors spread over random chunks."""
+    errors = errors[:num_results]
+    if engine == "numpy":
+        if rng is None:
+            rng = np.random.default_rng(SEED)
+        error_rows = rng.choice(num_results, len(errors), replace=False)
+    else:
+        error_rows = random.sample(range(num_results), len(errors))
+
+    for start in range(0, num_results, chunk_size):
+        size = min(chunk_size, num_results - start)
+        chunk_errors = [e for e, row in zip(errors, error_rows) if start <= row < start + size]
+        yield generate_lab_results(size, patient_ids, engine, rng, errors=chunk_errors)
+
+
+def iter_clinical_notes_template(num_notes, patient_ids, chunk_size, engine="python", rng=None):
+    """Yield template-based clinical notes in chunks."""
+    for start in range(0, num_notes, chunk_size):
+        yield generate_clinical_notes_template(min(chunk_size, num_notes - start), patient_ids, engine, rng)
+
+
+def iter_markov_notes(model, num_notes, patient_ids, chunk_size, rng=None):
+    """Yield notes sampled from a MarkovNoteModel in chunks."""
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    for start in range(0, num_notes, chunk_size):
+        yield generate_clinical_notes_markov(min(chunk_size, num_notes - start), patient_ids, model, rng)
+
+
+def iter_expanded_notes(base_notes_df, target_count, patient_ids, chunk_size, start=0, dedup=None):
+    """Streaming version of expand_notes_with_variations.
+
+    Walks variation rounds over all base notes (rather than all variations of one base note at a
+    time), so each chunk already mixes many base notes and only needs a local shuffle. start is the
+    global row offset, so shards pick up the round-robin where the previous shard stopped.
+    """
+    base_notes = base_notes_df.to_dict('records')
+    variator = NoteVariator([note["note_text"] for note in base_notes])
+    for chunk_start in range(start, start + target_count, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, start + target_count)
+        with METRICS.stage("generate", "notes", chunk_stop - chunk_start):
+            records = []
+            for row in range(chunk_start, chunk_stop):
+                base_idx = row % len(base_notes)
+                base_note = base_notes[base_idx]
+                if dedup is not None:
+                    note_text = dedup.diversify(functools.partial(variator.vary, base_idx), base_idx)
+                else:
+                    note_text = variator.vary(base_idx)
+
+                records.append({
+                    "patient_id": choose_patient(patient_ids),
+                    "note_date": DATES.sample(),
+                    "provider_id": random.choice(PROVIDER_IDS),
+                    "note_type": base_note["note_type"],
+                    "note_text": note_text
+                })
+            random.shuffle(records)
+            cluster_by_patient(records, patient_ids)
+
+        with METRICS.stage("build_dataframe", "notes", len(records)):
+            df = pd.DataFrame(records)
+        yield df
+
+
+def iter_counter_chunks(dataset, start, size, chunk_size, seed=SEED, patient_ids=None, errors=OBVIOUS_ERRORS,
+                        num_rows=None):
+    """Yield rows start..start+size of a dataset from the counter-based engine, chunk_size rows at a time.
+
+    num_rows is the size of the whole dataset, which decides where the planted lab errors go.
+    """
+    for chunk_start in range(start, start + size, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, start + size)
+        if dataset == "patients":
+            yield generate_patient_demographics_range(chunk_start, chunk_stop, seed)
+        elif dataset == "labs":
+            yield generate_lab_results_range(chunk_start, chunk_stop, patient_ids, seed, errors, num_rows)
+        else:
+            yield generate_clinical_notes_range(chunk_start, chunk_stop, patient_ids, seed)
+
+
+def iter_dataset_chunks(dataset, start, size, chunk_size, engine="python", rng=None, patient_ids=None,
+                        errors=OBVIOUS_ERRORS, base_notes_df=None, seed=SEED, num_rows=None, markov_model=None,
+                        dedup=None):
+    """Dispatch to the chunk iterator for one dataset ("patients", "labs" or "notes") over rows start..start+size."""
+    if engine == "counter" and base_notes_df is None:
+        return iter_counter_chunks(dataset, start, size, chunk_size, seed, patient_ids, errors, num_rows)
+    if dataset == "patients":
+        return iter_patient_demographics(size, chunk_size, engine, rng, start=start)
+    if dataset == "labs":
+        return iter_lab_results(size, patient_ids, chunk_size, engine, rng, errors=errors)
+    if base_notes_df is not None:
+        return iter_expanded_notes(base_notes_df, size, patient_ids, chunk_size, start=start, dedup=dedup)
+    if markov_model is not None:
+        return iter_markov_notes(markov_model, size, patient_ids, chunk_size, rng)
+    return iter_clinical_notes_template(size, patient_ids, chunk_size, engine, rng)
+
+
+def write_chunks(chunks, path, dataset, count_columns=(), output=None, expected_rows=None, stats=None):
+    """Append each DataFrame chunk to the output file as it is produced.
+
+    Returns the total row count and running value counts for count_columns, so callers can print
+    summaries without holding the dataset in memory. output holds DatasetWriter options, or
+    PartitionedWriter options if it has partition_by, in which case counts also holds the rows per
+    partition under that name. With expected_rows, rows/sec and an ETA are reported as chunks complete.
+    A DatasetStats passed as stats is updated with every chunk. Lab results also count the rows
+    carrying a planted error, by test name, under "planted_errors".
+    """
+    total = 0
+    counts = {col: pd.Series(dtype="int64") for col in count_columns}
+    if dataset == "labs":
+        counts["planted_errors"] = pd.Series(dtype="int64")
+    progress = METRICS.progress(dataset, expected_rows) if expected_rows else None
+    with open_writer(path, dataset, output or {}) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+            total += len(chunk)
+            for col in count_columns:
+                counts[col] = counts[col].add(chunk[col].value_counts(), fill_value=0).astype("int64")
+            if dataset == "labs":
+                planted = planted_errors(chunk)["test_name"].value_counts()
+                counts["planted_errors"] = counts["planted_errors"].add(planted, fill_value=0).astype("int64")
+            if stats is not None:
+                with METRICS.stage("stats", dataset, len(chunk)):
+                    stats.update(chunk)
+            if progress is not None:
+                progress.update(total)
+    if isinstance(writer, PartitionedWriter):
+        counts[writer.partition_by] = pd.Series(writer.rows, dtype="int64")
+    return total, counts
+
+
+def dataset_output(dataset, path, args, append=False, part="part"):
+    """open_writer options for dataset at path; drops an earlier run's partitions unless appending."""
+    if args.sink:
+        return {"sink": args.sink}
+    output = output_options(args)
+    partition_by = partitioning(dataset, args)
+    if not partition_by:
+        return dict(output, append=append)
+    if not append:
+        reset_partitions(path)
+    return dict(output, partition_by=partition_by, part=f"{part}-0000")
+
+
+def write_output(chunks, dataset, path, args, count_columns=(), append=False, part="part", expected_rows=None,
+                 stats=None):
+    """write_chunks with the output options from the command line.
+
+    Partitioned datasets (--partition-by) first drop the partitions of an earlier run, or with
+    append=True add <part>-0000 files next to them, and get their manifest updated. Otherwise
+    append=True adds the rows to the end of the file at path.
+    """
+    partition_by = partitioning(dataset, args)
+    output = dataset_output(dataset, path, args, append, part)
+    total, counts = write_chunks(chunks, path, dataset, count_columns, output, expected_rows, stats)
+    if partition_by:
+        write_partition_manifest(path, dataset, partition_by, args.format, counts.pop(partition_by), merge=append)
+    return total, counts
+
+
+# ============================================
+# Sharded (multi-process) generation
+# ============================================
+def dataset_seed_seqs(seed):
+    """Independent SeedSequences for the patients, labs and notes datasets, derived from the master seed."""
+    return dict(zip(["patients", "labs", "notes"], np.random.SeedSequence(seed).spawn(3)))
+
+
+def seed_shard(seed_seq):
+    """Seed random for this process and return a numpy Generator, both from one SeedSequence."""
+    state = int(seed_seq.generate_state(1)[0])
+    random.seed(state)
+    DATES.seed(state)
+    return np.random.default_rng(seed_seq)
+
+
+def write_shard(dataset, path, start, size, seed_seq, count_columns, output, options, dates, metrics, stats=None):
+    """Process pool entry point: generate one shard of a dataset into its own part file.
+
+    Returns the row count, value counts, the shard's stage totals and its DatasetStats (if an empty
+    one was passed in) for the parent's summary.
+    """
+    configure_dates(dates)
+    configure_metrics(metrics)
+    rng = seed_shard(seed_seq)
+    chunks = iter_dataset_chunks(dataset, start, size, rng=rng, **options)
+    total, counts = write_chunks(chunks, path, dataset, count_columns, output, stats=stats)
+    if options.get("dedup") is not None:
+        counts.update(options["dedup"].counts())
+    metrics.close(report=False)
+    return total, counts, metrics.totals, stats
+
+
+def write_dataset(dataset, path, num_rows, args, seed_seq, count_columns=(), errors=OBVIOUS_ERRORS, start=0,
+                  append=False, part="part", stats=None, **options):
+    """Generate one dataset to path, in-process or as shards across a process pool.
+
+    With --workers > 1 the rows are cut into --shard-size shards, each seeded from its own child of
+    seed_seq, written to part files and concatenated in shard order. The output therefore only
+    depends on the seed and shard size, not on how the pool schedules the shards. start is the
+    global index of the first row (see --append); append adds the rows to the end of path.
+
+    With --partition-by, path is the partition directory and each shard writes its own
+    <part>-NNNN file into every partition it touches, so there is nothing to concatenate.
+
+    stats, a DatasetStats, is updated with the new rows; shards summarize their own rows and the
+    parent merges them.
+    """
+    options = dict(options, chunk_size=args.chunk_size or args.shard_size, engine=args.engine, seed=args.seed,
+                   num_rows=start + num_rows)
+    output = output_options(args)
+    if args.sink:
+        # Shards hand their rows to the database loader as uncompressed Arrow IPC, whatever --format says
+        output = dict(output, fmt="arrow", compression=None)
+    partition_by = partitioning(dataset, args)
+
+    if args.workers <= 1:
+        rng = np.random.default_rng(seed_seq) if args.engine == "numpy" else None
+        chunks = iter_dataset_chunks(dataset, start, num_rows, rng=rng, errors=errors, **options)
+        total, counts = write_output(chunks, dataset, path, args, count_columns, append, part, expected_rows=num_rows,
+                                     stats=stats)
+        if options.get("dedup") is not None:
+            counts.update(options["dedup"].counts())
+        return total, counts
+
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    shard_starts = list(range(start, start + num_rows, args.shard_size))
+    shard_seqs = seed_seq.spawn(len(shard_starts))
+
+    # Planted lab errors land in random shards, decided up front from the dataset's own seed
+    if dataset != "labs":
+        errors = []
+    error_rows = start + np.random.default_rng(seed_seq).choice(num_rows, min(len(errors), num_rows), replace=False)
+
+    total = 0
+    counts = {col: pd.Series(dtype="int64") for col in count_columns}
+    if partition_by and not append:
+        reset_partitions(path)
+    if partition_by:
+        shard_dirs = contextlib.nullcontext(None)
+    else:
+        shard_dirs = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path)))
+    with shard_dirs as shard_dir:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = []
+            for shard, (shard_start, shard_seq) in enumerate(zip(shard_starts, shard_seqs)):
+                size = min(args.shard_size, start + num_rows - shard_start)
+                shard_errors = [e for e, row in zip(errors, error_rows) if shard_start <= row < shard_start + size]
+                if args.engine == "counter":
+                    shard_errors = errors  # placed by row index (lab_error_rows), not per shard
+                if partition_by:
+                    part_path = path
+                    shard_output = dict(output, partition_by=partition_by, part=f"{part}-{shard:04d}")
+                else:
+                    part_path = os.path.join(shard_dir, f"part-{shard:05d}.{output['fmt']}")
+                    shard_output = output
+                futures.append((part_path, pool.submit(
+                    write_shard, dataset, part_path, shard_start, size, shard_seq, count_columns, shard_output,
+                    dict(options, errors=shard_errors), DATES, METRICS,
+                    DatasetStats(dataset) if stats is not None else None)))
+
+            # Concatenate part files in shard order
+            progress = METRICS.progress(dataset, num_rows)
+            writer = None if partition_by else open_writer(path, dataset, dataset_output(dataset, path, args, append))
+            with writer or contextlib.nullcontext():
+                for part_path, future in futures:
+                    rows, shard_counts, shard_totals, shard_stats = future.result()
+                    total += rows
+                    if stats is not None:
+                        stats.merge(shard_stats)
+                    for col, shard_count in shard_counts.items():
+                        count = counts.get(col, pd.Series(dtype="int64"))
+                        counts[col] = count.add(shard_count, fill_value=0).astype("int64")
+                    METRICS.merge(shard_totals)
+                    if writer is not None:
+                        with METRICS.stage("merge", dataset, rows):
+                            writer.append_part(part_path)
+                        os.remove(part_path)
+                    progress.update(total)
+
+    if partition_by:
+        write_partition_manifest(path, dataset, partition_by, args.format, counts.pop(partition_by), merge=append)
+    return total, counts
+
+
+def generate_streaming(args):
+    """Chunked/sharded counterpart of main(): datasets are written a chunk (or shard) at a time.
+
+    Lab results and notes only see a PatientIdRange, never the demographics DataFrame.
+    """
+    seed_seqs = dataset_seed_seqs(args.seed)
+    if args.workers > 1:
+        print(f"Generating clinical trial datasets with {args.workers} workers "
+              f"(shards of {args.shard_size:,} rows)...", flush=True)
+    else:
+        print(f"Generating clinical trial datasets in chunks of {args.chunk_size or args.shard_size:,} rows...",
+              flush=True)
+
+    paths = {dataset: output_path(dataset, args) for dataset in DATASET_FILES}
+    stats = {dataset: new_dataset_stats(dataset, args) for dataset in DATASET_FILES}
+
+    print(f"\n1. Generating patient_demographics ({args.num_patients:,} records)...", flush=True)
+    num_patients, counts = write_dataset(
+        "patients", paths["patients"], args.num_patients, args, seed_seqs["patients"],
+        count_columns=("age", "enrollment_success", "contraindication_count"), stats=stats["patients"])
+    record_dataset_meta("patients", args, num_patients, paths["patients"])
+    save_dataset_stats(stats["patients"])
+    patient_ids = load_patient_activity(PatientIdRange(0, num_patients), [paths["patients"]], args)
+    ages = counts["age"]
+    median = stats["patients"].summary("age")["p50"] if stats["patients"] is not None else counts_median(ages)
+    print(f"   Saved: {paths['patients']}")
+    print(f"   Age distribution: mean={(ages.index * ages).sum() / ages.sum():.1f}, median={float(median)}")
+    print(f"   Enrollment success rate: {counts['enrollment_success'].get(1, 0) / num_patients * 100:.1f}%")
+    print(f"   Contraindication counts: {counts['contraindication_count'].sort_index().to_dict()}")
+
+    print(f"\n2. Generating lab_results_2025 ({args.num_lab_results:,} records)...")
+    num_labs, counts = write_dataset(
+        "labs", paths["labs"], args.num_lab_results, args, seed_seqs["labs"],
+        count_columns=("flag",), patient_ids=patient_ids, stats=stats["labs"])
+    record_dataset_meta("labs", args, num_labs, paths["labs"])
+    save_dataset_stats(stats["labs"])
+    print(f"   Saved: {paths['labs']}")
+    print(f"   Flag distribution: {counts['flag'].to_dict()}")
+    print(f"   Planted {counts['planted_errors'].sum()} obvious data entry errors for manual correction")
+
+    print(f"\n3. Generating clinical_notes_raw ({args.num_notes:,} records)...")
+    # The Claude prompts only need a sample of patients for context, so read back the head of the file
+    if args.expand_notes or args.use_claude:
+        context_df = read_dataset_head(paths["patients"], args.sink or args.format, 100_000)
+    base_notes_df = None
+    notes_df = None
+    model = None
+    if args.expand_notes:
+        print(f"   Step 1: Generating {args.base_notes:,} base notes with Claude API...")
+        base_notes_df = generate_clinical_notes_with_claude(args.base_notes, context_df, **claude_options(args))
+        if base_notes_df is None:
+            print("   ERROR: Claude API failed. Falling back to template-based generation...")
+        else:
+            print(f"   Step 2: Expanding to {args.num_notes:,} notes using variations...")
+    elif args.use_claude:
+        print("   Using Claude API for note generation...")
+        notes_df = generate_clinical_notes_with_claude(args.num_notes, context_df, **claude_options(args))
+        if notes_df is None:
+            print("   Falling back to template-based generation...")
+    elif args.notes_engine == "markov":
+        print("   Using the Markov note synthesizer...")
+        model = markov_model(args)
+    else:
+        print("   Using template-based generation (use --use-claude or --expand-notes for AI-generated notes)")
+
+    if notes_df is not None:
+        num_notes, counts = write_output([notes_df], "notes", paths["notes"], args, ("note_type",), stats=stats["notes"])
+    else:
+        num_notes, counts = write_dataset(
+            "notes", paths["notes"], args.num_notes, args, seed_seqs["notes"],
+            count_columns=("note_type",), patient_ids=patient_ids, base_notes_df=base_notes_df, markov_model=model,
+            dedup=note_deduplicator(args) if base_notes_df is not None else None, stats=stats["notes"])
+    record_dataset_meta("notes", args, num_notes, paths["notes"])
+    save_dataset_stats(stats["notes"])
+    print(f"   Saved: {paths['notes']}")
+    print(f"   Note types: {counts['note_type'].to_dict()}")
+    print_note_diversity(counts, args.dedup_threshold)
+
+    print("\n✓ All datasets generated successfully!")
+    print(f"\nSummary:")
+    print(f"  - {paths['patients']}: {num_patients:,} records")
+    print(f"  - {paths['labs']}: {num_labs:,} records")
+    print(f"  - {paths['notes']}: {num_notes:,} records")
+
+
+# ============================================
+# Fused (single-pass) generation
+# ============================================
+FUSED_BLOCK_SIZE = 100_000  # patients per block when --chunk-size is not given
+# Templates that talk about contraindications; only patients who have some get them
+CONTRAINDICATION_TEMPLATES = [t for t, template in enumerate(NOTE_TEMPLATES) if "contraindicat" in template.lower()]
+NOTE_GENDERS = {"Female": "F", "Male": "M", "Non-binary": "NB"}
+
+
+# Cohort mean of activity_multiplier (contraindications ~ CONTRAINDICATION_WEIGHTS, age ~ N(58, 12))
+MEAN_ACTIVITY_MULTIPLIER = ((1.0 + ACTIVITY_CONTRAINDICATION_EFFECT * np.dot(range(len(CONTRAINDICATION_WEIGHTS)),
+                                                                             CONTRAINDICATION_WEIGHTS))
+                            * np.exp(ACTIVITY_AGE_EFFECT ** 2 / 2))
+
+
+class RowAllocator:
+    """Hands out a fixed total of rows to patients, block by block, in proportion to expected counts.
+
+    Counts are the systematic rounding of the running cumulative expectation, so they only need the
+    current block. Rows beyond the total are cut off, and whatever is left after the last block is
+    spread over that block's patients, so the dataset always has exactly total rows.
+    """
+
+    def __init__(self, total, rng):
+        self.remaining = total
+        self.position = rng.random()
+
+    def allocate(self, expected, rng, last=False):
+        cumulative = self.position + np.cumsum(expected)
+        counts = np.diff(np.floor(np.concatenate([[self.position], cumulative]))).astype(np.int64)
+        self.position = cumulative[-1] if len(cumulative) else self.position
+        counts = np.diff(np.minimum(np.concatenate([[0], np.cumsum(counts)]), self.remaining))
+        self.remaining -= int(counts.sum())
+        if last and self.remaining and len(counts):
+            counts += rng.multinomial(self.remaining, expected / expected.sum())
+            self.remaining = 0
+        return counts
+
+
+def lab_abnormal_prob(ages, contraindications):
+    """Chance that a patient's lab result is out of range: higher with contraindications and age (~0.15 on average)."""
+    return np.clip(0.09 + 0.07 * np.asarray(contraindications) + 0.003 * (np.asarray(ages) - 58), 0.02, 0.6)
+
+
+def contraindication_lists(rng, counts):
+    """One string per row listing counts[i] distinct contraindications, e.g. "sulfa allergy, renal impairment"."""
+    table = NOTE_FIELD_TABLES["contraindication"]
+    order = np.argsort(rng.random((len(counts), len(table))), axis=1)
+    values = np.empty(len(counts), dtype=object)
+    for count in np.unique(counts):
+        rows = np.flatnonzero(counts == count)
+        values[rows] = [", ".join(names) for names in table[order[rows, :max(count, 1)]]]
+    return values
+
+
+@timed("generate", "notes", rows_arg=lambda patients, codes, *args, **kwargs: len(codes))
+def generate_patient_notes(patients, codes, patient_ids, rng):
+    """Template notes for the patients at positions codes of the patients block, conditioned on them.
+
+    Notes carry the patient's own age and gender. Contraindication templates are only picked for
+    patients with contraindications, more often the more they have, and list that many.
+    """
+    n = len(codes)
+    ages = patients["age"].to_numpy()[codes]
+    contraindications = patients["contraindication_count"].to_numpy()[codes]
+    template_idx = np.empty(n, dtype=np.int64)
+    for count in np.unique(contraindications):
+        rows = np.flatnonzero(contraindications == count)
+        weights = np.ones(len(COMPILED_NOTE_TEMPLATES))
+        weights[CONTRAINDICATION_TEMPLATES] = count
+        template_idx[rows] = rng.choice(len(weights), len(rows), p=weights / weights.sum())
+
+    genders = patients["gender"].astype(str).map(NOTE_GENDERS).to_numpy()[codes]
+    patient_fields = {
+        "age": lambda rows: ages[rows].astype(str).astype(object),
+        "gender": lambda rows: genders[rows],
+        "contraindication": lambda rows: contraindication_lists(rng, contraindications[rows]),
+    }
+    note_text = np.empty(n, dtype=object)
+    for t, template in enumerate(COMPILED_NOTE_TEMPLATES):
+        rows = np.flatnonzero(template_idx == t)
+        columns = [patient_fields[field](rows) if field in patient_fields else sample_note_field(rng, field, len(rows))
+                   for field in template.fields]
+        note_text[rows] = template.render_many(columns)
+
+    with METRICS.stage("build_dataframe", "notes", n):
+        return pd.DataFrame({
+            "patient_id": take_patient_ids(patient_ids, codes),
+            "note_date": DATES.sample_array(rng, n),
+            "provider_id": pd.Categorical.from_codes(rng.integers(len(PROVIDER_IDS), size=n), PROVIDER_IDS),
+            "note_type": pd.Categorical.from_codes(rng.integers(len(NOTE_TYPES), size=n), NOTE_TYPES),
+            "note_text": note_text,
+        })
+
+
+def generate_fused(args):
+    """--fused: a single pass over the cohort that writes all three datasets at once.
+
+    Patients are generated a block at a time; each block's lab results and notes are generated
+    right away from the block's own rows (so a patient's rows sit together), with volumes and
+    content conditioned on the patient: more lab tests and notes, and more abnormal results, with
+    more contraindications and age; notes use the patient's age and gender and list their
+    contraindications. The three writers stay open for the whole pass.
+    """
+    block_size = args.chunk_size or FUSED_BLOCK_SIZE
+    print(f"Generating clinical trial datasets in one pass over the cohort "
+          f"(blocks of {block_size:,} patients)...", flush=True)
+    rngs = {dataset: np.random.default_rng(seq) for dataset, seq in dataset_seed_seqs(args.seed).items()}
+    paths = {dataset: output_path(dataset, args) for dataset in DATASET_FILES}
+    targets = {"labs": args.num_lab_results, "notes": args.num_notes}
+    allocators = {dataset: RowAllocator(total, rngs[dataset]) for dataset, total in targets.items()}
+    rates = {dataset: total / max(args.num_patients, 1) / MEAN_ACTIVITY_MULTIPLIER for dataset, total in targets.items()}
+    totals = dict.fromkeys(DATASET_FILES, 0)
+    stats = {dataset: new_dataset_stats(dataset, args) for dataset in DATASET_FILES}
+    counts = {"age": 0, "enrollment_success": 0, "planted_errors": 0, "flag": pd.Series(dtype="int64"),
+              "note_type": pd.Series(dtype="int64")}
+    # Planted lab errors go to rows drawn over the whole dataset, like the counter engine's
+    error_rows = lab_error_rows(args.seed, len(OBVIOUS_ERRORS), args.num_lab_results)
+
+    progress = METRICS.progress("patients", args.num_patients, unit="patients")
+    with contextlib.ExitStack() as stack:
+        writers = {dataset: stack.enter_context(open_writer(path, dataset, dataset_output(dataset, path, args)))
+                   for dataset, path in paths.items()}
+        for start in range(0, args.num_patients, block_size):
+            stop = min(start + block_size, args.num_patients)
+            last = stop == args.num_patients
+            patients = generate_patient_demographics(stop - start, "numpy", rngs["patients"], start=start)
+            patient_ids = PatientIdRange(start, stop)
+            ages = patients["age"].to_numpy()
+            contraindications = patients["contraindication_count"].to_numpy()
+            multiplier = activity_multiplier(ages, contraindications)
+
+            lab_codes = np.repeat(np.arange(len(patients)), allocators["labs"].allocate(
+                rates["labs"] * multiplier, rngs["labs"], last))
+            block_errors = [error for error, row in zip(OBVIOUS_ERRORS, error_rows)
+                            if totals["labs"] <= row < totals["labs"] + len(lab_codes)]
+            with METRICS.stage("generate", "labs", len(lab_codes)):
+                labs = generate_lab_results_numpy(
+                    len(lab_codes), patient_ids, rngs["labs"], block_errors, patient_codes=lab_codes,
+                    abnormal_prob=lab_abnormal_prob(ages[lab_codes], contraindications[lab_codes]))
+            note_codes = np.repeat(np.arange(len(patients)), allocators["notes"].allocate(
+                rates["notes"] * multiplier, rngs["notes"], last))
+            notes = generate_patient_notes(patients, note_codes, patient_ids, rngs["notes"])
+
+            for dataset, df in (("patients", patients), ("labs", labs), ("notes", notes)):
+                writers[dataset].write(df)
+                totals[dataset] += len(df)
+                if stats[dataset] is not None:
+                    with METRICS.stage("stats", dataset, len(df)):
+                        stats[dataset].update(df)
+            counts["age"] += int(ages.sum())
+            counts["enrollment_success"] += int(patients["enrollment_success"].sum())
+            counts["planted_errors"] += len(planted_errors(labs))
+            counts["flag"] = counts["flag"].add(labs["flag"].value_counts(), fill_value=0).astype("int64")
+            counts["note_type"] = counts["note_type"].add(notes["note_type"].value_counts(), fill_value=0).astype("int64")
+            progress.update(stop)
+
+    for dataset, path in paths.items():
+        if isinstance(writers[dataset], PartitionedWriter):
+            write_partition_manifest(path, dataset, args.partition_by, args.format, writers[dataset].rows)
+        record_dataset_meta(dataset, args, totals[dataset], path)
+        save_dataset_stats(stats[dataset])
+
+    num_patients = max(totals["patients"], 1)
+    print(f"\n   Patients: mean age {counts['age'] / num_patients:.1f}, "
+          f"enrollment success rate {counts['enrollment_success'] / num_patients * 100:.1f}%")
+    print(f"   Lab flag distribution: {counts['flag'].to_dict()}")
+    print(f"   Planted {counts['planted_errors']} obvious data entry errors for manual correction")
+    print(f"   Note types: {counts['note_type'].to_dict()}")
+    print("\n✓ All datasets generated successfully!")
+    print(f"\nSummary:")
+    for dataset, path in paths.items():
+        print(f"  - {path}: {totals[dataset]:,} records")
+
+
+# ============================================
+# Incremental (append) generation
+# ============================================
+# Run settings recorded in each dataset's metadata and restored by --append
+RUN_SETTINGS = ["seed", "engine", "format", "compression", "date_seasonality", "weekday_weights", "partition_by",
+                "patient_activity", "activity_skew", "cluster_patients"]
+APPEND_SPAWN_KEY = 2**32 - 1  # keeps append seed streams apart from the per-shard children
+
+
+def dataset_meta_path(dataset):
+    return f"{DATASET_FILES[dataset]}.meta.json"
+
+
+def new_dataset_meta(dataset, args, rows, path):
+    """Sidecar metadata for a freshly generated dataset: row count, files and the run settings."""
+    meta = {"dataset": dataset, "rows": rows, "files": [path], "appends": []}
+    meta.update({name: getattr(args, name) for name in RUN_SETTINGS})
+    return meta
+
+
+def record_dataset_meta(dataset, args, rows, path):
+    """Write dataset's sidecar if a later --append will need it, i.e. the run used settings other than the
+    defaults (args.write_meta); otherwise drop any stale one, and --append reads the data files instead."""
+    if args.write_meta:
+        save_dataset_meta(new_dataset_meta(dataset, args, rows, path))
+    elif os.path.exists(dataset_meta_path(dataset)):
+        os.remove(dataset_meta_path(dataset))
+
+
+def save_dataset_meta(meta):
+    path = dataset_meta_path(meta["dataset"])
+    meta = dict(meta, updated=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def count_dataset_rows(path, fmt):
+    """Row count of an output file: from the footer for parquet/arrow, a one-column scan for csv."""
+    if fmt == "csv":
+        return sum(len(chunk) for chunk in pd.read_csv(path, usecols=[0], chunksize=1_000_000))
+    import pyarrow as pa
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(path).metadata.num_rows
+    import pyarrow.ipc as ipc
+
+    with ipc.open_file(pa.memory_map(path)) as reader:
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+
+def last_patient_index(path, fmt):
+    """Index NNNNN of the last PT-2025-NNNNN in a patients file, reading only its tail."""
+    if fmt == "csv":
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 65536))
+            lines = [line for line in f.read().decode("utf-8").splitlines() if line.strip()]
+        last_id = lines[-1].split(",", 1)[0]
+    else:
+        import pyarrow as pa
+
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+
+            parquet_file = pq.ParquetFile(path)
+            column = parquet_file.read_row_group(parquet_file.num_row_groups - 1, columns=["patient_id"])["patient_id"]
+        else:
+            import pyarrow.ipc as ipc
+
+            with ipc.open_file(pa.memory_map(path)) as reader:
+                column = reader.get_batch(reader.num_record_batches - 1).column("patient_id")
+        last_id = column[len(column) - 1].as_py()
+    return int(last_id.rsplit("-", 1)[1])
+
+
+def read_dataset_meta(dataset, fmt):
+    """Metadata of an existing output: its sidecar, or (for default-settings runs, which write none)
+    the row count recovered from the file itself. None if the dataset has not been generated."""
+    path = dataset_meta_path(dataset)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    data_path = dataset_path(dataset, fmt)
+    if not os.path.exists(data_path):
+        return None
+    return {"dataset": dataset, "rows": count_dataset_rows(data_path, fmt), "files": [data_path], "appends": []}
+
+
+def recorded_run_settings(defaults):
+    """The RUN_SETTINGS each dataset's outputs were made with: {dataset: settings}, from its sidecar,
+    or the defaults for a dataset without one (default-settings runs write none)."""
+    recorded = {}
+    for dataset in DATASET_FILES:
+        settings = dict(defaults)
+        if os.path.exists(dataset_meta_path(dataset)):
+            with open(dataset_meta_path(dataset)) as f:
+                meta = json.load(f)
+            settings.update((name, meta[name]) for name in RUN_SETTINGS if name in meta)
+        recorded[dataset] = settings
+    return recorded
+
+
+def run_settings_disagreements(recorded):
+    """Settings the datasets in recorded_run_settings() disagree on, as "name (file: value, ...)" strings."""
+    disagreements = []
+    for name in RUN_SETTINGS:
+        values = {dataset: settings[name] for dataset, settings in recorded.items()}
+        if len({json.dumps(value) for value in values.values()}) > 1:
+            sources = [f"{DATASET_FILES[dataset]}{'' if os.path.exists(dataset_meta_path(dataset)) else ' (no sidecar)'}"
+                       f": {value}" for dataset, value in values.items()]
+            disagreements.append(f"{name} ({', '.join(sources)})")
+    return disagreements
+
+
+def restore_run_settings(args, given, settings):
+    """For --append, reuse the seed, engine, format and date settings the existing outputs were made with.
+
+    settings are the outputs' recorded settings (see recorded_run_settings). given holds the settings
+    passed on the command line (None where not passed). Returns those that contradict the existing
+    outputs, as "--flag value (outputs: value)" strings; they are not applied.
+    """
+    conflicts = []
+    for name, value in settings.items():
+        passed = getattr(given, name)
+        if passed is not None and passed != value:
+            conflicts.append(f"--{name.replace('_', '-')} {passed} (outputs: {value})")
+        else:
+            setattr(args, name, value)
+    return conflicts
+
+
+def append_seed_seq(seed, dataset, start):
+    """SeedSequence for rows appended to dataset from row start on.
+
+    Keyed on (seed, dataset, first new row), so replaying the same appends reproduces the same
+    rows, and each delta draws a stream independent of the original rows and of other deltas.
+    """
+    parent = dataset_seed_seqs(seed)[dataset]
+    return np.random.SeedSequence(parent.entropy, spawn_key=parent.spawn_key + (APPEND_SPAWN_KEY, start))
+
+
+def partition_path(dataset, fmt, part):
+    return f"{DATASET_FILES[dataset]}.part-{part:04d}.{fmt}"
+
+
+def append_dataset(dataset, meta, start, num_rows, args, count_columns=(), chunks=None, **options):
+    """Generate num_rows new rows of dataset starting at global row start and add them to the output.
+
+    Rows go to the end of the last file (--append-to file, csv only) or to a new partition file.
+    Date-partitioned datasets (--partition-by) always get new append-NNNN files in their partition
+    directories. Planted lab errors are not repeated. Returns (path, rows written, value counts)
+    and records the delta in the dataset's metadata, and in its statistics sidecar if it has one.
+    """
+    part = "part"
+    if partitioning(dataset, args):
+        in_place = True
+        path = meta["files"][-1]
+        part = f"append-{len(meta['appends']) + 1:04d}"
+    else:
+        in_place = args.append_to == "file"
+        path = meta["files"][-1] if in_place else partition_path(dataset, args.format, len(meta["files"]))
+    seed_seq = append_seed_seq(args.seed, dataset, start)
+    seed_shard(seed_seq)  # the python engine draws from the random module
+    # A sidecar is kept in step with its data; without one, stats of the new rows alone would be misleading
+    stats = read_dataset_stats(dataset)
+    if chunks is not None:
+        rows, counts = write_output(chunks, dataset, path, args, count_columns, append=in_place, part=part,
+                                    stats=stats)
+    else:
+        rows, counts = write_dataset(dataset, path, num_rows, args, seed_seq, count_columns, errors=[],
+                                     start=start, append=in_place, part=part, stats=stats, **options)
+
+    if not in_place:
+        meta["files"].append(path)
+    meta["rows"] = meta["rows"] + rows
+    meta["appends"].append({"start": start, "rows": rows, "path": path, "time": time.strftime("%Y-%m-%dT%H:%M:%S")})
+    meta.update({name: getattr(args, name) for name in RUN_SETTINGS})
+    save_dataset_meta(meta)
+    save_dataset_stats(stats)
+    return path, rows, counts
+
+
+def generate_append(args):
+    """--append: extend the existing outputs with new rows instead of regenerating them.
+
+    Only metadata is read: each dataset's .meta.json sidecar (or the parquet/arrow footer, or a
+    one-column csv scan, for default-settings outputs without one) for its row count, and the tail of the patients file
+    for the last patient ID. New lab results and notes reference all patients, old and new.
+    """
+    metas = {dataset: read_dataset_meta(dataset, args.format) for dataset in DATASET_FILES}
+    missing = [DATASET_FILES[dataset] for dataset, meta in metas.items() if meta is None]
+    if missing:
+        print(f"ERROR: no existing {args.format} output for {', '.join(missing)}; run once without --append first.")
+        return
+
+    where = "in place" if args.append_to == "file" else "as new partition files"
+    print(f"Appending to clinical trial datasets {where} (seed {args.seed}, {args.engine} engine)...", flush=True)
+
+    next_patient = last_patient_index(metas["patients"]["files"][-1], args.format) + 1
+    if next_patient != metas["patients"]["rows"]:
+        print(f"   WARNING: patients metadata says {metas['patients']['rows']:,} rows, "
+              f"but the last patient ID is PT-2025-{next_patient - 1:05d}; continuing from the ID")
+        metas["patients"]["rows"] = next_patient
+
+    summary = []
+    print(f"\n1. Appending {args.num_patients:,} rows to patient_demographics...", flush=True)
+    if args.num_patients:
+        path, rows, counts = append_dataset("patients", metas["patients"], next_patient, args.num_patients, args,
+                                            count_columns=("age", "enrollment_success"))
+        ages = counts["age"]
+        print(f"   Saved: {path} (PT-2025-{next_patient:05d} .. PT-2025-{next_patient + rows - 1:05d})")
+        print(f"   New rows: age mean={(ages.index * ages).sum() / ages.sum():.1f}, "
+              f"enrollment success rate {counts['enrollment_success'].get(1, 0) / rows * 100:.1f}%")
+        summary.append((path, rows, metas["patients"]["rows"]))
+    patient_ids = load_patient_activity(PatientIdRange(0, metas["patients"]["rows"]), metas["patients"]["files"], args)
+
+    print(f"\n2. Appending {args.num_lab_results:,} rows to lab_results_2025...")
+    if args.num_lab_results:
+        path, rows, counts = append_dataset("labs", metas["labs"], metas["labs"]["rows"], args.num_lab_results, args,
+                                            count_columns=("flag",), patient_ids=patient_ids)
+        print(f"   Saved: {path}")
+        print(f"   New rows flag distribution: {counts['flag'].to_dict()}")
+        summary.append((path, rows, metas["labs"]["rows"]))
+
+    print(f"\n3. Appending {args.num_notes:,} rows to clinical_notes_raw...")
+    if args.num_notes:
+        start = metas["notes"]["rows"]
+        chunks = None
+        base_notes_df = None
+        if args.expand_notes or args.use_claude:
+            context_df = read_dataset_head(metas["patients"]["files"][0], args.format, 100_000)
+            num_claude = args.base_notes if args.expand_notes else args.num_notes
+            claude_df = generate_clinical_notes_with_claude(num_claude, context_df, **claude_options(args))
+            if claude_df is None:
+                print("   Falling back to template-based generation...")
+            elif args.expand_notes:
+                base_notes_df = claude_df
+            else:
+                chunks = [claude_df]
+        model = None
+        if args.notes_engine == "markov" and chunks is None and base_notes_df is None:
+            model = markov_model(args)
+        path, rows, counts = append_dataset("notes", metas["notes"], start, args.num_notes, args,
+                                            count_columns=("note_type",), chunks=chunks, patient_ids=patient_ids,
+                                            base_notes_df=base_notes_df, markov_model=model,
+                                            dedup=note_deduplicator(args) if base_notes_df is not None else None)
+        print(f"   Saved: {path}")
+        print(f"   New rows note types: {counts['note_type'].to_dict()}")
+        print_note_diversity(counts, args.dedup_threshold)
+        summary.append((path, rows, metas["notes"]["rows"]))
+
+    print("\n✓ Append complete!")
+    print(f"\nSummary:")
+    for path, rows, total in summary:
+        print(f"  - {path}: +{rows:,} records ({total:,} in dataset)")
+
+
+# ============================================
+# Main
+# ============================================
+def generate_in_memory(args):
+    """Generate each dataset as one DataFrame and write it out (the default, non-chunked path)."""
     print("Generating clinical trial datasets...", flush=True)
 
     # Generate patient demographics first (we need patient IDs for other datasets)
     print(f"\n1. Generating patient_demographics ({args.num_patients:,} records)...", flush=True)
-    patient_df = generate_patient_demographics(args.num_patients)
-    patient_ids = patient_df["patient_id"].tolist()
-    patient_df.to_csv("patient_demographics.csv", index=False)
-    print(f"   Saved: patient_demographics.csv")
+    seed_seqs = dataset_seed_seqs(args.seed)
+    patient_df = generate_patient_demographics(args.num_patients, engine=args.engine,
+                                               rng=np.random.default_rng(seed_seqs["patients"]))
+    patient_ids = patient_activity(patient_df["patient_id"].tolist(), patient_df["age"],
+                                   patient_df["contraindication_count"], args)
+    stats = new_dataset_stats("patients", args)
+    patients_path = write_dataframe(patient_df, "patients", args, stats)
+    record_dataset_meta("patients", args, len(patient_df), patients_path)
+    save_dataset_stats(stats)
+    print(f"   Saved: {patients_path}")
     print(f"   Age distribution: mean={patient_df['age'].mean():.1f}, median={patient_df['age'].median()}")
     print(f"   Enrollment success rate: {patient_df['enrollment_success'].mean()*100:.1f}%")
     print(f"   Contraindication counts: {patient_df['contraindication_count'].value_counts().sort_index().to_dict()}")
 
     # Generate lab results
     print(f"\n2. Generating lab_results_2025 ({args.num_lab_results:,} records)...")
-    lab_df = generate_lab_results(args.num_lab_results, patient_ids)
-    lab_df.to_csv("lab_results_2025.csv", index=False)
-    print(f"   Saved: lab_results_2025.csv")
+    lab_df = generate_lab_results(args.num_lab_results, patient_ids, engine=args.engine,
+                                  rng=np.random.default_rng(seed_seqs["labs"]))
+    stats = new_dataset_stats("labs", args)
+    labs_path = write_dataframe(lab_df, "labs", args, stats)
+    record_dataset_meta("labs", args, len(lab_df), labs_path)
+    save_dataset_stats(stats)
+    print(f"   Saved: {labs_path}")
     print(f"   Flag distribution: {lab_df['flag'].value_counts().to_dict()}")
     # Show the planted obvious errors
     obvious = lab_df[lab_df['result_value'].isin([150.0, 140.0, 9500.0])]
@@ -674,33 +4233,274 @@ def main():
     if args.expand_notes:
         # Two-step approach: generate base notes with Claude, then expand with variations
         print(f"   Step 1: Generating {args.base_notes:,} base notes with Claude API...")
-        base_notes_df = generate_clinical_notes_with_claude(args.base_notes, patient_df)
+        base_notes_df = generate_clinical_notes_with_claude(args.base_notes, patient_df, **claude_options(args))
         if base_notes_df is None:
             print("   ERROR: Claude API failed. Falling back to template-based generation...")
-            notes_df = generate_clinical_notes_template(args.num_notes, patient_ids)
+            notes_df = generate_clinical_notes_template(args.num_notes, patient_ids, engine=args.engine,
+                                                        rng=np.random.default_rng(seed_seqs["notes"]))
         else:
             print(f"   Step 2: Expanding to {args.num_notes:,} notes using variations...")
-            notes_df = expand_notes_with_variations(base_notes_df, args.num_notes, patient_ids)
+            dedup = note_deduplicator(args)
+            notes_df = expand_notes_with_variations(base_notes_df, args.num_notes, patient_ids, dedup=dedup)
             print(f"   Expansion complete: {args.base_notes:,} base notes -> {len(notes_df):,} total notes")
+            if dedup is not None:
+                print_note_diversity(dedup.counts(), args.dedup_threshold)
     elif args.use_claude:
         print("   Using Claude API for note generation...")
-        notes_df = generate_clinical_notes_with_claude(args.num_notes, patient_df)
+        notes_df = generate_clinical_notes_with_claude(args.num_notes, patient_df, **claude_options(args))
         if notes_df is None:
             print("   Falling back to template-based generation...")
-            notes_df = generate_clinical_notes_template(args.num_notes, patient_ids)
+            notes_df = generate_clinical_notes_template(args.num_notes, patient_ids, engine=args.engine,
+                                                        rng=np.random.default_rng(seed_seqs["notes"]))
+    elif args.notes_engine == "markov":
+        print("   Using the Markov note synthesizer...")
+        notes_df = generate_clinical_notes_markov(args.num_notes, patient_ids, markov_model(args),
+                                                  rng=np.random.default_rng(seed_seqs["notes"]))
     else:
         print("   Using template-based generation (use --use-claude or --expand-notes for AI-generated notes)")
-        notes_df = generate_clinical_notes_template(args.num_notes, patient_ids)
+        notes_df = generate_clinical_notes_template(args.num_notes, patient_ids, engine=args.engine,
+                                                        rng=np.random.default_rng(seed_seqs["notes"]))
 
-    notes_df.to_csv("clinical_notes_raw.csv", index=False)
-    print(f"   Saved: clinical_notes_raw.csv")
+    stats = new_dataset_stats("notes", args)
+    notes_path = write_dataframe(notes_df, "notes", args, stats)
+    record_dataset_meta("notes", args, len(notes_df), notes_path)
+    save_dataset_stats(stats)
+    print(f"   Saved: {notes_path}")
     print(f"   Note types: {notes_df['note_type'].value_counts().to_dict()}")
 
     print("\n✓ All datasets generated successfully!")
     print(f"\nSummary:")
-    print(f"  - patient_demographics.csv: {len(patient_df):,} records")
-    print(f"  - lab_results_2025.csv: {len(lab_df):,} records")
-    print(f"  - clinical_notes_raw.csv: {len(notes_df):,} records")
+    print(f"  - {patients_path}: {len(patient_df):,} records")
+    print(f"  - {labs_path}: {len(lab_df):,} records")
+    print(f"  - {notes_path}: {len(notes_df):,} records")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate clinical trial demo datasets")
+    parser.add_argument("--use-claude", action="store_true",
+                        help="Use Claude API for clinical note generation (requires ANTHROPIC_API_KEY)")
+    parser.add_argument("--expand-notes", action="store_true",
+                        help="Generate base notes with Claude then expand using variations (recommended)")
+    parser.add_argument("--base-notes", type=int, default=2000,
+                        help="Number of base notes to generate with Claude when using --expand-notes (default: 2000)")
+    parser.add_argument("--num-notes", type=int, default=None,
+                        help=f"Number of clinical notes to generate (default: {NUM_CLINICAL_NOTES}; 0 with --append)")
+    parser.add_argument("--num-patients", type=int, default=None,
+                        help=f"Number of patients to generate (default: {NUM_PATIENTS}; 0 with --append)")
+    parser.add_argument("--num-lab-results", type=int, default=None,
+                        help=f"Number of lab results to generate (default: {NUM_LAB_RESULTS}; 0 with --append)")
+    parser.add_argument("--engine", choices=["python", "numpy", "counter"], default="python",
+                        help="Row-by-row python generator, vectorized numpy engine for large cohorts, or counter-based "
+                             "engine where every row depends only on --seed and its index (default: python)")
+    parser.add_argument("--dedup-threshold", type=float, default=None,
+                        help="With --expand-notes, re-roll variants whose estimated Jaccard similarity (word 3-grams, "
+                             "MinHash/LSH) to an earlier note reaches this, e.g. 0.9, and report note diversity")
+    parser.add_argument("--dedup-retries", type=int, default=DEDUP_RETRIES,
+                        help=f"Re-rolls per note before a near-duplicate is kept (default: {DEDUP_RETRIES})")
+    parser.add_argument("--notes-engine", choices=["template", "markov"], default="template",
+                        help="Offline note generator: fill-in templates, or an n-gram model trained per note type "
+                             "on the example notes, template notes and --markov-corpus (default: template)")
+    parser.add_argument("--markov-order", type=int, default=MARKOV_ORDER,
+                        help=f"Tokens of context for --notes-engine markov (default: {MARKOV_ORDER})")
+    parser.add_argument("--markov-corpus", default=None,
+                        help="Extra training notes for --notes-engine markov: a notes csv/parquet/arrow file from an "
+                             "earlier --use-claude run, or a --journal JSONL file")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="Stream each dataset to disk in chunks of this many rows (bounded memory)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Generate datasets as shards across this many processes (default: 1)")
+    parser.add_argument("--shard-size", type=int, default=1_000_000,
+                        help="Rows per shard when --workers > 1 (default: 1,000,000)")
+    parser.add_argument("--fused", action="store_true",
+                        help="Generate all three datasets in one pass over the cohort (numpy engine), with each "
+                             "patient's lab results and notes written next to them and conditioned on the patient")
+    parser.add_argument("--append", action="store_true",
+                        help="Add --num-* new rows to the existing outputs instead of regenerating them "
+                             "(seed, engine, format and date settings are taken from the existing outputs' "
+                             "<name>.meta.json; passing different ones is an error)")
+    parser.add_argument("--append-to", choices=["file", "partition"], default=None,
+                        help="Append in place (csv only) or write new <name>.part-NNNN files "
+                             "(default: file for csv, partition otherwise)")
+    parser.add_argument("--seed", type=int, default=SEED,
+                        help=f"Master random seed (default: {SEED})")
+    parser.add_argument("--date-seasonality", type=float, default=0.0,
+                        help="Relative amplitude of a yearly visit cycle peaking in winter, e.g. 0.3 (default: 0, uniform)")
+    parser.add_argument("--weekday-weights", default=None,
+                        help="Comma-separated Monday..Sunday visit weights, e.g. 1,1,1,1,1,0.3,0.1")
+    parser.add_argument("--patient-activity", choices=ACTIVITY_MODELS, default="uniform",
+                        help="How lab results and notes spread over patients: uniform, or skewed lognormal/zipf "
+                             "activity that grows with contraindication_count and age (default: uniform)")
+    parser.add_argument("--activity-skew", type=float, default=1.0,
+                        help="Lognormal sigma, or Zipf exponent, of --patient-activity (default: 1.0)")
+    parser.add_argument("--cluster-patients", action="store_true",
+                        help="Keep each patient's lab results and notes together (sorted by patient per chunk)")
+    parser.add_argument("--cache-dir", default=".claude_cache",
+                        help="Directory for cached Claude notes (default: .claude_cache)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always call the Claude API, ignoring and not writing the response cache")
+    parser.add_argument("--cache-max-mb", type=int, default=1024,
+                        help="Evict least recently used cache entries beyond this size (default: 1024)")
+    parser.add_argument("--cache-max-age-days", type=float, default=None,
+                        help="Evict cache entries older than this many days (default: never)")
+    parser.add_argument("--journal", default="claude_batches.jsonl",
+                        help="Checkpoint file that completed Claude notes are appended to (default: claude_batches.jsonl)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip Claude notes already in --journal from an interrupted run")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Start --journal over, discarding the notes an earlier Claude run left in it (without "
+                             "--resume or --fresh, a non-empty journal is an error)")
+    parser.add_argument("--no-prompt-cache", action="store_true",
+                        help="Send the system prompt without a cache_control breakpoint (disables API prompt caching)")
+    parser.add_argument("--note-style-guide", action="store_true",
+                        help="Add detailed note-writing guidance to the Claude system prompt; changes the notes "
+                             "generated and invalidates cached ones, but makes the prompt long enough to be cached")
+    parser.add_argument("--max-retries", type=int, default=5,
+                        help="Retries per Claude batch on rate-limit/overload errors (default: 5)")
+    parser.add_argument("--max-concurrent", type=int, default=32,
+                        help="Upper bound for the adaptive number of concurrent Claude requests (default: 32)")
+    parser.add_argument("--tokens-per-minute", type=int, default=None,
+                        help="Input+output token budget per minute for Claude requests (default: unlimited)")
+    parser.add_argument("--stats", action="store_true",
+                        help="Also write <name>.stats.json sidecars (value counts, quantile and distinct-patient "
+                             "sketches, null and anomaly counts) computed while each dataset is written; "
+                             "--append keeps existing ones up to date")
+    parser.add_argument("--metrics-file", default=None,
+                        help="Write per-stage timings, progress and Claude request stats as JSON lines to this file")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Print the time spent in each stage at the end of the run (also printed with "
+                             "--metrics-file, --trace-memory or --profile)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Record tracemalloc peak memory per stage (slows pure-Python generation noticeably)")
+    parser.add_argument("--profile", choices=STAGES, default=None,
+                        help="Run every occurrence of this stage under cProfile (in the main process)")
+    parser.add_argument("--profile-file", default=None,
+                        help="Where to dump the --profile stats (default: profile_<stage>.prof)")
+    parser.add_argument("--api-base-url", default=None,
+                        help="Override the Anthropic API base URL, e.g. http://localhost:8765 for mock_claude_server.py")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv",
+                        help="Output file format; parquet/arrow/feather use typed schemas (default: csv)")
+    parser.add_argument("--compression", choices=["none", "zstd"], default="none",
+                        help="Compression codec for parquet/arrow/feather output (default: none)")
+    parser.add_argument("--row-group-size", type=int, default=1_000_000,
+                        help="Rows per parquet row group (default: 1,000,000)")
+    parser.add_argument("--sink", choices=list(SQL_TYPES), default=None,
+                        help="Bulk-load the datasets into tables of a local SQLite or DuckDB database instead of "
+                             "files, with patient_id and date indexes built after the load")
+    parser.add_argument("--sink-path", default=None,
+                        help="Database file for --sink (default: clinical_trials.sqlite / clinical_trials.duckdb)")
+    parser.add_argument("--sink-benchmark", action="store_true",
+                        help="After loading a --sink database, time the pipeline's patient/labs/notes join query")
+    parser.add_argument("--partition-by", choices=list(PARTITION_KEY_LENGTHS), default=None,
+                        help="Write lab results and notes as <name>/<test|note>_<month|day>=<key>/part-NNNN files "
+                             "plus a _manifest.json of rows per partition (default: one file per dataset)")
+    args = parser.parse_args()
+
+    defaults = (0, 0, 0) if args.append else (NUM_PATIENTS, NUM_LAB_RESULTS, NUM_CLINICAL_NOTES)
+    for name, default in zip(["num_patients", "num_lab_results", "num_notes"], defaults):
+        if getattr(args, name) is None:
+            setattr(args, name, default)
+    if args.append:
+        # Only settings actually passed are set on this namespace; the rest stay None
+        given = parser.parse_args(namespace=argparse.Namespace(**dict.fromkeys(RUN_SETTINGS)))
+        recorded = recorded_run_settings({name: parser.get_default(name) for name in RUN_SETTINGS})
+        disagreements = run_settings_disagreements(recorded)
+        if disagreements:
+            parser.error(f"--append needs all three outputs made with the same settings, but their .meta.json "
+                         f"sidecars disagree on: {'; '.join(disagreements)}")
+        conflicts = restore_run_settings(args, given, recorded["patients"])
+        if conflicts:
+            parser.error(f"--append keeps the existing outputs' settings; these conflict with them: "
+                         f"{', '.join(conflicts)}")
+        if args.append_to is None:
+            args.append_to = "file" if args.format == "csv" else "partition"
+        if args.append_to == "file" and args.format != "csv":
+            parser.error(f"--append-to file needs csv output; {args.format} outputs get new partition files")
+    # Default runs need no sidecar: --append recovers everything from the data files and the defaults
+    args.write_meta = any(getattr(args, name) != parser.get_default(name) for name in RUN_SETTINGS)
+
+    if args.activity_skew <= 0:
+        parser.error("--activity-skew must be positive")
+    if args.fused:
+        if args.engine != "numpy":
+            parser.error("--fused uses the numpy engine; add --engine numpy")
+        unsupported = [flag for flag, used in [("--append", args.append), ("--workers", args.workers > 1),
+                                               ("--use-claude", args.use_claude), ("--expand-notes", args.expand_notes),
+                                               ("--patient-activity", args.patient_activity != "uniform"),
+                                               ("--notes-engine markov", args.notes_engine == "markov")] if used]
+        if unsupported:
+            parser.error(f"--fused can't be combined with {', '.join(unsupported)}")
+    if args.resume and args.fresh:
+        parser.error("--resume and --fresh are alternatives: keep the journal's notes or discard them")
+    if ((args.use_claude or args.expand_notes) and not (args.resume or args.fresh)
+            and os.path.exists(args.journal) and os.path.getsize(args.journal)):
+        parser.error(f"{args.journal} holds notes from an earlier Claude run; add --resume to continue it "
+                     f"or --fresh to start it over")
+    if args.dedup_threshold is not None and not 0 < args.dedup_threshold <= 1:
+        parser.error("--dedup-threshold must be in (0, 1]")
+    if args.dedup_threshold is not None and not args.expand_notes:
+        parser.error("--dedup-threshold only applies to --expand-notes variants; add --expand-notes")
+    if args.markov_order < 1:
+        parser.error("--markov-order must be at least 1")
+    if args.notes_engine == "markov" and args.engine == "counter":
+        parser.error("--notes-engine markov samples notes sequentially, so it can't be combined with --engine counter")
+    if args.engine == "counter" and args.cluster_patients:
+        parser.error("--cluster-patients reorders rows within chunks, so it can't be combined with --engine counter")
+
+    if args.format != "csv":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error(f"--format {args.format} requires pyarrow. Run: pip install pyarrow")
+    if args.sink_benchmark and not args.sink:
+        parser.error("--sink-benchmark needs --sink")
+    if args.sink:
+        if args.append or args.partition_by:
+            parser.error(f"--sink can't be combined with {'--append' if args.append else '--partition-by'}")
+        args.sink_path = args.sink_path or DEFAULT_SINK_PATHS[args.sink]
+        if args.sink == "duckdb":
+            try:
+                import duckdb  # noqa: F401
+                import pyarrow  # noqa: F401
+            except ImportError:
+                parser.error("--sink duckdb requires duckdb and pyarrow. Run: pip install duckdb pyarrow")
+        if args.workers > 1:
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                parser.error("--sink with --workers passes shards to the loader as Arrow IPC files, which "
+                             "requires pyarrow. Run: pip install pyarrow")
+
+    random.seed(args.seed)
+    weekday_weights = [float(w) for w in args.weekday_weights.split(",")] if args.weekday_weights else None
+    if weekday_weights is not None and len(weekday_weights) != 7:
+        parser.error("--weekday-weights needs 7 comma-separated values (Monday..Sunday)")
+    configure_dates(DateSampler(seasonality=args.date_seasonality, weekday_weights=weekday_weights))
+    DATES.seed(args.seed)
+    uniform_dates = not (args.date_seasonality or weekday_weights)
+    if uniform_dates and (args.engine == "python" or args.use_claude or args.expand_notes) and not args.fused:
+        try:
+            import faker  # noqa: F401
+        except ImportError:
+            parser.error("the python engine (and Claude note metadata) draws dates with Faker. Run: pip install "
+                         "faker, or use --engine numpy")
+
+    configure_metrics(Metrics(args.metrics_file, trace_memory=args.trace_memory, profile=args.profile,
+                              profile_path=args.profile_file))
+    METRICS.emit("run_start", args=vars(args))
+    try:
+        if args.append:
+            generate_append(args)
+        elif args.fused:
+            generate_fused(args)
+        elif args.chunk_size or args.workers > 1 or args.engine == "counter":
+            # Counter-based rows don't depend on how they are chunked, so that engine always streams
+            generate_streaming(args)
+        else:
+            generate_in_memory(args)
+        if args.sink_benchmark:
+            run_join_benchmark(args.sink_path, args.sink)
+    finally:
+        METRICS.close(report=bool(args.verbose or args.metrics_file or args.trace_memory or args.profile))
 
 
 if __name__ == "__main__":
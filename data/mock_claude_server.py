@@ -0,0 +1,228 @@
+"""
+Local stand-in for the Anthropic Messages API, for exercising the Claude note path without network.
+
+Answers POST /v1/messages with one fake note per numbered patient line in the prompt, as JSON
+lines like the real model is asked to do, either whole or streamed as server-sent events. Latency,
+429 rate limiting, 529 overloads, dropped notes and max_tokens truncation can be injected to test
+retries, follow-up requests and the adaptive concurrency limiter and batch size. System prompts
+sent as cache_control blocks are remembered, and the usage reports cache writes and reads like
+the API's prompt caching does.
+
+Usage:
+    python mock_claude_server.py --port 8765 --latency 0.5 --max-in-flight 8 --rate-limit-prob 0.02
+
+    # In another shell:
+    ANTHROPIC_API_KEY=mock python generate_datasets.py --use-claude --num-notes 2000 \
+        --api-base-url http://localhost:8765
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockClaudeServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the fault-injection settings and request counters."""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, latency_jitter=0.0, rate_limit_prob=0.0, overload_prob=0.0,
+                 max_in_flight=None, drop_prob=0.0, note_tokens=60, cache_min_tokens=1024):
+        super().__init__(address, MockClaudeHandler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit_prob = rate_limit_prob
+        self.overload_prob = overload_prob
+        self.max_in_flight = max_in_flight
+        self.drop_prob = drop_prob
+        self.note_tokens = note_tokens
+        self.cache_min_tokens = cache_min_tokens
+        self.prompt_cache = set()
+        self.in_flight = 0
+        self.requests = 0
+        self.rejected = 0
+        self.payloads = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class MockClaudeHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status, error_type, message):
+        self._send_json(status, {"type": "error", "error": {"type": error_type, "message": message}},
+                        headers={"retry-after": "1"})
+
+    def _send_stream(self, message, chunk_chars=64):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        text = message["content"][0]["text"]
+        usage = message["usage"]
+        events = [
+            {"type": "message_start", "message": dict(message, content=[], stop_reason=None,
+                                                      usage=dict(usage, output_tokens=0))},
+            {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+        ]
+        events += [
+            {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text[i:i + chunk_chars]}}
+            for i in range(0, len(text), chunk_chars)
+        ]
+        events += [
+            {"type": "content_block_stop", "index": 0},
+            {"type": "message_delta", "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+             "usage": {"output_tokens": usage["output_tokens"]}},
+            {"type": "message_stop"},
+        ]
+        for event in events:
+            self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        with server._lock:
+            server.requests += 1
+            server.payloads.append(payload)
+            over_capacity = server.max_in_flight is not None and server.in_flight >= server.max_in_flight
+            if not over_capacity:
+                server.in_flight += 1
+        if over_capacity or random.random() < server.rate_limit_prob:
+            with server._lock:
+                server.rejected += 1
+                if not over_capacity:
+                    server.in_flight -= 1
+            return self._send_error(429, "rate_limit_error", "Mock rate limit exceeded")
+
+        try:
+            time.sleep(max(0.0, random.gauss(server.latency, server.latency_jitter)))
+            if random.random() < server.overload_prob:
+                return self._send_error(529, "overloaded_error", "Mock overloaded")
+            message = mock_message(payload, server.drop_prob, server.note_tokens)
+            cache_usage(server, payload, message["usage"])
+            if payload.get("stream"):
+                self._send_stream(message)
+            else:
+                self._send_json(200, message)
+        finally:
+            with server._lock:
+                server.in_flight -= 1
+
+
+def prompt_text(payload):
+    """Concatenate the text of the last user message, whether content is a string or blocks."""
+    content = payload.get("messages", [{}])[-1].get("content", "")
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+
+def mock_message(payload, drop_prob=0.0, note_tokens=60):
+    """Build a Messages API response with one fake JSON-line note per numbered line of the prompt.
+
+    Each note is dropped with drop_prob; replies longer than max_tokens (at ~4 characters per token)
+    are cut off mid-line with stop_reason "max_tokens", like the real API.
+    """
+    prompt = prompt_text(payload)
+    numbers = re.findall(r"^\s*(\d+)[.:]", prompt, flags=re.MULTILINE) or ["1"]
+    filler = " Hx reviewed, no new sxs, tolerating tx w/o SE." * max(1, note_tokens * 4 // 48)
+    notes = [
+        json.dumps({"index": int(n), "note": f"Pt seen for f/u. Mock note {random.randint(1000, 9999)}.{filler}"})
+        for n in numbers if random.random() >= drop_prob
+    ]
+    text = "\n".join(notes)
+    stop_reason = "end_turn"
+    max_chars = payload.get("max_tokens", 4096) * 4
+    if len(text) > max_chars:
+        text, stop_reason = text[:max_chars], "max_tokens"
+    system = payload.get("system", "")
+    system_chars = len(system) if isinstance(system, str) else sum(len(b.get("text", "")) for b in system)
+    return {
+        "id": f"msg_mock_{random.randint(0, 10**9)}",
+        "type": "message",
+        "role": "assistant",
+        "model": payload.get("model", "mock"),
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": {"input_tokens": (system_chars + len(prompt)) // 4, "output_tokens": len(text) // 4},
+    }
+
+
+def cache_usage(server, payload, usage):
+    """Move the system prompt's tokens from input_tokens to a cache write or read, if it is marked cacheable.
+
+    Like the API, only prefixes of at least cache_min_tokens are cached (1024 tokens by default, the
+    real minimum for most models; 2048 for Haiku models).
+    """
+    system = payload.get("system", "")
+    if isinstance(system, str) or not any(block.get("cache_control") for block in system):
+        return
+    text = "".join(block.get("text", "") for block in system)
+    tokens = len(text) // 4
+    if tokens < server.cache_min_tokens:
+        return
+    with server._lock:
+        hit = text in server.prompt_cache
+        server.prompt_cache.add(text)
+    usage["input_tokens"] -= tokens
+    usage["cache_read_input_tokens" if hit else "cache_creation_input_tokens"] = tokens
+
+
+def start_mock_server(port=0, **options):
+    """Start a MockClaudeServer on a background thread and return it (call .shutdown() to stop)."""
+    server = MockClaudeServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Anthropic Messages API for local testing")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean response latency in seconds (default: 0.5)")
+    parser.add_argument("--latency-jitter", type=float, default=0.1, help="Latency standard deviation (default: 0.1)")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0, help="Probability of a random 429")
+    parser.add_argument("--overload-prob", type=float, default=0.0, help="Probability of a 529 overloaded error")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="Answer 429 when more requests than this are in flight (emulates a rate limit)")
+    parser.add_argument("--drop-prob", type=float, default=0.0,
+                        help="Probability of leaving out each requested note (exercises follow-up requests)")
+    parser.add_argument("--note-tokens", type=int, default=60,
+                        help="Approximate output tokens per note (default: 60)")
+    parser.add_argument("--cache-min-tokens", type=int, default=1024,
+                        help="Smallest system prompt (in tokens) the emulated prompt cache stores (default: 1024)")
+    args = parser.parse_args()
+
+    server = MockClaudeServer(("127.0.0.1", args.port), latency=args.latency, latency_jitter=args.latency_jitter,
+                              rate_limit_prob=args.rate_limit_prob, overload_prob=args.overload_prob,
+                              max_in_flight=args.max_in_flight, drop_prob=args.drop_prob,
+                              note_tokens=args.note_tokens, cache_min_tokens=args.cache_min_tokens)
+    print(f"Mock Claude API listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
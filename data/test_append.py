@@ -0,0 +1,78 @@
+"""
+Tests for --append: new rows continue the existing outputs under the settings they were made with.
+
+Usage:
+    python -m pytest test_append.py
+"""
+
+import json
+import sys
+
+import pytest
+
+import generate_datasets as gd
+
+
+def run(monkeypatch, *options):
+    monkeypatch.setattr(sys, "argv", ["generate_datasets.py", *options])
+    gd.main()
+
+
+def read(dataset):
+    return gd.pd.read_csv(f"{gd.DATASET_FILES[dataset]}.csv")
+
+
+@pytest.fixture
+def outputs(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    run(monkeypatch, "--engine", "numpy", "--seed", "7", "--num-patients", "300", "--num-lab-results", "2000",
+        "--num-notes", "500")
+    return tmp_path
+
+
+def test_append_continues_patient_ids_and_rows(monkeypatch, outputs):
+    run(monkeypatch, "--append", "--num-patients", "50", "--num-lab-results", "400", "--num-notes", "100")
+    patients, labs, notes = read("patients"), read("labs"), read("notes")
+    assert patients["patient_id"].tolist() == gd.format_patient_ids(range(350)).tolist()
+    assert (len(labs), len(notes)) == (2400, 600)
+    # New rows may reference new patients, and were made with the restored seed and engine
+    assert labs["patient_id"].isin(patients["patient_id"]).all()
+    meta = json.loads((outputs / "lab_results_2025.meta.json").read_text())
+    assert (meta["rows"], meta["seed"], meta["engine"]) == (2400, 7, "numpy")
+    assert meta["appends"][0]["start"] == 2000
+    # Planted errors are not repeated
+    assert len(gd.planted_errors(labs)) == len(gd.OBVIOUS_ERRORS)
+
+
+def test_append_is_reproducible(monkeypatch, outputs, tmp_path_factory):
+    run(monkeypatch, "--append", "--num-lab-results", "400")
+    first = (outputs / "lab_results_2025.csv").read_bytes()
+    again = tmp_path_factory.mktemp("again")
+    monkeypatch.chdir(again)
+    run(monkeypatch, "--engine", "numpy", "--seed", "7", "--num-patients", "300", "--num-lab-results", "2000",
+        "--num-notes", "500")
+    run(monkeypatch, "--append", "--num-lab-results", "400")
+    assert (again / "lab_results_2025.csv").read_bytes() == first
+
+
+@pytest.mark.parametrize("option", [["--engine", "python"], ["--seed", "8"], ["--format", "parquet"]])
+def test_append_refuses_conflicting_settings(monkeypatch, outputs, option):
+    with pytest.raises(SystemExit):
+        run(monkeypatch, "--append", "--num-lab-results", "10", *option)
+    assert len(read("labs")) == 2000
+
+
+def test_append_refuses_disagreeing_sidecars(monkeypatch, outputs, capsys):
+    path = outputs / "clinical_notes_raw.meta.json"
+    path.write_text(json.dumps(dict(json.loads(path.read_text()), seed=8)))
+    with pytest.raises(SystemExit):
+        run(monkeypatch, "--append", "--num-lab-results", "10")
+    assert "seed (patient_demographics: 7, lab_results_2025: 7, clinical_notes_raw: 8)" in capsys.readouterr().err
+
+
+def test_default_outputs_append_without_sidecars(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    run(monkeypatch, "--num-patients", "200", "--num-lab-results", "1000", "--num-notes", "300")
+    assert not list(tmp_path.glob("*.meta.json"))
+    run(monkeypatch, "--append", "--num-patients", "20")
+    assert read("patients")["patient_id"].iloc[-1] == "PT-2025-00219"
@@ -0,0 +1,225 @@
+"""
+Tests for the Claude note path of generate_datasets.py against a stub `anthropic` client.
+
+The stub answers each streamed request with one JSON-line note per numbered patient line, and can
+fail requests or leave notes out, so caching, retries and follow-up requests run without a network.
+
+Usage:
+    python -m pytest test_claude_notes.py
+"""
+
+import asyncio
+import json
+import random
+import re
+import sys
+import types
+
+import pytest
+
+import generate_datasets as gd
+
+
+class StubStream:
+    """Async context manager standing in for client.messages.stream(...)."""
+
+    def __init__(self, messages, request):
+        self.messages = messages
+        self.request = request
+        self.text = ""
+
+    async def __aenter__(self):
+        await asyncio.sleep(0)  # let other requests start, as a network round trip would
+        if self.messages.errors:
+            raise self.messages.errors.pop(0)
+        self.text = self.messages.reply(self.request)
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for i in range(0, len(self.text), 16):
+            yield self.text[i:i + 16]
+
+    async def get_final_message(self):
+        return types.SimpleNamespace(
+            stop_reason="end_turn",
+            content=[types.SimpleNamespace(type="text", text=self.text)],
+            usage=types.SimpleNamespace(input_tokens=100, output_tokens=self.messages.output_tokens(self.text)),
+        )
+
+
+class StubMessages:
+    """Records every request; errors are raised by the next requests, drop lists indices to leave out of replies.
+
+    tokens_per_note, when set, is the output usage reported per note instead of the reply's length / 4.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.errors = []
+        self.drop = set()
+        self.tokens_per_note = None
+
+    def stream(self, **request):
+        self.requests.append(request)
+        return StubStream(self, request)
+
+    def reply(self, request):
+        prompt = request["messages"][-1]["content"]
+        numbers = [int(n) for n in re.findall(r"^(\d+)\. ", prompt, flags=re.MULTILINE)]
+        kept = [n for n in numbers if n not in self.drop]
+        self.drop -= set(numbers)  # only the first reply loses them
+        return "\n".join(json.dumps({"index": n, "note": f"Stub note {n}"}) for n in kept)
+
+    def output_tokens(self, text):
+        if self.tokens_per_note is None:
+            return len(text) // 4
+        return self.tokens_per_note * len(text.splitlines())
+
+
+class ApiError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    messages = StubMessages()
+
+    class AsyncAnthropic:
+        def __init__(self, **options):
+            self.messages = messages
+
+        async def close(self):
+            pass
+
+    monkeypatch.setitem(sys.modules, "anthropic", types.SimpleNamespace(AsyncAnthropic=AsyncAnthropic))
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "stub")
+    monkeypatch.setattr(gd, "RETRY_BASE_DELAY", 0.0)
+    gd.configure_metrics(gd.Metrics())
+    return messages
+
+
+def generate_notes(num_notes=30, **options):
+    random.seed(gd.SEED)
+    gd.DATES.seed(gd.SEED)
+    patient_df = gd.generate_patient_demographics(20)
+    return gd.generate_clinical_notes_with_claude(num_notes, patient_df, **options)
+
+
+def test_cache_hit_skips_the_client(stub, tmp_path):
+    first = generate_notes(cache=gd.ResponseCache(str(tmp_path)))
+    assert stub.requests
+    stub.requests.clear()
+
+    second = generate_notes(cache=gd.ResponseCache(str(tmp_path)), batch_size=7)
+    assert stub.requests == []
+    assert second["note_text"].tolist() == first["note_text"].tolist()
+
+
+def test_rate_limited_request_is_retried(stub):
+    stub.errors = [ApiError(429), ApiError(529)]
+    notes = generate_notes(num_notes=5)
+    assert len(stub.requests) == 3
+    assert not notes["note_text"].str.startswith("Note generation failed").any()
+
+
+def test_non_retryable_error_fails_the_batch(stub):
+    stub.errors = [ApiError(400)]
+    notes = generate_notes(num_notes=5)
+    assert len(stub.requests) == 1
+    assert (notes["note_text"] == "Note generation failed.").all()
+
+
+def test_missing_notes_are_requested_again(stub):
+    stub.drop = {2, 4}
+    notes = generate_notes(num_notes=5)
+    assert len(stub.requests) == 2
+    followup = stub.requests[1]["messages"][-1]["content"]
+    assert re.findall(r"^(\d+)\. ", followup, flags=re.MULTILINE) == ["2", "4"]
+    assert notes["note_text"].tolist() == [f"Stub note {n}" for n in range(1, 6)]
+
+
+def batch_sizes(requests):
+    return [len(re.findall(r"^\d+\. ", request["messages"][-1]["content"], flags=re.MULTILINE))
+            for request in requests]
+
+
+def test_batches_shrink_after_a_rate_limited_start(stub):
+    # Long replies shrink the adaptive batch size; only batches holding one of the limiter's
+    # initial slots may be cut before the first reply arrives
+    stub.errors = [ApiError(429)]
+    stub.tokens_per_note = 1000
+    notes = generate_notes(num_notes=200, batch_size=20)
+    sizes = batch_sizes(stub.requests)
+    assert sum(sizes) == 200 + 20  # every note once, plus the retry of the rate-limited batch
+    assert sizes.count(20) <= 4 + 1
+    assert sorted(sizes)[-6] <= 6
+    assert not notes["note_text"].str.startswith("Note").any()
+
+
+def test_system_prompt_is_sent_as_a_cache_breakpoint(stub):
+    stub.drop = {3}
+    generate_notes(num_notes=5)
+    system_prompt = gd.note_system_prompt()
+    assert gd.NOTE_STYLE_GUIDE not in system_prompt
+    assert len(stub.requests) == 2
+    for request in stub.requests:
+        assert request["system"] == [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        assert request["messages"][-1]["content"].startswith(gd.NOTE_BATCH_HEADER)
+
+
+def test_prompt_cache_can_be_disabled(stub):
+    generate_notes(num_notes=5, cache_prompt=False)
+    assert stub.requests[0]["system"] == gd.note_system_prompt()
+
+
+def test_uncached_prefix_is_reported(stub, capsys):
+    # The stub reports no cache usage, as the API does for a prefix below its minimum
+    generate_notes(num_notes=5)
+    assert "Prompt cache: did not apply" in capsys.readouterr().out
+
+
+def test_style_guide_is_opt_in(stub, tmp_path):
+    generate_notes(num_notes=5, cache=gd.ResponseCache(str(tmp_path)))
+    stub.requests.clear()
+    generate_notes(num_notes=5, cache=gd.ResponseCache(str(tmp_path)), style_guide=True)
+    assert gd.NOTE_STYLE_GUIDE in stub.requests[0]["system"][0]["text"]
+    assert len(stub.requests) == 1  # notes cached under the default prompt aren't reused
+
+
+def test_existing_journal_needs_resume_or_fresh(stub, tmp_path):
+    journal = str(tmp_path / "claude_batches.jsonl")
+    first = generate_notes(num_notes=5, journal_path=journal)
+    with pytest.raises(FileExistsError):
+        generate_notes(num_notes=5, journal_path=journal)
+    stub.requests.clear()
+    assert generate_notes(num_notes=5, journal_path=journal, resume=True).equals(first)
+    assert stub.requests == []
+    generate_notes(num_notes=5, journal_path=journal, fresh=True)
+    assert len(stub.requests) == 1
+
+
+def test_resume_requests_only_notes_missing_from_the_journal(stub, tmp_path):
+    journal = tmp_path / "claude_batches.jsonl"
+    first = generate_notes(num_notes=30, batch_size=10, journal_path=str(journal))
+    # An interrupted run: only the first batch and part of the second were checkpointed
+    lines = journal.read_text().splitlines(keepends=True)
+    assert len(lines) == 30
+    journal.write_text("".join(lines[:14]))
+    stub.requests.clear()
+
+    resumed = generate_notes(num_notes=30, batch_size=10, journal_path=str(journal), resume=True)
+    assert sum(batch_sizes(stub.requests)) == 16
+    # The stub numbers notes by batch position, so only the journaled notes keep their text
+    assert resumed.drop(columns="note_text").equals(first.drop(columns="note_text"))
+    assert (resumed["note_text"] == first["note_text"]).sum() >= 14
+    assert not resumed["note_text"].str.startswith("Note").any()
+    assert len(gd.read_note_journal(str(journal))) == 30
@@ -0,0 +1,96 @@
+"""
+Tests that the generator engines agree on their output shape and are reproducible.
+
+Usage:
+    python -m pytest test_engines.py
+"""
+
+import hashlib
+import random
+import sys
+
+import numpy as np
+import pytest
+
+import generate_datasets as gd
+
+ROWS = {"patients": 500, "labs": 20000, "notes": 3000}
+
+
+def generate(monkeypatch, directory, *options):
+    directory.mkdir()
+    monkeypatch.chdir(directory)
+    monkeypatch.setattr(sys, "argv", ["generate_datasets.py", "--num-patients", str(ROWS["patients"]),
+                                      "--num-lab-results", str(ROWS["labs"]), "--num-notes", str(ROWS["notes"]),
+                                      *options])
+    gd.main()
+    return {dataset: hashlib.sha256((directory / f"{name}.csv").read_bytes()).hexdigest()
+            for dataset, name in gd.DATASET_FILES.items()}
+
+
+def python_and_numpy(dataset):
+    random.seed(gd.SEED)
+    gd.DATES.seed(gd.SEED)
+    rng = np.random.default_rng(gd.SEED)
+    if dataset == "patients":
+        return [gd.generate_patient_demographics(300, engine, rng) for engine in ("python", "numpy")]
+    patient_ids = gd.PatientIdRange(0, 300)
+    if dataset == "labs":
+        return [gd.generate_lab_results(2000, patient_ids, engine, rng) for engine in ("python", "numpy")]
+    return [gd.generate_clinical_notes_template(2000, patient_ids, engine, rng) for engine in ("python", "numpy")]
+
+
+@pytest.mark.parametrize("dataset", ["patients", "labs", "notes"])
+def test_numpy_engine_matches_python_schema(dataset):
+    python_df, numpy_df = python_and_numpy(dataset)
+    assert list(numpy_df.columns) == list(python_df.columns)
+    assert len(numpy_df) == len(python_df)
+    for column in python_df.columns:
+        python_values, numpy_values = python_df[column], numpy_df[column]
+        if python_values.dtype.kind in "biuf":
+            assert numpy_values.dtype.kind in "biuf", column
+        elif column not in ("patient_id", "note_text"):
+            # Categorical columns draw from the same value sets
+            assert set(numpy_values.astype(str)) <= set(python_values.astype(str)) | set(gd.DATES.iso), column
+    # Both convert to the typed columnar schema
+    pytest.importorskip("pyarrow")
+    for df in (python_df, numpy_df):
+        assert gd.to_arrow_table(df, gd.arrow_schema(dataset)).schema == gd.arrow_schema(dataset)
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_sharded_output_does_not_depend_on_worker_count(monkeypatch, tmp_path, engine):
+    two = generate(monkeypatch, tmp_path / "two", "--engine", engine, "--workers", "2", "--shard-size", "4000")
+    three = generate(monkeypatch, tmp_path / "three", "--engine", engine, "--workers", "3", "--shard-size", "4000")
+    assert two == three
+
+
+def test_counter_engine_output_does_not_depend_on_sharding(monkeypatch, tmp_path):
+    in_process = generate(monkeypatch, tmp_path / "in_process", "--engine", "counter", "--chunk-size", "3000")
+    sharded = generate(monkeypatch, tmp_path / "sharded", "--engine", "counter", "--workers", "2",
+                       "--shard-size", "7000")
+    assert in_process == sharded
+
+
+def test_counter_engine_regenerates_any_row_range():
+    patient_ids = gd.PatientIdRange(0, 500)
+    whole = {
+        "patients": gd.generate_patient_demographics_range(0, 500),
+        "labs": gd.generate_lab_results_range(0, 5000, patient_ids, num_results=5000),
+        "notes": gd.generate_clinical_notes_range(0, 2000, patient_ids),
+    }
+    parts = {
+        "patients": [gd.generate_patient_demographics_range(120, 380)],
+        "labs": [gd.generate_lab_results_range(start, stop, patient_ids, num_results=5000)
+                 for start, stop in [(0, 1234), (1234, 4000), (4000, 5000)]],
+        "notes": [gd.generate_clinical_notes_range(1999, 2000, patient_ids),
+                  gd.generate_clinical_notes_range(700, 1100, patient_ids)],
+    }
+    ranges = {"patients": [(120, 380)], "labs": [(0, 1234), (1234, 4000), (4000, 5000)],
+              "notes": [(1999, 2000), (700, 1100)]}
+    for dataset, frames in parts.items():
+        for (start, stop), part in zip(ranges[dataset], frames):
+            expected = whole[dataset].iloc[start:stop].reset_index(drop=True)
+            gd.pd.testing.assert_frame_equal(part.reset_index(drop=True), expected, check_categorical=False)
+    # The planted errors sit at the same rows however the range is cut
+    assert len(gd.planted_errors(whole["labs"])) == len(gd.OBVIOUS_ERRORS)
@@ -0,0 +1,45 @@
+"""
+Tests for the per-stage metrics report of generate_datasets.py.
+
+Usage:
+    python -m pytest test_metrics.py
+"""
+
+import json
+import sys
+
+import pytest
+
+import generate_datasets as gd
+
+
+@pytest.fixture(autouse=True)
+def plain_metrics():
+    # main() leaves its Metrics module-wide; don't let later tests write to this test's --metrics-file
+    yield
+    gd.configure_metrics(gd.Metrics())
+
+
+def run(monkeypatch, tmp_path, *options):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["generate_datasets.py", "--engine", "numpy", "--num-patients", "200",
+                                      "--num-lab-results", "2000", "--num-notes", "500", *options])
+    gd.main()
+
+
+def test_stage_table_is_printed_only_on_request(monkeypatch, tmp_path, capsys):
+    run(monkeypatch, tmp_path)
+    assert "Time by stage" not in capsys.readouterr().out
+    run(monkeypatch, tmp_path, "--verbose")
+    assert "Time by stage" in capsys.readouterr().out
+
+
+def test_metrics_file_gets_the_stage_summary(monkeypatch, tmp_path, capsys):
+    run(monkeypatch, tmp_path, "--metrics-file", "metrics.jsonl")
+    assert "Time by stage" in capsys.readouterr().out
+    with open(tmp_path / "metrics.jsonl") as f:
+        events = [json.loads(line) for line in f]
+    summary = [event for event in events if event["event"] == "summary"]
+    assert len(summary) == 1
+    stages = {(stage["dataset"], stage["stage"]): stage for stage in summary[0]["stages"]}
+    assert stages[("labs", "write")]["rows"] == 2000
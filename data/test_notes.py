@@ -0,0 +1,109 @@
+"""
+Tests for the offline note generators: NoteVariator substitutions, MinHash near-duplicate
+detection and the Markov synthesizer.
+
+Usage:
+    python -m pytest test_notes.py
+"""
+
+import random
+import re
+
+import numpy as np
+
+import generate_datasets as gd
+
+BASE_NOTE = ("65 yo M w/ HTN on lisinopril 10mg and metformin 500mg, 110mg ASA. EF 45%. "
+             "Pt has hx of allergeis to sulfa. Patient eligible for follow up.")
+
+
+def variants(base_texts, index, count=2000, seed=0):
+    random.seed(seed)
+    variator = gd.NoteVariator(base_texts)
+    return [variator.vary(index) for _ in range(count)]
+
+
+def test_note_variator_substitutes_only_known_sites():
+    meds = "|".join(["lisinopril"] + gd.MED_SUBSTITUTIONS["lisinopril"])
+    dm_meds = "|".join(["metformin"] + gd.MED_SUBSTITUTIONS["metformin"])
+    doses_10 = "|".join(map(re.escape, ["10mg"] + gd.DOSAGE_SUBSTITUTIONS["10mg"]))
+    doses_500 = "|".join(map(re.escape, ["500mg"] + gd.DOSAGE_SUBSTITUTIONS["500mg"]))
+    pattern = re.compile(
+        rf"(\d+) yo M w/ HTN on ({meds}) ({doses_10}) and ({dm_meds}) ({doses_500}), 110mg ASA\. EF (\d+)%\. "
+        r"(Pt) has hx of (allergeis|allergies) to sulfa\. (Patient|patietn) (eligible|eligibile) for "
+        r"(follow up|followup)\.")
+    seen = {group: set() for group in range(1, 12)}
+    for text in variants([BASE_NOTE], 0):
+        match = pattern.fullmatch(text)
+        assert match, text
+        for group in seen:
+            seen[group].add(match.group(group))
+    # Ages stay within 10 years (and 25-90), percentages within 5 points (and 15-70)
+    assert {int(age) for age in seen[1]} <= set(range(55, 76))
+    assert {int(ef) for ef in seen[6]} <= set(range(40, 51))
+    assert len(seen[1]) > 10 and len(seen[6]) > 5
+    # Every medication and dose alternative turns up, and typos are both added and fixed
+    assert seen[2] == set(meds.split("|")) and seen[4] == set(dm_meds.split("|"))
+    assert seen[3] == {"10mg", *gd.DOSAGE_SUBSTITUTIONS["10mg"]}
+    assert "allergies" in seen[8] and "patietn" in seen[9]
+
+
+def test_note_variator_keeps_notes_without_sites():
+    text = "Routine visit, no changes."
+    assert set(variants([BASE_NOTE, text], 1, count=200)) == {text}
+
+
+def test_note_variator_is_seeded_by_the_random_module():
+    assert variants([BASE_NOTE], 0, seed=3) == variants([BASE_NOTE], 0, seed=3)
+    assert variants([BASE_NOTE], 0, seed=3) != variants([BASE_NOTE], 0, seed=4)
+
+
+LONG_NOTE = ("Pt is a 67 yo F w/ hx of CAD s/p CABG 2019, CHF with EF 35%, CKD stage 3 and DM2 on metformin "
+             "1000mg BID. Prior enrollment in CARD-2022, completed full protocol. Contraindicated for "
+             "nephrotoxic agents. Discussed HEART-2025 screening, pt interested, will f/u in 2 weeks w/ labs.")
+
+
+def test_dedup_matches_near_duplicates_only():
+    dedup = gd.NoteDeduplicator(threshold=0.7)
+    signature = dedup.signature(LONG_NOTE)
+    dedup.add(signature, dedup._band_keys(signature))
+
+    near = LONG_NOTE.replace("2 weeks", "3 weeks")
+    near_signature = dedup.signature(near)
+    assert dedup.match(near_signature, dedup._band_keys(near_signature)) == 0
+
+    other = gd.EXAMPLE_NOTES[0]["note_text"]
+    other_signature = dedup.signature(other)
+    assert dedup.match(other_signature, dedup._band_keys(other_signature)) is None
+
+
+def test_dedup_rerolls_near_duplicate_variants():
+    dedup = gd.NoteDeduplicator(threshold=0.7, retries=3)
+    other = gd.EXAMPLE_NOTES[0]["note_text"]
+    attempts = iter([LONG_NOTE, LONG_NOTE.replace("2 weeks", "3 weeks"), LONG_NOTE, other])
+    assert dedup.diversify(lambda: next(attempts), 0) == LONG_NOTE
+    # Two near-duplicates are re-rolled before a distinct note is accepted
+    assert dedup.diversify(lambda: next(attempts), 0) == other
+    counts = dedup.counts()["note_diversity"]
+    assert (counts["notes"], counts["distinct"], counts["rerolls"], counts["near_duplicates"]) == (2, 2, 2, 0)
+
+
+def test_dedup_keeps_the_last_attempt_when_every_reroll_repeats():
+    dedup = gd.NoteDeduplicator(threshold=0.7, retries=2)
+    dedup.diversify(lambda: LONG_NOTE, 0)
+    assert dedup.diversify(lambda: LONG_NOTE, 0) == LONG_NOTE
+    counts = dedup.counts()
+    assert counts["note_diversity"]["near_duplicates"] == 1
+    assert counts["note_clusters"].to_dict() == {2: 1}
+
+
+def test_markov_notes_are_deterministic_for_a_seed():
+    model = gd.train_markov_model(template_notes=200, seed=5)
+    patient_ids = gd.PatientIdRange(0, 100)
+    first = gd.generate_clinical_notes_markov(300, patient_ids, model, np.random.default_rng(1))
+    again = gd.generate_clinical_notes_markov(300, patient_ids, gd.train_markov_model(template_notes=200, seed=5),
+                                              np.random.default_rng(1))
+    other = gd.generate_clinical_notes_markov(300, patient_ids, model, np.random.default_rng(2))
+    gd.pd.testing.assert_frame_equal(first, again)
+    assert (first["note_text"] != other["note_text"]).any()
+    assert first["note_text"].str.len().gt(0).all()
@@ -0,0 +1,63 @@
+"""
+Tests that --partition-by output reads back as one dataset with pyarrow and pandas.
+
+Usage:
+    python -m pytest test_partitioned_output.py
+"""
+
+import json
+import sys
+
+import pytest
+
+import generate_datasets as gd
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.dataset as ds  # noqa: E402
+
+
+def generate(monkeypatch, tmp_path, *options):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["generate_datasets.py", "--engine", "numpy", "--num-patients", "500",
+                                      "--num-lab-results", "20000", "--num-notes", "3000", *options])
+    gd.main()
+
+
+def read_manifest(directory):
+    with open(f"{directory}/{gd.PARTITION_MANIFEST}") as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("options", [
+    ["--format", "parquet", "--partition-by", "month"],
+    ["--format", "parquet", "--partition-by", "day", "--workers", "2", "--shard-size", "7000"],
+    ["--format", "arrow", "--partition-by", "month", "--chunk-size", "4000"],
+])
+def test_columnar_partitions_read_back(monkeypatch, tmp_path, options):
+    generate(monkeypatch, tmp_path, *options)
+    fmt = options[1]
+    partition_by = options[3]
+    for dataset, rows in [("labs", 20000), ("notes", 3000)]:
+        directory = gd.DATASET_FILES[dataset]
+        column = gd.PARTITION_COLUMNS[dataset]
+        key_name = gd.partition_key_name(dataset, partition_by)
+        table = ds.dataset(directory, format="ipc" if fmt == "arrow" else fmt, partitioning="hive").to_table()
+        assert table.num_rows == rows == read_manifest(directory)["rows"]
+        assert table.schema.field(column).type == pa.date32()
+        df = table.to_pandas()
+        keys = df[column].astype(str).str.slice(0, gd.PARTITION_KEY_LENGTHS[partition_by])
+        assert (keys == df[key_name].astype(str)).all()
+        if fmt == "parquet":
+            assert len(gd.pd.read_parquet(directory)) == rows
+
+
+def test_csv_day_partitions_read_back(monkeypatch, tmp_path):
+    generate(monkeypatch, tmp_path, "--partition-by", "day", "--chunk-size", "5000")
+    manifest = read_manifest("lab_results_2025")
+    table = ds.dataset("lab_results_2025", format="csv", partitioning="hive").to_table()
+    assert table.num_rows == manifest["rows"] == 20000
+    for partition in manifest["partitions"]:
+        frames = [gd.pd.read_csv(f"lab_results_2025/{partition['path']}/{name}") for name in partition["files"]]
+        rows = gd.pd.concat(frames)
+        assert len(rows) == partition["rows"]
+        assert (rows["test_date"] == partition["key"]).all()
@@ -0,0 +1,88 @@
+"""
+Tests for weighted patient sampling (the alias table) and the mergeable KLL/HLL summary sketches.
+
+Usage:
+    python -m pytest test_sampling.py
+"""
+
+import numpy as np
+import pytest
+
+import generate_datasets as gd
+
+
+def alias_distribution(prob, alias):
+    """The distribution an alias table draws from: each slot keeps prob and passes the rest to its alias."""
+    n = len(prob)
+    return (prob + np.bincount(alias, weights=1.0 - prob, minlength=n)) / n
+
+
+@pytest.mark.parametrize("model", ["lognormal", "zipf"])
+def test_alias_table_reproduces_the_weights(model):
+    ages = np.random.default_rng(0).integers(25, 90, 5000)
+    weights = gd.activity_weights(ages, np.zeros(5000), model=model, skew=1.5)
+    prob, alias = gd.alias_table(weights)
+    assert ((prob >= 0) & (prob <= 1 + 1e-9)).all()
+    np.testing.assert_allclose(alias_distribution(prob, alias), weights / weights.sum(), rtol=1e-9, atol=1e-15)
+
+
+def test_alias_table_handles_uniform_and_single_weights():
+    for weights in ([3.0] * 10, [1.0]):
+        prob, alias = gd.alias_table(weights)
+        assert (prob == 1).all() and (alias == np.arange(len(weights))).all()
+
+
+def test_weighted_draws_follow_the_weights():
+    weights = np.array([1, 2, 3, 4, 0, 10, 0.5, 20], dtype=float)
+    activity = gd.PatientActivity(gd.PatientIdRange(0, len(weights)), weights)
+    n = 1_000_000
+    codes = activity.sample(np.random.default_rng(3), n)
+    frequencies = np.bincount(codes, minlength=len(weights)) / n
+    expected = weights / weights.sum()
+    # Within 5 standard errors of a binomial count
+    assert (np.abs(frequencies - expected) <= 5 * np.sqrt(expected * (1 - expected) / n)).all()
+    assert frequencies[4] == 0
+
+
+def test_clustered_draws_are_sorted():
+    activity = gd.PatientActivity(gd.PatientIdRange(0, 100), np.arange(1, 101, dtype=float), clustered=True)
+    codes = activity.sample(np.random.default_rng(0), 5000)
+    assert (np.diff(codes) >= 0).all()
+
+
+def test_merged_quantile_sketches_stay_within_rank_error():
+    rng = np.random.default_rng(0)
+    parts = [rng.lognormal(3.0, 1.0, 200_000), rng.normal(50.0, 5.0, 150_000), rng.uniform(0.0, 1000.0, 50_000)]
+    merged = gd.QuantileSketch(seed=1)
+    for seed, values in enumerate(parts, start=2):
+        sketch = gd.QuantileSketch(seed=seed)
+        for chunk in np.array_split(values, 7):
+            sketch.update(chunk)
+        merged.merge(sketch)
+    values = np.sort(np.concatenate(parts))
+    qs = [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+    ranks = np.searchsorted(values, merged.quantiles(qs)) / len(values)
+    assert np.abs(ranks - qs).max() < 0.025
+    assert (merged.count, merged.min, merged.max) == (len(values), values[0], values[-1])
+    assert merged.sum == pytest.approx(values.sum())
+    assert sum(len(items) for items in merged.levels) < 3 * gd.KLL_K
+
+
+def test_merged_hyperloglogs_estimate_the_union():
+    rng = np.random.default_rng(0)
+    ids = gd.format_patient_ids(range(300_000)).to_numpy()
+    merged = gd.HyperLogLog()
+    # Overlapping shards: every id appears in one or two of them, some many times
+    for start in range(0, 300_000, 50_000):
+        sketch = gd.HyperLogLog()
+        shard = ids[start:start + 80_000]
+        sketch.update(shard[rng.integers(0, len(shard), 3 * len(shard))])
+        sketch.update(shard)
+        merged.merge(sketch)
+    assert merged.estimate() == pytest.approx(300_000, rel=0.03)
+
+
+def test_hyperloglog_uses_linear_counting_for_small_sets():
+    sketch = gd.HyperLogLog()
+    sketch.update(gd.format_patient_ids(range(500)))
+    assert sketch.estimate() == pytest.approx(500, rel=0.02)
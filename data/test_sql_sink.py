@@ -0,0 +1,60 @@
+"""
+Tests for --sink: in-process, sharded and fused loads fill the same tables, and the join benchmark runs.
+
+Usage:
+    python -m pytest test_sql_sink.py
+"""
+
+import sys
+
+import pytest
+
+import generate_datasets as gd
+
+pytest.importorskip("pyarrow")
+
+ROWS = {"patients": 500, "labs": 20000, "notes": 3000}
+
+
+def load(monkeypatch, directory, sink, *options):
+    directory.mkdir()
+    monkeypatch.chdir(directory)
+    monkeypatch.setattr(sys, "argv", ["generate_datasets.py", "--sink", sink,
+                                      "--num-patients", str(ROWS["patients"]), "--num-lab-results", str(ROWS["labs"]),
+                                      "--num-notes", str(ROWS["notes"]), *options])
+    gd.main()
+    path = gd.DEFAULT_SINK_PATHS[sink]
+    tables = {dataset: gd.read_sink_table(path, sink, dataset) for dataset in gd.DATASET_FILES}
+    return path, tables
+
+
+def sorted_rows(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("sink", ["sqlite", "duckdb"])
+def test_sharded_load_matches_in_process_load(monkeypatch, tmp_path, sink):
+    if sink == "duckdb":
+        pytest.importorskip("duckdb")
+    # Counter-based rows don't depend on sharding, so both loads must hold identical tables
+    path, expected = load(monkeypatch, tmp_path / "in_process", sink, "--engine", "counter", "--chunk-size", "7000")
+    _, sharded = load(monkeypatch, tmp_path / "sharded", sink, "--engine", "counter", "--workers", "2",
+                      "--shard-size", "7000")
+    assert not list((tmp_path / "sharded").glob("*.csv"))
+    for dataset, df in sharded.items():
+        assert len(df) == ROWS[dataset]
+        gd.pd.testing.assert_frame_equal(sorted_rows(df), sorted_rows(expected[dataset]))
+    # Sharded rows are counted as written once, by the shards
+    assert gd.METRICS.totals[("labs", "write")]["rows"] == ROWS["labs"]
+
+    assert gd.run_join_benchmark(path, sink, repeat=1)["patients"].sum() == ROWS["patients"]
+
+
+@pytest.mark.parametrize("sink", ["sqlite", "duckdb"])
+def test_fused_load(monkeypatch, tmp_path, sink):
+    if sink == "duckdb":
+        pytest.importorskip("duckdb")
+    path, tables = load(monkeypatch, tmp_path / "fused", sink, "--engine", "numpy", "--fused", "--chunk-size", "200")
+    for dataset, df in tables.items():
+        assert len(df) == ROWS[dataset]
+    assert gd.run_join_benchmark(path, sink, repeat=1)["patients"].sum() == ROWS["patients"]